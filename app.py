@@ -1,8 +1,8 @@
 """Creates a program to handle fog of war for TTRPGs with save/load functionality"""
+import os
+import multiprocessing
 import tkinter as tk
 from tkinter import filedialog, messagebox
-import threading
-import queue
 import customtkinter as ctk
 import numpy as np
 from PIL import Image
@@ -11,13 +11,30 @@ from windows.dm_window import DMWindow
 from windows.player_window import PlayerWindow
 
 # Fog methods
-from utils.fog_utils import reset_fog, clear_fog
+from utils.fog_utils import reset_fog, clear_fog, StrokeEngine
+
+from utils.undo_redo_utils import UndoHistory, DEFAULT_UNDO_BUDGET
+from utils.autosave_utils import AutosaveService
+from utils.tile_utils import new_fog_mask, fog_shape, mask_scale, GridFogMask
+from utils.render_utils import FogRenderer, mask_rect_to_map, resize_mask_to_display
+from utils.perf_utils import PerfMonitor
+from utils.scheduler_utils import RenderScheduler, TARGET_FPS
+from utils.net_utils import PlayerServer
+from utils.campaign_utils import Campaign, CAMPAIGN_CACHE_MB
+from utils.shared_utils import PlayerProcess
+from utils.region_utils import RegionService
+from utils.sight_utils import SightEngine
+from utils.loader_utils import MapLoader
+from utils.index_utils import FogIndex
+
+# Fog detail choices: map pixels per fog pixel along each side
+FOG_SCALES = {"Full": 1, "1/2": 2, "1/4": 4, "1/8": 8}
 
 # Save/load methods
 from utils.save_utils import (
     save_fog_state, 
     load_fog_state,
-    auto_load_fog_state,
+    get_fog_save_path,
     update_status
 )
 
@@ -31,35 +48,53 @@ class FogOfWar:
         # Create the main control window
         self.root = ctk.CTk()
         self.root.title("Fog of War - Control Panel")
-        self.root.geometry("400x500")
+        self.root.geometry("400x780")
 
         self.root.bind('<F1>', self.show_help)
+        self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
 
         # Variables
+        self.map_source = None
         self.map_image = None
+        self.perf = PerfMonitor()
+        self.renderer = FogRenderer(self.perf)
         self.fog_mask = None
+        # New fog masks store one pixel per fog_scale x fog_scale map pixels
+        self.fog_scale = 1
         self.dm_window = None
         self.player_window = None
+        self.player_server = None
+        self.player_process = None
         self.reveal_radius = 70
-        self.update_queue = queue.Queue()
-        self.last_update_time = 0
-        self.update_interval = 0.017  # ~60 FPS (1/60 seconds)
-        self.undo_stack = []
-        self.redo_stack = []
+        self.target_fps = TARGET_FPS
+        self.scheduler = RenderScheduler(self.root, self.target_fps, self.perf)
+        self.undo_budget_mb = DEFAULT_UNDO_BUDGET // (1024 * 1024)
+        self.history = UndoHistory(max_bytes=self.undo_budget_mb * 1024 * 1024)
+        self.stroke = StrokeEngine(self)
 
         # Save/Load variables
         self.current_map_path = None
         self.current_save_path = None
         self.auto_save_enabled = True
+        self.autosave = AutosaveService(self)
+        # Fog saves and room indexes found by map content, across renames
+        self.fog_index = FogIndex()
+
+        # Campaign maps preloaded in the background
+        self.campaign = None
+        self.campaign_cache_mb = CAMPAIGN_CACHE_MB
+        self.campaign_names = {}
+
+        # Rooms of the shown map for one-click reveals
+        self.regions = RegionService(self)
+        # Token line of sight, walled by the map or its imported room map
+        self.sight = SightEngine(self)
+        # Maps are read on a background thread, showing a preview first
+        self.loader = MapLoader(self)
 
         # Create UI
         self.create_ui()
 
-        # Start the update thread
-        self.update_thread = threading.Thread(
-            target=self.update_windows, daemon=True)
-        self.update_thread.start()
-
     def show_help(self, event=None):
         """Shows the helper menu"""
 
@@ -70,16 +105,37 @@ class FogOfWar:
                             "Ctrl + Y  : Redo last undone action\n"
                             "F11       : Toggle fullscreen\n"
                             "Esc       : Exit fullscreen\n"
+                            "F3        : Toggle frame timings (DM view)\n"
                             "F1        : Show this help\n\n"
                             "Mouse:\n"
                             "Left Click      : Reveal fog\n"
-                            "Click + Drag    : Reveal multiple areas")
+                            "Click + Drag    : Reveal multiple areas\n"
+                            "Shift + Click   : Reveal a whole room\n"
+                            "Ctrl + Drag     : Move a token, revealing what it sees")
 
-    def push_undo(self):
-        """Modifies the undo/redo stacks"""
+    def push_undo(self, rect=None):
+        """Records the fog inside rect (everything if None) before it changes"""
         if self.fog_mask is not None:
-            self.undo_stack.append(self.fog_mask.copy())
-            self.redo_stack.clear()
+            self.history.record(self.fog_mask, rect)
+
+    @property
+    def editable(self):
+        """Whether the fog can be edited; a map preview's can't"""
+        return self.fog_mask is not None and self.current_map_path is not None
+
+    def mark_dirty(self, rect=None):
+        """Tells the renderer which fog mask area changed (None means
+        everything) and schedules a redraw of the open windows"""
+        map_rect = rect
+        if rect is not None:
+            map_rect = mask_rect_to_map(self.fog_mask, rect, self.map_source.shape)
+        self.renderer.mark_dirty(map_rect)
+        if self.player_server is not None:
+            self.player_server.mark_dirty(map_rect)
+        if self.player_process is not None:
+            # It mirrors the mask itself, so it takes mask coordinates
+            self.player_process.mark_dirty(rect)
+        self.scheduler.request()
 
     def create_ui(self):
         """Generates the UI for the first window"""
@@ -98,6 +154,19 @@ class FogOfWar:
                                  command=self.load_map, width=200)
         load_btn.pack(pady=10)
 
+        # Campaign: several maps preloaded for instant switching
+        campaign_frame = ctk.CTkFrame(self.root)
+        campaign_frame.pack(pady=(0, 10))
+
+        campaign_btn = ctk.CTkButton(campaign_frame, text="Load Campaign",
+                                     command=self.load_campaign, width=120)
+        campaign_btn.pack(side="left", padx=5)
+
+        self.map_menu = ctk.CTkOptionMenu(campaign_frame, values=["No campaign"],
+                                          command=self.switch_map, width=150)
+        self.map_menu.configure(state="disabled")
+        self.map_menu.pack(side="left", padx=5)
+
         # Save/Load buttons
         save_load_frame = ctk.CTkFrame(self.root)
         save_load_frame.pack(pady=10)
@@ -110,6 +179,18 @@ class FogOfWar:
                                  command=lambda: load_fog_state(self), width=120)
         load_btn.pack(side="left", padx=5)
 
+        # Room detection for Shift+Click reveals
+        region_frame = ctk.CTkFrame(self.root)
+        region_frame.pack(pady=(0, 10))
+
+        detect_btn = ctk.CTkButton(region_frame, text="Detect Rooms",
+                                   command=self.regions.detect, width=120)
+        detect_btn.pack(side="left", padx=5)
+
+        import_btn = ctk.CTkButton(region_frame, text="Import Room Map",
+                                   command=self.import_regions, width=120)
+        import_btn.pack(side="left", padx=5)
+
         # Reveal radius slider
         radius_label = ctk.CTkLabel(self.root, text="Reveal Size:")
         radius_label.pack(pady=(20, 5))
@@ -127,6 +208,34 @@ class FogOfWar:
         # Update radius value display
         self.radius_slider.configure(command=self.update_radius)
 
+        # Fog detail: coarser fog uses less memory and reveals faster
+        fog_scale_frame = ctk.CTkFrame(self.root)
+        fog_scale_frame.pack(pady=5)
+
+        fog_scale_label = ctk.CTkLabel(fog_scale_frame, text="Fog Detail:")
+        fog_scale_label.pack(side="left", padx=5)
+
+        self.fog_scale_menu = ctk.CTkOptionMenu(fog_scale_frame, values=list(FOG_SCALES),
+                                                command=self.set_fog_scale, width=90)
+        self.fog_scale_menu.set("Full")
+        self.fog_scale_menu.pack(side="left", padx=5)
+
+        # Grid mode: fog by whole battle grid cells, one bit each
+        grid_frame = ctk.CTkFrame(self.root)
+        grid_frame.pack(pady=5)
+
+        grid_label = ctk.CTkLabel(grid_frame, text="Grid:")
+        grid_label.pack(side="left", padx=5)
+
+        self.grid_size_entry = ctk.CTkEntry(grid_frame, width=60, placeholder_text="cell px")
+        self.grid_size_entry.pack(side="left", padx=2)
+
+        self.grid_offset_entry = ctk.CTkEntry(grid_frame, width=70, placeholder_text="offset x,y")
+        self.grid_offset_entry.pack(side="left", padx=2)
+
+        grid_btn = ctk.CTkButton(grid_frame, text="Use Grid", command=self.set_grid, width=80)
+        grid_btn.pack(side="left", padx=5)
+
         # Control buttons
         button_frame = ctk.CTkFrame(self.root)
         button_frame.pack(pady=20)
@@ -139,6 +248,17 @@ class FogOfWar:
                                    command=self.open_player_window, width=120)
         player_btn.pack(side="left", padx=5)
 
+        # Renders the player view on another core so it can't slow the DM down
+        self.separate_player = ctk.BooleanVar(value=False)
+        separate_box = ctk.CTkCheckBox(self.root, text="Player view in separate process",
+                                       variable=self.separate_player)
+        separate_box.pack(pady=(0, 10))
+
+        # Player view for another machine, see viewer.py
+        self.server_btn = ctk.CTkButton(self.root, text="Start Network Player",
+                                        command=self.toggle_player_server, width=200)
+        self.server_btn.pack(pady=(0, 10))
+
         # Reset and clear buttons
         control_frame = ctk.CTkFrame(self.root)
         control_frame.pack(pady=10)
@@ -156,6 +276,9 @@ class FogOfWar:
                                          font=ctk.CTkFont(size=10))
         self.status_label.pack(pady=(10, 0))
 
+        # Shown below the status while a map loads
+        self.load_progress = ctk.CTkProgressBar(self.root, width=200)
+
     def update_radius(self, value):
         """Updates the radius of what will be removed"""
         self.reveal_radius = int(value)
@@ -170,65 +293,121 @@ class FogOfWar:
         )
 
         if file_path:
-            try:
-                # Load the image using PIL (already in RGB format)
-                pil_image = Image.open(file_path).convert('RGB')
-                self.map_image = np.array(pil_image)
-                self.current_map_path = file_path
-
-                # Create initial fog mask (all black)
-                self.fog_mask = np.zeros(
-                    (self.map_image.shape[0], self.map_image.shape[1]), dtype=np.uint8)
-                # Try to auto-load associated fog state
-                auto_load_fog_state(self)
-                messagebox.showinfo("Success", "Map loaded successfully!")
-                update_status(self, "Map loaded successfully")
-
-                # Update windows if they're open
-                self.update_queue.put("update_all")
+            # Decodes the image (or maps its cached decode) and auto-loads
+            # its fog state in the background
+            self.loader.load(file_path)
+
+    def set_fog_scale(self, label):
+        """Changes the fog detail, resampling the fog of the shown map"""
+        self.fog_scale = FOG_SCALES[label]
+        if not self.editable:
+            return
+        shape = fog_shape(self.map_image.shape, self.fog_scale)
+        if shape == self.fog_mask.shape and not isinstance(self.fog_mask, GridFogMask):
+            return
 
-            except Exception as e:
-                messagebox.showerror(
-                    "Error", f"Failed to load image: {str(e)}")
-                update_status(self, "Failed to load map")
+        resized = resize_mask_to_display(self.fog_mask, (shape[1], shape[0]))
+        fog_mask = new_fog_mask(shape)
+        fog_mask[:, :] = np.where(resized > 127, 255, 0).astype(np.uint8)
+        self.replace_fog_mask(fog_mask)
+        update_status(self, f"Fog detail set to {label}")
 
-    def update_windows(self):
-        """Updates the windows"""
-        while True:
-            try:
-                message = self.update_queue.get(timeout=0.1)
-                if message == "update_all":
-                    while not self.update_queue.empty():
-                        try:
-                            self.update_queue.get_nowait()
-                        except queue.Empty:
-                            break
-
-                    try:
-                        if self.dm_window and hasattr(self.dm_window, 'window'):
-                            if self.dm_window.window.winfo_exists():
-                                self.dm_window.window.after_idle(
-                                    self.dm_window.update_display)
-                    except tk.TclError:
-                        self.dm_window = None
-                    except Exception as e:
-                        print(f"Error updating DM window: {e}")
-
-                    try:
-                        if self.player_window and hasattr(self.player_window, 'window'):
-                            if self.player_window.window.winfo_exists():
-                                self.player_window.window.after_idle(
-                                    self.player_window.update_display)
-                    except tk.TclError:
-                        self.player_window = None
-                    except Exception as e:
-                        print(f"Error updating player window: {e}")
-
-            except queue.Empty:
-                continue
-            except Exception as e:
-                print(f"Error in update_windows: {e}")
-                continue
+    def set_grid(self):
+        """Switches the shown map to grid fog with the entered cell size and offset"""
+        if not self.editable:
+            messagebox.showwarning("Warning", "Please load a map first!")
+            return
+        try:
+            cell_size = int(self.grid_size_entry.get())
+            offset = [int(v) for v in (self.grid_offset_entry.get() or "0,0").split(",")]
+            if cell_size < 2 or len(offset) != 2:
+                raise ValueError
+        except ValueError:
+            messagebox.showerror(
+                "Error", "Enter the cell size in pixels and the grid offset as x,y")
+            return
+
+        self.replace_fog_mask(GridFogMask.from_mask(
+            self.fog_mask, self.map_image.shape, cell_size, offset))
+        rows, cols = self.fog_mask.shape
+        update_status(self, f"Grid fog with {cols}x{rows} cells")
+
+    def replace_fog_mask(self, fog_mask):
+        """Swaps in a converted mask, saving it right away with a fresh journal"""
+        # The old mask is saved first; the new one starts a new journal
+        self.stroke.end()
+        self.autosave.detach()
+        self.fog_mask = fog_mask
+        self.history.clear()
+        self.autosave.attach(get_fog_save_path(self), replay=False)
+        self.autosave.flush()
+        self.mark_dirty()
+
+    def show_fog_scale(self):
+        """Shows the detail or grid of the current fog and keeps using it"""
+        if self.fog_mask is None:
+            return
+        if isinstance(self.fog_mask, GridFogMask):
+            cell_size, offset = self.fog_mask.geometry
+            self.grid_size_entry.delete(0, "end")
+            self.grid_size_entry.insert(0, str(cell_size))
+            self.grid_offset_entry.delete(0, "end")
+            self.grid_offset_entry.insert(0, f"{offset[0]},{offset[1]}")
+            return
+        self.fog_scale = mask_scale(self.map_image.shape, self.fog_mask.shape)
+        for label, scale in FOG_SCALES.items():
+            if scale == self.fog_scale:
+                self.fog_scale_menu.set(label)
+
+    def load_campaign(self):
+        """Selects the maps of a session and starts preloading them"""
+        file_paths = filedialog.askopenfilenames(
+            title="Select Campaign Maps",
+            filetypes=[
+                ("Image files", "*.png *.jpg *.jpeg *.bmp *.tiff *.gif")]
+        )
+        if not file_paths:
+            return
+
+        self.loader.cancel()
+        if self.campaign is not None:
+            self.campaign.deactivate()
+            self.campaign.close()
+        self.campaign = Campaign(self, file_paths,
+                                 max_bytes=self.campaign_cache_mb * 1024 * 1024)
+
+        # Menu labels are file names, numbered if two maps share one
+        self.campaign_names = {}
+        for path in file_paths:
+            name = os.path.basename(path)
+            while name in self.campaign_names:
+                name = f"{os.path.basename(path)} ({len(self.campaign_names)})"
+            self.campaign_names[name] = path
+        self.map_menu.configure(values=list(self.campaign_names), state="normal")
+
+        first = next(iter(self.campaign_names))
+        self.map_menu.set(first)
+        self.campaign.switch_to(self.campaign_names[first])
+        self.campaign.preload()
+
+    def switch_map(self, name):
+        """Shows another map of the campaign"""
+        if self.campaign is not None and name in self.campaign_names:
+            self.loader.cancel()
+            self.campaign.switch_to(self.campaign_names[name])
+
+    def import_regions(self):
+        """Loads an image whose colours mark the rooms of the shown map"""
+        if self.map_image is None:
+            messagebox.showwarning("Warning", "Please load a map first!")
+            return
+        file_path = filedialog.askopenfilename(
+            title="Select Room Map",
+            filetypes=[
+                ("Image files", "*.png *.jpg *.jpeg *.bmp *.tiff *.gif")]
+        )
+        if file_path:
+            self.regions.import_labels(file_path)
 
     def open_dm_window(self):
             """Opens the DM window"""
@@ -239,7 +418,6 @@ class FogOfWar:
             try:
                 if self.dm_window is None or not self.dm_window.window.winfo_exists():
                     self.dm_window = DMWindow(self)
-                    self.dm_window.window.after(200, self.dm_window.update_display)
                 else:
                     self.dm_window.window.lift()
             except Exception as e:
@@ -252,21 +430,97 @@ class FogOfWar:
             messagebox.showwarning("Warning", "Please load a map first!")
             return
 
+        if self.separate_player.get():
+            self.open_player_process()
+            return
+
         try:
             if self.player_window is None or not self.player_window.window.winfo_exists():
                 self.player_window = PlayerWindow(self)
-                self.player_window.window.after(
-                    200, self.player_window.update_display)
             else:
                 self.player_window.window.lift()
         except Exception as e:
             messagebox.showerror(
                 "Error", f"Failed to open player window: {str(e)}")
     
+    def toggle_player_server(self):
+        """Starts or stops streaming the player view to network viewers"""
+        if self.player_server is not None:
+            self.scheduler.unregister('network')
+            self.player_server.stop()
+            self.player_server = None
+            self.server_btn.configure(text="Start Network Player")
+            update_status(self, "Network player stopped")
+            return
+
+        try:
+            server = PlayerServer(self)
+            _, port = server.start()
+        except OSError as e:
+            messagebox.showerror(
+                "Error", f"Failed to start network player: {str(e)}")
+            return
+
+        self.player_server = server
+        self.scheduler.register('network', server.flush)
+        self.server_btn.configure(text="Stop Network Player")
+        update_status(self, f"Network player on port {port}: python viewer.py <this PC>:{port}")
+
+    def open_player_process(self):
+        """Opens the player view in its own process"""
+        if self.player_process is not None and self.player_process.alive:
+            return
+        self.close_player_process()
+        try:
+            self.player_process = PlayerProcess(self)
+            self.player_process.start()
+        except Exception as e:
+            self.player_process = None
+            messagebox.showerror(
+                "Error", f"Failed to start player process: {str(e)}")
+            return
+        self.scheduler.register('player_process', self.flush_player_process)
+
+    def flush_player_process(self):
+        """Feeds the player process, cleaning up once its window was closed"""
+        if self.player_process is not None and not self.player_process.alive:
+            self.close_player_process()
+            return
+        self.player_process.flush()
+
+    def close_player_process(self):
+        """Stops the player process and frees its shared memory"""
+        if self.player_process is not None:
+            self.scheduler.unregister('player_process')
+            self.player_process.stop()
+            self.player_process = None
+
+    def on_closing(self):
+        """Writes the final autosave and frame timings before exiting"""
+        self.scheduler.cancel()
+        self.loader.cancel()
+        if self.campaign is not None:
+            self.campaign.close()
+        if self.player_server is not None:
+            self.player_server.stop()
+        self.close_player_process()
+        self.regions.close()
+        self.autosave.close()
+        try:
+            perf_path = self.perf.export()
+            if perf_path:
+                print(f"Frame timings saved to {perf_path}")
+        except Exception as e:
+            print(f"Error exporting frame timings: {e}")
+        self.root.destroy()
+
     def run(self):
         """Runs the main loop"""
         self.root.mainloop()
         
 if __name__ == "__main__":
+    # In the frozen exe the player process re-runs this file; this makes it
+    # run the player window instead of another control panel
+    multiprocessing.freeze_support()
     app = FogOfWar()
     app.run()
@@ -0,0 +1,104 @@
+"""Microbenchmark for the fog compositors on the bundled test1.png
+
+Compares, per frame, the original float32 full-resolution blend + LANCZOS
+resize, the float32 blend at display resolution and the integer Compositor.
+
+    python benchmarks/bench_compositor.py [--frames 50] [--size 1280x720]
+"""
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+import numpy as np
+import cv2
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.render_utils import Compositor, darken_for_dm, resize_to_display
+
+MAP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        "test1.png")
+
+
+def float_full_res(map_image, fog_mask, display_size):
+    """The original DM update_display: float32 blend, then LANCZOS resize"""
+    dm_image = map_image.copy()
+    fog_overlay = np.full_like(dm_image, 64, dtype=np.uint8)
+    fog_alpha = (255 - fog_mask).astype(np.float32) / 255.0
+    fog_alpha = fog_alpha[:, :, np.newaxis]
+    dm_image = dm_image.astype(np.float32)
+    fog_overlay = fog_overlay.astype(np.float32)
+    dm_image = (dm_image * (1 - fog_alpha * 0.7) +
+                fog_overlay * fog_alpha * 0.7).astype(np.uint8)
+    return np.asarray(Image.fromarray(dm_image).resize(display_size, Image.LANCZOS))
+
+
+def float_display_res(map_cache, fog_cache):
+    """The float32 blend applied to display-size caches"""
+    fog_overlay = np.full_like(map_cache, 64, dtype=np.uint8)
+    fog_alpha = (255 - fog_cache).astype(np.float32) / 255.0
+    fog_alpha = fog_alpha[:, :, np.newaxis]
+    return (map_cache.astype(np.float32) * (1 - fog_alpha * 0.7) +
+            fog_overlay.astype(np.float32) * fog_alpha * 0.7).astype(np.uint8)
+
+
+def measure(name, render, frames):
+    """Runs render() and prints median frame time and peak traced allocation"""
+    render()
+    times = []
+    for _ in range(frames):
+        start = time.perf_counter()
+        render()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    render()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{name:<28} {np.median(times) * 1000:9.2f} ms {peak / 1024 / 1024:10.2f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=50)
+    parser.add_argument("--size", default="1280x720",
+                        help="canvas size the map is fitted into")
+    args = parser.parse_args()
+
+    map_image = np.array(Image.open(MAP_PATH).convert('RGB'))
+    img_height, img_width = map_image.shape[:2]
+    canvas_width, canvas_height = (int(v) for v in args.size.split("x"))
+    scale = min(canvas_width / img_width, canvas_height / img_height)
+    display_size = (int(img_width * scale), int(img_height * scale))
+
+    # A few revealed rooms so the fog has hard edges to resample
+    fog_mask = np.zeros(map_image.shape[:2], dtype=np.uint8)
+    rng = np.random.default_rng(0)
+    for _ in range(40):
+        x, y = rng.integers(0, img_width), rng.integers(0, img_height)
+        cv2.rectangle(fog_mask, (int(x), int(y)), (int(x) + 150, int(y) + 100), 255, -1)
+
+    map_cache = resize_to_display(map_image, display_size)
+    dark_cache = darken_for_dm(map_cache)
+    fog_cache = resize_to_display(fog_mask, display_size, Image.BILINEAR)
+    frame = np.empty_like(map_cache)
+    compositor = Compositor()
+
+    print(f"map {img_width}x{img_height} -> display {display_size[0]}x{display_size[1]}, "
+          f"{args.frames} frames")
+    print(f"{'compositor':<28} {'per frame':>12} {'peak alloc':>13}")
+    measure("float32 full-res + resize",
+            lambda: float_full_res(map_image, fog_mask, display_size), args.frames)
+    measure("float32 display-res",
+            lambda: float_display_res(map_cache, fog_cache), args.frames)
+    measure("integer Compositor (DM)",
+            lambda: compositor.dm(map_cache, dark_cache, fog_cache, frame), args.frames)
+    measure("integer Compositor (player)",
+            lambda: compositor.player(map_cache, fog_cache, frame), args.frames)
+
+
+if __name__ == "__main__":
+    main()
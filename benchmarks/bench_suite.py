@@ -0,0 +1,362 @@
+"""Headless performance suite for the fog operations, renderer and save files
+
+For each synthetic map size it replays brush strokes through reveal_path,
+renders the DM and player views after every per-frame flush, undoes the
+strokes, then saves and loads the fog. It reports latency percentiles and
+peak traced memory, and can compare against a stored baseline.
+
+    python benchmarks/bench_suite.py
+    python benchmarks/bench_suite.py --sizes 1024,16384 --replay fog/map.fog.journal
+    python benchmarks/bench_suite.py --repeat 5 --save-baseline benchmarks/baseline.json
+    python benchmarks/bench_suite.py --repeat 5 --baseline benchmarks/baseline.json --threshold 0.25
+
+benchmarks/baseline.json is a reference with the default settings, the
+median of five runs; its recorded_on entry names the machine and settings
+it was taken with. Compare against it with the same --repeat, as single
+runs are noisier. Metrics with few samples (full frame, undo, save and
+load) are compared on p50 only. Timings only compare on similar
+hardware, so record your own baseline before changing anything when
+working on another machine.
+
+No display is needed, so it runs on a plain Linux box.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.fog_utils import reveal_path
+from utils.undo_redo_utils import UndoHistory
+from utils.render_utils import FogRenderer, mask_rect_to_map
+from utils.map_utils import MapSource
+from utils.tile_utils import new_fog_mask
+from utils.save_utils import write_fog_file, read_fog_file
+from utils.perf_utils import PerfMonitor
+
+DEFAULT_SIZES = "1024,2048,4096,8192,16384"
+DM_CANVAS = (1280, 720)
+PLAYER_CANVAS = (1920, 1080)
+# Timed runs of the full frame, save and load, after one discarded warm-up
+TIMED_SAMPLES = 20
+# Fewer samples than this make p95 little more than the slowest run, so
+# such metrics are compared on p50 only
+P95_MIN_SAMPLES = 100
+
+
+class NullAutosave:
+    """Accepts journal records without writing anything"""
+
+    seq = 0
+
+    def record(self, op, rect=None, **fields):
+        pass
+
+
+class NullScheduler:
+    """Ignores redraw requests; the suite renders explicitly"""
+
+    def request(self, view=None):
+        pass
+
+
+class HeadlessFogApp:
+    """The parts of FogOfWar the fog operations touch, without any Tk"""
+
+    def __init__(self, map_source, reveal_radius):
+        self.map_source = map_source
+        self.map_image = map_source.pixels
+        self.fog_mask = new_fog_mask(map_source.shape[:2])
+        self.reveal_radius = reveal_radius
+        self.history = UndoHistory()
+        self.autosave = NullAutosave()
+        self.perf = PerfMonitor(enabled=False)
+        self.renderer = FogRenderer(self.perf)
+        self.scheduler = NullScheduler()
+
+    def push_undo(self, rect=None):
+        self.history.record(self.fog_mask, rect)
+
+    def mark_dirty(self, rect=None):
+        if rect is not None:
+            rect = mask_rect_to_map(self.fog_mask, rect, self.map_source.shape)
+        self.renderer.mark_dirty(rect)
+        self.scheduler.request()
+
+
+def synthetic_map(width, height):
+    """A parchment-like map with a dark 70 px grid, built without a decoder"""
+    rng = np.random.default_rng(width)
+    texture = rng.integers(150, 230, (256, 256, 3), dtype=np.uint8)
+    pixels = np.tile(texture, (-(-height // 256), -(-width // 256), 1))[:height, :width]
+    pixels = np.ascontiguousarray(pixels)
+    pixels[::70] = 40
+    pixels[:, ::70] = 40
+    return pixels
+
+
+def scripted_strokes(width, height, count=30, frames=40, seed=0):
+    """Random-walk drags as lists of per-frame point batches"""
+    rng = np.random.default_rng(seed)
+    strokes = []
+    for _ in range(count):
+        x, y = rng.uniform(0, width), rng.uniform(0, height)
+        heading = rng.uniform(0, 2 * np.pi)
+        batches = [[(int(x), int(y))]]
+        for _ in range(frames):
+            batch = []
+            # A few motion events per frame, each up to ~1.5% of the map
+            for _ in range(rng.integers(1, 5)):
+                heading += rng.normal(0, 0.4)
+                step = rng.uniform(0.002, 0.015) * width
+                x = float(np.clip(x + np.cos(heading) * step, 0, width - 1))
+                y = float(np.clip(y + np.sin(heading) * step, 0, height - 1))
+                batch.append((int(x), int(y)))
+            batches.append(batch)
+        strokes.append(batches)
+    return strokes
+
+
+def journal_strokes(journal_path, width, height):
+    """Stroke flushes recorded in an autosave journal, scaled to the map size"""
+    with open(journal_path, 'r') as f:
+        lines = f.read().splitlines()
+    source_height, source_width = json.loads(lines[0])['map_shape']
+    scale_x, scale_y = width / source_width, height / source_height
+
+    strokes = []
+    for line in lines[1:]:
+        entry = json.loads(line)
+        if entry.get('op') != 'stroke':
+            continue
+        points = [(int(x * scale_x), int(y * scale_y)) for x, y in entry['points']]
+        # Each journal entry is one per-frame flush; a single point starts a stroke
+        if len(points) == 1 or not strokes:
+            strokes.append([points])
+        else:
+            strokes[-1].append(points[1:])
+    return strokes
+
+
+def percentiles(samples):
+    """p50/p95/p99 of a list of seconds, in milliseconds"""
+    if not samples:
+        return {}
+    values = np.array(samples) * 1000
+    return {'p50': float(np.percentile(values, 50)),
+            'p95': float(np.percentile(values, 95)),
+            'p99': float(np.percentile(values, 99)),
+            'count': len(samples)}
+
+
+def replay(app, strokes, timings=None):
+    """Replays strokes like the StrokeEngine does, rendering after each flush"""
+    for batches in strokes:
+        app.history.begin_stroke()
+        last_point = None
+        for batch in batches:
+            path = batch if last_point is None else [last_point] + batch
+            last_point = batch[-1]
+
+            start = time.perf_counter()
+            reveal_path(app, path)
+            reveal_done = time.perf_counter()
+            app.renderer.render('dm', app.map_source, app.fog_mask, DM_CANVAS)
+            app.renderer.render('player', app.map_source, app.fog_mask, PLAYER_CANVAS)
+            frame_done = time.perf_counter()
+
+            if timings is not None:
+                timings['reveal'].append(reveal_done - start)
+                timings['frame'].append(frame_done - reveal_done)
+        app.history.end_stroke()
+
+
+def bench_size(width, height, strokes_for, reveal_radius, save_dir):
+    """Runs every measurement for one map size"""
+    map_source = MapSource.from_array(synthetic_map(width, height))
+    strokes = strokes_for(width, height)
+    timings = {'reveal': [], 'frame': [], 'full_frame': [], 'undo': [],
+               'save': [], 'load': []}
+
+    app = HeadlessFogApp(map_source, reveal_radius)
+    # The first pass warms up caches and allocations and isn't timed
+    for run in range(TIMED_SAMPLES + 1):
+        app.renderer.mark_dirty()
+        start = time.perf_counter()
+        app.renderer.render('dm', map_source, app.fog_mask, DM_CANVAS)
+        app.renderer.render('player', map_source, app.fog_mask, PLAYER_CANVAS)
+        if run:
+            timings['full_frame'].append(time.perf_counter() - start)
+
+    replay(app, strokes, timings)
+
+    while True:
+        start = time.perf_counter()
+        bbox = app.history.undo(app.fog_mask)
+        if bbox is None:
+            break
+        timings['undo'].append(time.perf_counter() - start)
+    for _ in strokes:
+        app.history.redo(app.fog_mask)
+
+    save_path = os.path.join(save_dir, f"bench_{width}.fog")
+    for run in range(TIMED_SAMPLES + 1):
+        start = time.perf_counter()
+        write_fog_file(save_path, app.fog_mask, {'map_path': None})
+        saved = time.perf_counter()
+        read_fog_file(save_path)
+        if run:
+            timings['save'].append(saved - start)
+            timings['load'].append(time.perf_counter() - saved)
+    file_size = os.path.getsize(save_path)
+
+    # Separate pass for memory, since tracing slows allocations down
+    tracemalloc.start()
+    traced_app = HeadlessFogApp(map_source, reveal_radius)
+    replay(traced_app, strokes[:5])
+    write_fog_file(save_path, traced_app.fog_mask, {'map_path': None})
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    results = {name: percentiles(samples) for name, samples in timings.items()}
+    results['peak_mb'] = peak / 1024 / 1024
+    results['fog_mb'] = app.fog_mask.nbytes / 1024 / 1024
+    results['save_kb'] = file_size / 1024
+    return results
+
+
+def print_results(label, results):
+    """Prints one size's results as a small table"""
+    print(f"\n{label}")
+    for name in ('reveal', 'frame', 'full_frame', 'undo', 'save', 'load'):
+        stats = results[name]
+        if stats:
+            print(f"  {name:<11} p50 {stats['p50']:8.2f} ms  p95 {stats['p95']:8.2f} ms"
+                  f"  p99 {stats['p99']:8.2f} ms  (n={stats['count']})")
+    print(f"  peak traced memory {results['peak_mb']:.1f} MB, fog mask "
+          f"{results['fog_mb']:.1f} MB, save file {results['save_kb']:.0f} KB")
+
+
+def median_results(runs):
+    """Per-metric medians of several runs of one size, to even out noise"""
+    merged = {}
+    for name, value in runs[0].items():
+        if isinstance(value, dict):
+            merged[name] = {key: float(np.median([run[name][key] for run in runs]))
+                            for key in value}
+            if 'count' in value:
+                merged[name]['count'] = value['count']
+        else:
+            merged[name] = float(np.median([run[name] for run in runs]))
+    return merged
+
+
+def machine_info(args):
+    """The machine and settings a run was recorded with"""
+    cpu = platform.processor()
+    if os.path.exists('/proc/cpuinfo'):
+        with open('/proc/cpuinfo', 'r') as f:
+            cpu = next((line.split(':', 1)[1].strip() for line in f
+                        if line.startswith('model name')), cpu)
+    return {
+        'cpu': cpu,
+        'cores': os.cpu_count(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'sizes': args.sizes,
+        'strokes': args.replay or args.strokes,
+        'radius': args.radius,
+        'repeat': args.repeat,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Returns the metrics that got slower or bigger than baseline * (1 + threshold)"""
+    regressions = []
+    for label, metrics in results.items():
+        for name, stats in metrics.items():
+            base = baseline.get(label, {}).get(name)
+            if base is None:
+                continue
+            if isinstance(stats, dict):
+                keys = ('p50', 'p95')
+                if min(stats.get('count', 0), base.get('count', 0)) < P95_MIN_SAMPLES:
+                    keys = ('p50',)
+                pairs = [(stats[k], base[k], f"{name} {k}") for k in keys
+                         if k in stats and k in base]
+            else:
+                pairs = [(stats, base, name)]
+            for value, reference, metric in pairs:
+                # Ignore sub-millisecond noise
+                if value > reference * (1 + threshold) and value - reference > 0.5:
+                    regressions.append(f"{label} {metric}: {reference:.2f} -> {value:.2f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default=DEFAULT_SIZES,
+                        help="comma separated map widths (height is 3/4 of width)")
+    parser.add_argument("--replay", help="autosave journal whose strokes are replayed")
+    parser.add_argument("--strokes", type=int, default=30,
+                        help="number of scripted strokes when not replaying")
+    parser.add_argument("--radius", type=int, default=70, help="brush size in pixels")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="run each size this many times and report the medians")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--save-baseline", help="store the results as a baseline")
+    parser.add_argument("--baseline", help="baseline to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed slowdown before a metric counts as a regression")
+    args = parser.parse_args()
+
+    if args.replay:
+        strokes_for = lambda width, height: journal_strokes(args.replay, width, height)
+    else:
+        strokes_for = lambda width, height: scripted_strokes(width, height, args.strokes)
+
+    save_dir = tempfile.mkdtemp(prefix="fog_bench_")
+    all_results = {}
+    try:
+        for width in (int(size) for size in args.sizes.split(",")):
+            height = width * 3 // 4
+            label = f"{width}x{height}"
+            all_results[label] = median_results(
+                [bench_size(width, height, strokes_for, args.radius, save_dir)
+                 for _ in range(args.repeat)])
+            print_results(label, all_results[label])
+    finally:
+        shutil.rmtree(save_dir, ignore_errors=True)
+
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(dict(all_results, recorded_on=machine_info(args)), f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        recorded_on = baseline.get('recorded_on')
+        if recorded_on:
+            print(f"\nBaseline recorded on {recorded_on['cpu']} ({recorded_on['cores']} cores), "
+                  f"sizes {recorded_on['sizes']}, strokes {recorded_on['strokes']}, "
+                  f"radius {recorded_on['radius']}, median of {recorded_on.get('repeat', 1)}")
+        regressions = compare(all_results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\nNo regressions over {args.threshold:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""Exports fogged player (and DM) views of many maps without opening the app
+
+Each map is rendered with the fog of its fog/<name>.fog save, or for a map
+that was renamed or moved, the save the app's fog index knows for the same
+image (plus any edits still in the autosave journal), using the same
+renderer as the windows. A map without a readable save is exported fully
+fogged. Maps are spread over a process pool, one map per task; each map is
+kept only at the largest export size, and every worker is replaced after a
+few maps so memory stays bounded on big batches.
+
+    python export.py maps/ -o handouts/
+    python export.py maps/*.jpg -o out/ --size 1920x1080 --size 800x600 --dm
+    python export.py maps/ -o out/ --workers 4 --format jpg
+
+No display is needed, so it runs on a server.
+"""
+import os
+import sys
+import zlib
+import struct
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from PIL import Image
+
+from utils.map_utils import MapSource
+from utils.render_utils import FogRenderer
+from utils.save_utils import read_fog_file, fog_save_path
+from utils.index_utils import FogIndex
+from utils.tile_utils import fog_shape, saved_fog_shape
+from utils.autosave_utils import journal_path, read_journal, apply_journal_entry
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.gif')
+DEFAULT_SIZE = "1920x1080"
+# Maps a worker process renders before it is replaced with a fresh one
+EXPORT_TASKS_PER_CHILD = 8
+# JPEG quality of exported images
+EXPORT_JPEG_QUALITY = 92
+# Map pixels per fog pixel of the full fog of maps without a save
+UNSAVED_FOG_SCALE = 8
+
+# The app's fog index, read once per worker process and never written
+worker_fog_index = None
+
+
+def find_maps(paths):
+    """Map images among the given files and directories (not recursive)"""
+    maps = []
+    for path in paths:
+        if os.path.isdir(path):
+            maps += sorted(os.path.join(path, name) for name in os.listdir(path)
+                           if name.lower().endswith(IMAGE_EXTENSIONS))
+        elif path.lower().endswith(IMAGE_EXTENSIONS):
+            maps.append(path)
+    return maps
+
+
+def find_fog(map_path):
+    """The fog save of a map, by its name or else by its content, or None"""
+    fog_path = fog_save_path(map_path)
+    if os.path.exists(fog_path):
+        return fog_path
+
+    # Saved under an earlier name or folder of the same image
+    global worker_fog_index
+    if worker_fog_index is None:
+        worker_fog_index = FogIndex(read_only=True)
+    return worker_fog_index.find_save(worker_fog_index.map_key(map_path))
+
+
+def parse_size(text):
+    width, _, height = text.lower().partition("x")
+    return (int(width), int(height))
+
+
+def decode_map(map_path, sizes):
+    """Decodes a map no larger than the biggest export needs.
+
+    JPEGs are decoded in draft mode straight at a reduced scale; other
+    formats are decoded in full and shrunk right away, so only the reduced
+    image and its pyramid are kept.
+    """
+    image = Image.open(map_path)
+    width, height = image.size
+    scale = min(1.0, max(min(w / width, h / height) for w, h in sizes))
+    target = (max(1, int(width * scale)), max(1, int(height * scale)))
+    image.draft('RGB', target)
+    image = image.convert('RGB')
+    if image.size[0] > target[0]:
+        image = image.resize(target, Image.LANCZOS)
+    return MapSource.from_array(np.asarray(image), map_path), (height, width)
+
+
+def load_fog(map_path, shape):
+    """The saved fog of a map with its journal replayed, or full fog"""
+    fog_path = find_fog(map_path)
+    fog_mask = None
+    if fog_path is not None:
+        try:
+            metadata, fog_mask = read_fog_file(fog_path)
+            if fog_mask.shape != saved_fog_shape(shape, metadata):
+                fog_mask = None
+            elif os.path.exists(journal_path(fog_path)):
+                for entry in read_journal(journal_path(fog_path), fog_mask.shape):
+                    if entry['seq'] > metadata.get('journal_seq', 0):
+                        apply_journal_entry(fog_mask, entry)
+        except (OSError, ValueError, KeyError, zlib.error, struct.error) as e:
+            print(f"Error reading {fog_path}, exporting the map fully fogged: {e}")
+            fog_mask = None
+    if fog_mask is None:
+        # Full fog is uniform, so a small mask renders the same as a full one
+        fog_mask = np.zeros(fog_shape(shape, UNSAVED_FOG_SCALE), dtype=np.uint8)
+    return fog_mask
+
+
+def export_map(map_path, out_dir, sizes, views, image_format):
+    """Renders one map at every size and view; returns the written paths"""
+    map_source, shape = decode_map(map_path, sizes)
+    # The renderer resamples the fog from its own size, so it needs no
+    # matching to the reduced decode
+    fog_mask = load_fog(map_path, shape)
+
+    renderer = FogRenderer()
+    map_name = os.path.splitext(os.path.basename(map_path))[0]
+    written = []
+    for size in sizes:
+        suffix = f"_{size[0]}x{size[1]}" if len(sizes) > 1 else ""
+        for view in views:
+            frame, _, _ = renderer.render(view, map_source, fog_mask, size)
+            path = os.path.join(out_dir, f"{map_name}_{view}{suffix}.{image_format}")
+            image = Image.fromarray(frame)
+            if image_format == 'jpg':
+                image.save(path, quality=EXPORT_JPEG_QUALITY)
+            else:
+                image.save(path)
+            written.append(path)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("maps", nargs="+", help="map images or folders of them")
+    parser.add_argument("-o", "--out", default="export", help="output folder")
+    parser.add_argument("--size", action="append", type=parse_size,
+                        help=f"fit the view into WIDTHxHEIGHT, repeatable (default {DEFAULT_SIZE})")
+    parser.add_argument("--dm", action="store_true", help="also export the DM view")
+    parser.add_argument("--format", choices=("png", "jpg"), default="png")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="worker processes (default: all cores)")
+    args = parser.parse_args()
+
+    sizes = args.size or [parse_size(DEFAULT_SIZE)]
+    views = ('player', 'dm') if args.dm else ('player',)
+    maps = find_maps(args.maps)
+    if not maps:
+        print("No map images found")
+        return 1
+    os.makedirs(args.out, exist_ok=True)
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=min(args.workers, len(maps)),
+                             max_tasks_per_child=EXPORT_TASKS_PER_CHILD) as executor:
+        futures = {executor.submit(export_map, path, args.out, sizes, views, args.format): path
+                   for path in maps}
+        for done, future in enumerate(as_completed(futures), 1):
+            name = os.path.basename(futures[future])
+            try:
+                future.result()
+                print(f"[{done}/{len(maps)}] {name}")
+            except Exception as e:
+                failed += 1
+                print(f"[{done}/{len(maps)}] Error exporting {name}: {e}")
+
+    print(f"Exported {len(maps) - failed} of {len(maps)} maps to {args.out}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
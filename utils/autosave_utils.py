@@ -0,0 +1,332 @@
+import os
+import json
+import base64
+import queue
+import threading
+import zlib
+from collections import deque
+import numpy as np
+
+from utils.save_utils import fog_metadata, write_fog_file, index_fog_save, update_status
+from utils.fog_utils import brush_segment_bbox, stamp_segment, polygon_bbox, stamp_polygon
+from utils.tile_utils import TiledFogMask
+
+# Quiet period after the last edit before a snapshot is taken (seconds)
+AUTOSAVE_DELAY = 2.0
+
+
+class AutosaveService:
+    """Saves the fog in the background and journals every edit in between.
+
+    Each fog operation is appended to <save>.fog.journal as one JSON line
+    with an increasing sequence number. After edits stop for `delay` seconds
+    the mask is copied on the Tk thread and handed to a worker thread that
+    writes the .fog file atomically and trims the journal to the entries the
+    snapshot doesn't contain. After a crash, loading the .fog file and
+    replaying the newer journal entries rebuilds the exact fog. Entries
+    holding the whole mask are packed by the worker from a copy, and the
+    entries after one wait for it so the journal stays in order.
+    """
+
+    def __init__(self, fog_app, delay=AUTOSAVE_DELAY):
+        self.fog_app = fog_app
+        self.delay_ms = int(delay * 1000)
+        self.save_path = None
+        self.journal_file = None
+        self.journal_lock = threading.Lock()
+        self.pending = []
+        # Pending entries not written to the journal file yet, in order
+        self.unwritten = deque()
+        # Sequence numbers of entries the worker is still packing
+        self.encoding = set()
+        self.seq = 0
+        self.after_id = None
+
+        self.jobs = queue.Queue()
+        self.worker = threading.Thread(target=self.run_worker, daemon=True)
+        self.worker.start()
+
+    def attach(self, save_path, journal_seq=0, replay=True):
+        """Starts journaling for save_path, replaying edits newer than journal_seq"""
+        self.detach()
+        self.save_path = save_path
+        self.seq = journal_seq
+        self.pending = []
+        self.unwritten.clear()
+        self.encoding.clear()
+
+        path = journal_path(save_path)
+        if replay and os.path.exists(path) and self.fog_app.fog_mask is not None:
+            for entry in read_journal(path, self.fog_app.fog_mask.shape):
+                if entry['seq'] > journal_seq:
+                    apply_journal_entry(self.fog_app.fog_mask, entry)
+                    self.pending.append(entry)
+                    self.seq = entry['seq']
+
+        with self.journal_lock:
+            self.rewrite_journal()
+
+        if self.pending:
+            self.fog_app.mark_dirty()
+            update_status(self.fog_app,
+                          f"Recovered {len(self.pending)} unsaved fog changes")
+            self.schedule()
+
+    def detach(self, copy=True):
+        """Saves the attached fog one last time and closes its journal.
+
+        copy=False hands the live mask to the worker instead of a copy; only
+        do that if the mask is not edited again until the save is written
+        (anything edited later is still journaled and replayed on recovery).
+        """
+        if self.save_path is None:
+            return
+        if self.after_id is not None:
+            self.snapshot(copy)
+        with self.journal_lock:
+            if self.journal_file is not None:
+                self.journal_file.close()
+                self.journal_file = None
+            self.save_path = None
+
+    def record(self, op, rect=None, **fields):
+        """Appends one fog operation to the journal and reschedules a snapshot"""
+        if self.save_path is None or not self.fog_app.auto_save_enabled:
+            return
+
+        self.seq += 1
+        entry = {'seq': self.seq, 'op': op}
+        if rect is not None:
+            entry['rect'] = [int(v) for v in rect]
+        entry.update(fields)
+
+        with self.journal_lock:
+            self.pending.append(entry)
+            self.unwritten.append(entry)
+            self.write_journal()
+        self.schedule()
+
+    def record_mask(self):
+        """Journals the whole mask, e.g. after undoing a reset; the worker
+        packs a copy so a large mask is never compressed on the Tk thread"""
+        if self.save_path is None or not self.fog_app.auto_save_enabled:
+            return
+
+        self.seq += 1
+        entry = {'seq': self.seq, 'op': 'mask'}
+        with self.journal_lock:
+            self.encoding.add(entry['seq'])
+            self.pending.append(entry)
+            self.unwritten.append(entry)
+        self.jobs.put(('mask', entry, self.fog_app.fog_mask.copy()))
+        self.schedule()
+
+    def write_journal(self):
+        """Appends the unwritten entries up to one still being packed (lock held)"""
+        written = False
+        while self.unwritten and self.unwritten[0]['seq'] not in self.encoding:
+            entry = self.unwritten.popleft()
+            if self.journal_file is not None:
+                self.journal_file.write(json.dumps(entry) + "\n")
+                written = True
+        if written:
+            self.journal_file.flush()
+
+    def schedule(self):
+        """Debounces snapshots so bursts of edits produce a single save"""
+        if self.after_id is not None:
+            self.fog_app.root.after_cancel(self.after_id)
+        self.after_id = self.fog_app.root.after(self.delay_ms, self.snapshot)
+
+    def flush(self):
+        """Snapshots immediately instead of waiting for the quiet period"""
+        if self.save_path is not None:
+            self.snapshot()
+
+    def snapshot(self, copy=True):
+        """Copies the mask on the Tk thread and queues it for the worker"""
+        if self.after_id is not None:
+            self.fog_app.root.after_cancel(self.after_id)
+            self.after_id = None
+        if self.fog_app.fog_mask is None or self.save_path is None:
+            return
+
+        metadata = fog_metadata(self.fog_app)
+        fog_mask = self.fog_app.fog_mask
+        self.jobs.put(('save', self.save_path, fog_mask.copy() if copy else fog_mask, metadata))
+
+    def close(self, timeout=10):
+        """Writes the final snapshot and waits for the worker to finish"""
+        self.detach()
+        self.jobs.put(None)
+        self.worker.join(timeout)
+
+    def run_worker(self):
+        """Packs whole-mask entries and writes queued snapshots, skipping
+        snapshots already superseded"""
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+
+            jobs = [job]
+            stop = False
+            while not self.jobs.empty():
+                job = self.jobs.get_nowait()
+                if job is None:
+                    stop = True
+                    break
+                jobs.append(job)
+
+            # Only the newest snapshot per file matters
+            latest = {}
+            for job in jobs:
+                if job[0] == 'mask':
+                    self.encode_entry(*job[1:])
+                else:
+                    latest[job[1]] = job[1:]
+
+            for save_path, fog_mask, metadata in latest.values():
+                try:
+                    write_fog_file(save_path, fog_mask, metadata)
+                    index_fog_save(self.fog_app, save_path, metadata)
+                    self.trim_journal(save_path, metadata['journal_seq'])
+                except Exception as e:
+                    print(f"Error auto-saving fog state: {e}")
+
+            if stop:
+                return
+
+    def encode_entry(self, entry, fog_mask):
+        """Packs a whole-mask entry and writes it with the entries held behind it"""
+        try:
+            fields = encode_mask(fog_mask)
+        except Exception as e:
+            # Left out of the journal; the next snapshot still saves it
+            print(f"Error journaling fog state: {e}")
+            fields = None
+        with self.journal_lock:
+            if fields is None:
+                self.pending = [e for e in self.pending if e is not entry]
+                self.unwritten = deque(e for e in self.unwritten if e is not entry)
+            else:
+                entry.update(fields)
+            self.encoding.discard(entry['seq'])
+            self.write_journal()
+
+    def trim_journal(self, save_path, journal_seq):
+        """Drops journal entries that are now contained in the snapshot"""
+        with self.journal_lock:
+            if save_path != self.save_path:
+                return
+            self.pending = [e for e in self.pending if e['seq'] > journal_seq]
+            self.rewrite_journal()
+
+    def rewrite_journal(self):
+        """Atomically replaces the journal with the pending entries (lock held)"""
+        if self.journal_file is not None:
+            self.journal_file.close()
+
+        path = journal_path(self.save_path)
+        fog_mask = self.fog_app.fog_mask
+        header = {'journal': 1,
+                  'map_shape': list(fog_mask.shape) if fog_mask is not None else None}
+
+        temp_path = path + ".tmp"
+        self.unwritten = deque(self.pending)
+        with open(temp_path, 'w') as f:
+            f.write(json.dumps(header) + "\n")
+            while self.unwritten and self.unwritten[0]['seq'] not in self.encoding:
+                f.write(json.dumps(self.unwritten.popleft()) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+        self.journal_file = open(path, 'a')
+
+
+def journal_path(save_path):
+    """The journal file that belongs to a fog save"""
+    return save_path + ".journal"
+
+
+def read_journal(path, mask_shape):
+    """Returns the journal entries, or none if they belong to another mask size"""
+    entries = []
+    with open(path, 'r') as f:
+        lines = f.read().splitlines()
+    if not lines:
+        return entries
+
+    header = json.loads(lines[0])
+    if header.get('map_shape') != list(mask_shape):
+        return entries
+
+    for line in lines[1:]:
+        try:
+            entries.append(json.loads(line))
+        except json.JSONDecodeError:
+            # A crash can leave the last line half written
+            break
+    return entries
+
+
+def encode_patch(pixels):
+    """Packs a mask region into a short string for the journal"""
+    return base64.b64encode(zlib.compress(pixels.tobytes(), 1)).decode('ascii')
+
+
+def decode_patch(data, shape, dtype=np.uint8):
+    """Unpacks a string from encode_patch into a writable array"""
+    pixels = np.frombuffer(bytearray(zlib.decompress(base64.b64decode(data))), dtype=dtype)
+    return pixels.reshape(shape)
+
+
+def encode_mask(fog_mask):
+    """Packs a whole mask for the journal; a tiled mask keeps its uniform
+    tiles as their values and packs only the tiles that hold pixels"""
+    if isinstance(fog_mask, TiledFogMask):
+        return {'tile_size': fog_mask.tile_size,
+                'constants': encode_patch(fog_mask.constants),
+                'tiles': {f"{row},{col}": encode_patch(tile)
+                          for (row, col), tile in fog_mask.tiles.items()}}
+    return {'data': encode_patch(fog_mask[:, :])}
+
+
+def decode_mask(entry, shape):
+    """Unpacks the fields of encode_mask into a mask of shape"""
+    if 'constants' not in entry:
+        return decode_patch(entry['data'], shape)
+    mask = TiledFogMask(shape, 0, entry['tile_size'])
+    mask.constants = decode_patch(entry['constants'], mask.constants.shape, np.int16)
+    for key, data in entry['tiles'].items():
+        row, col = (int(v) for v in key.split(","))
+        mask.tiles[(row, col)] = decode_patch(data, mask.tile_shape(row, col))
+    return mask
+
+
+def apply_journal_entry(fog_mask, entry):
+    """Replays one journaled operation onto the mask in place"""
+    op = entry['op']
+    if op == 'reset':
+        fog_mask.fill(0)
+    elif op == 'clear':
+        fog_mask.fill(255)
+    elif op == 'reveal':
+        x1, y1, x2, y2 = entry['rect']
+        fog_mask[y1:y2, x1:x2] = 255
+    elif op == 'stroke':
+        points = entry['points']
+        for start, end in list(zip(points, points[1:])) or [(points[0], points[0])]:
+            bbox = brush_segment_bbox(start, end, entry['size'], fog_mask.shape)
+            if bbox is not None:
+                stamp_segment(fog_mask, start, end, entry['size'], bbox)
+    elif op == 'polygon':
+        bbox = polygon_bbox(entry['points'], fog_mask.shape)
+        if bbox is not None:
+            stamp_polygon(fog_mask, entry['points'], bbox)
+    elif op == 'patch':
+        x1, y1, x2, y2 = entry['rect']
+        fog_mask[y1:y2, x1:x2] = decode_patch(entry['data'], (y2 - y1, x2 - x1))
+    elif op == 'mask':
+        fog_mask[:, :] = decode_mask(entry, fog_mask.shape)
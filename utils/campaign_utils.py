@@ -0,0 +1,193 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.map_utils import MapSource
+from utils.tile_utils import new_fog_mask, fog_shape, saved_fog_shape
+from utils.save_utils import (get_fog_save_path, find_fog_save, read_fog_file, fog_metadata,
+                              update_status)
+
+# Memory the preloaded maps and fog of a campaign may hold (MB)
+CAMPAIGN_CACHE_MB = 1024
+# Maps decoded at the same time in the background
+PRELOAD_WORKERS = 2
+# How often a switch to a map that is still loading is retried (ms)
+SWITCH_RETRY_MS = 50
+
+
+class CampaignEntry:
+    """One map of a campaign with its fog, once it has been preloaded"""
+
+    def __init__(self, map_path):
+        self.map_path = map_path
+        self.lock = threading.Lock()
+        self.future = None
+        self.map_source = None
+        self.fog_mask = None
+        self.metadata = {}
+        self.journal_seq = 0
+        self.error = None
+
+    @property
+    def ready(self):
+        return self.map_source is not None
+
+    @property
+    def nbytes(self):
+        """Memory held for this entry: the fog plus the warmed pyramid levels"""
+        if not self.ready:
+            return 0
+        return (self.fog_mask.nbytes +
+                sum(level.nbytes for level in self.map_source.levels[1:]))
+
+
+class Campaign:
+    """The maps of a session, preloaded in the background into an LRU cache.
+
+    Worker threads decode each map into the map cache, read its fog file and
+    page in the smaller pyramid levels the views draw from, while the cache
+    stays under max_bytes. Switching to a preloaded map only swaps
+    references. The fog of the map being left stays in memory with its
+    edits; any unsaved ones are handed to the autosave worker without a
+    copy, so leaving a map never waits for the disk.
+    """
+
+    def __init__(self, fog_app, map_paths, max_bytes=CAMPAIGN_CACHE_MB * 1024 * 1024,
+                 workers=PRELOAD_WORKERS):
+        self.fog_app = fog_app
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict((path, CampaignEntry(path)) for path in map_paths)
+        self.lock = threading.Lock()
+        self.active = None
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="preload")
+
+    def cached_bytes(self):
+        with self.lock:
+            return sum(entry.nbytes for entry in self.entries.values())
+
+    def preload(self):
+        """Queues every map that is not loaded yet, in campaign order"""
+        for entry in self.entries.values():
+            if not entry.ready and entry.future is None:
+                entry.future = self.executor.submit(self.load_entry, entry, False)
+
+    def load_entry(self, entry, requested):
+        """Loads one map and its fog on a worker thread"""
+        with entry.lock:
+            if entry.ready:
+                return
+            if not requested and self.cached_bytes() >= self.max_bytes:
+                # The cache is full; load this map when it is asked for
+                entry.future = None
+                return
+            try:
+                map_source = MapSource.open(entry.map_path)
+                for level in map_source.levels[1:]:
+                    warm(level)
+
+                save_path = find_fog_save(self.fog_app, entry.map_path)
+                metadata, fog_mask = {}, None
+                if save_path is not None:
+                    metadata, fog_mask = read_fog_file(save_path)
+                if fog_mask is None or fog_mask.shape != saved_fog_shape(map_source.shape, metadata):
+                    fog_mask = new_fog_mask(fog_shape(map_source.shape, self.fog_app.fog_scale))
+
+                entry.map_source = map_source
+                entry.fog_mask = fog_mask
+                entry.metadata = metadata
+                entry.journal_seq = metadata.get('journal_seq', 0)
+                entry.error = None
+            except Exception as e:
+                entry.error = e
+                print(f"Error preloading {entry.map_path}: {e}")
+            finally:
+                entry.future = None
+        self.evict()
+
+    def evict(self):
+        """Drops least recently used maps until the cache fits in max_bytes"""
+        with self.lock:
+            total = sum(entry.nbytes for entry in self.entries.values())
+            for entry in self.entries.values():
+                if total <= self.max_bytes:
+                    break
+                if entry is self.active or not entry.ready:
+                    continue
+                # Skip a map that is being switched to right now
+                if not entry.lock.acquire(blocking=False):
+                    continue
+                total -= entry.nbytes
+                # Its fog was already handed to the autosave when it was left
+                entry.map_source = None
+                entry.fog_mask = None
+                entry.lock.release()
+
+    def switch_to(self, map_path, retry=False):
+        """Shows a campaign map, waiting on the Tk loop while it still loads"""
+        entry = self.entries[map_path]
+        if entry is self.active:
+            return
+        name = os.path.basename(map_path)
+        if entry.error is not None and entry.future is None:
+            update_status(self.fog_app, f"Failed to load {name}: {entry.error}")
+            # Clicking the map again tries again
+            entry.error = None
+            return
+
+        fog_app = self.fog_app
+        with entry.lock:
+            if entry.ready:
+                self.deactivate()
+                fog_app.map_source = entry.map_source
+                fog_app.map_image = entry.map_source.pixels
+                fog_app.current_map_path = entry.map_path
+                fog_app.fog_mask = entry.fog_mask
+                with self.lock:
+                    self.active = entry
+                    self.entries.move_to_end(map_path)
+
+        if self.active is not entry:
+            if entry.future is None:
+                entry.future = self.executor.submit(self.load_entry, entry, True)
+            if not retry:
+                update_status(fog_app, f"Loading {name}...")
+            fog_app.root.after(SWITCH_RETRY_MS, lambda: self.switch_to(map_path, True))
+            return
+
+        fog_app.history.clear()
+        fog_app.show_fog_scale()
+        fog_app.regions.open_map()
+        if 'reveal_radius' in entry.metadata:
+            fog_app.update_radius(entry.metadata['reveal_radius'])
+            fog_app.radius_slider.set(fog_app.reveal_radius)
+        fog_app.autosave.attach(get_fog_save_path(fog_app), entry.journal_seq)
+
+        if fog_app.dm_window is not None:
+            fog_app.dm_window.reset_view()
+        fog_app.mark_dirty()
+        update_status(fog_app, f"Switched to {name}")
+
+    def deactivate(self):
+        """Keeps the fog of the shown map in memory and saves it in the background"""
+        entry = self.active
+        self.active = None
+        fog_app = self.fog_app
+        if entry is None or fog_app.map_source is not entry.map_source:
+            return
+        # The fog may have been replaced, e.g. by loading a fog file
+        entry.fog_mask = fog_app.fog_mask
+        entry.metadata = fog_metadata(fog_app)
+        entry.journal_seq = fog_app.autosave.seq
+        # The mask isn't edited again until the map is shown again
+        fog_app.autosave.detach(copy=False)
+
+    def close(self):
+        """Stops preloading; the shown map's fog is saved by the app as usual"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def warm(pixels):
+    """Reads one byte per page of a memory-mapped array so it is resident"""
+    flat = pixels.reshape(-1)
+    flat[::4096].max()
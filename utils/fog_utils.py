@@ -1,44 +1,185 @@
-import time
 import numpy as np
 import cv2
 
+from utils.render_utils import union_rect
+from utils.tile_utils import GridFogMask
+
 def reset_fog(self):
         """Resets the fog of the map"""
-        if self.fog_mask is not None:
+        if self.editable:
             self.push_undo()
-            self.fog_mask = np.zeros_like(self.fog_mask)
-            self.update_queue.put("update_all")
+            self.fog_mask.fill(0)
+            self.autosave.record('reset')
+            self.mark_dirty()
 
 def clear_fog(self):
         """Clears all of the fog"""
-        if self.fog_mask is not None:
+        if self.editable:
             self.push_undo()
-            self.fog_mask = np.ones_like(self.fog_mask) * 255
-            self.update_queue.put("update_all")
+            self.fog_mask.fill(255)
+            self.autosave.record('clear')
+            self.mark_dirty()
 
-def reveal_area(self, x, y, force_update=False):
-        """Removes the fog where clicked"""
-        if self.fog_mask is not None:
-            self.push_undo()
-            mask = np.zeros_like(self.fog_mask)
-            half_size = self.reveal_radius // 2
-
-            x1 = max(0, int(x - half_size))
-            y1 = max(0, int(y - half_size))
-            x2 = min(self.fog_mask.shape[1], int(x + half_size))
-            y2 = min(self.fog_mask.shape[0], int(y + half_size))
-
-            cv2.rectangle(mask, (x1, y1), (x2, y2), 255, -1)
-
-            self.fog_mask = cv2.bitwise_or(self.fog_mask, mask)
-
-            if force_update:
-                self.update_queue.put("update_all")
-            else:
-                current_time = time.time()
-                if current_time - self.last_update_time >= self.update_interval:
-                    self.update_queue.put("update_all")
-                    self.last_update_time = current_time
-                elif current_time - self.last_update_time >= 0.01:
-                    self.update_queue.put("update_all")
-                    self.last_update_time = current_time
+def map_to_fog(self, points, size=None):
+        """Converts map points (and a brush size) into fog mask coordinates"""
+        if isinstance(self.fog_mask, GridFogMask):
+            points = [self.fog_mask.map_to_cell(x, y) for x, y in points]
+            if size is not None:
+                size = max(1, int(round(size / self.fog_mask.cell_size)))
+            return points, size
+        scale_x = self.fog_mask.shape[1] / self.map_source.shape[1]
+        scale_y = self.fog_mask.shape[0] / self.map_source.shape[0]
+        if scale_x == 1 and scale_y == 1:
+            return points, size
+        points = [(int(x * scale_x), int(y * scale_y)) for x, y in points]
+        if size is not None:
+            size = max(1, int(round(size * scale_x)))
+        return points, size
+
+def reveal_path(self, points):
+        """Removes the fog along a polyline of brush stamps (map coordinates)
+        and returns its bbox in the fog mask"""
+        if self.fog_mask is None:
+            return None
+
+        points, size = map_to_fog(self, points, self.reveal_radius)
+        bbox = None
+        segments = list(zip(points, points[1:])) or [(points[0], points[0])]
+        with self.perf.probe('mask_update'):
+            for start, end in segments:
+                segment_box = brush_segment_bbox(start, end, size, self.fog_mask.shape)
+                if segment_box is None:
+                    continue
+                self.push_undo(segment_box)
+                stamp_segment(self.fog_mask, start, end, size, segment_box)
+                bbox = union_rect(bbox, segment_box)
+
+        if bbox is None:
+            return None
+
+        self.autosave.record('stroke', points=[[int(x), int(y)] for x, y in points],
+                             size=size)
+        self.mark_dirty(bbox)
+        return bbox
+
+def reveal_polygon(self, points):
+        """Removes the fog inside a map polygon, e.g. what a token can see"""
+        if self.fog_mask is None:
+            return None
+
+        points, _ = map_to_fog(self, points)
+
+        with self.perf.probe('mask_update'):
+            bbox = polygon_bbox(points, self.fog_mask.shape)
+            if bbox is None:
+                return None
+            self.push_undo(bbox)
+            stamp_polygon(self.fog_mask, points, bbox)
+
+        self.autosave.record('polygon', points=[[int(x), int(y)] for x, y in points])
+        self.mark_dirty(bbox)
+        return bbox
+
+def polygon_bbox(points, mask_shape):
+        """Bounding box (x1, y1, x2, y2) of a polygon, clipped to the mask"""
+        points = np.asarray(points)
+        x1 = max(0, int(points[:, 0].min()))
+        y1 = max(0, int(points[:, 1].min()))
+        x2 = min(mask_shape[1], int(points[:, 0].max()) + 1)
+        y2 = min(mask_shape[0], int(points[:, 1].max()) + 1)
+
+        if x2 <= x1 or y2 <= y1:
+            return None
+        return (x1, y1, x2, y2)
+
+def stamp_polygon(fog_mask, points, bbox):
+        """Reveals the inside of a polygon, touching only the bbox region"""
+        x1, y1, x2, y2 = bbox
+        polygon = np.asarray(points, dtype=np.int32) - (x1, y1)
+        stamp = np.zeros((y2 - y1, x2 - x1), dtype=np.uint8)
+        cv2.fillPoly(stamp, [polygon], 255)
+        fog_mask[y1:y2, x1:x2] |= stamp
+
+def brush_segment_bbox(start, end, size, mask_shape):
+        """Bounding box (x1, y1, x2, y2) of a square brush swept from start to end"""
+        half_size = size // 2
+        x1 = max(0, int(min(start[0], end[0]) - half_size))
+        y1 = max(0, int(min(start[1], end[1]) - half_size))
+        # The brush covers x + half_size inclusively
+        x2 = min(mask_shape[1], int(max(start[0], end[0]) + half_size) + 1)
+        y2 = min(mask_shape[0], int(max(start[1], end[1]) + half_size) + 1)
+
+        if x2 <= x1 or y2 <= y1:
+            return None
+        return (x1, y1, x2, y2)
+
+def stamp_segment(fog_mask, start, end, size, bbox):
+        """Reveals the area a square brush covers moving from start to end.
+
+        The swept area is the convex hull of the brush at both ends, so fast
+        drags leave no gaps. Only the bbox region of the mask is touched.
+        """
+        half_size = size // 2
+        x1, y1, x2, y2 = bbox
+
+        corners = []
+        for x, y in (start, end):
+            x, y = int(x) - x1, int(y) - y1
+            corners += [(x - half_size, y - half_size), (x + half_size, y - half_size),
+                        (x + half_size, y + half_size), (x - half_size, y + half_size)]
+        hull = cv2.convexHull(np.array(corners, dtype=np.int32))
+
+        stamp = np.zeros((y2 - y1, x2 - x1), dtype=np.uint8)
+        cv2.fillConvexPoly(stamp, hull, 255)
+        fog_mask[y1:y2, x1:x2] |= stamp
+
+
+class StrokeEngine:
+    """Collects drag points and reveals them as one polyline per frame.
+
+    The pending points are revealed by the render scheduler right before it
+    draws, so every frame shows all motion received up to that point.
+    """
+
+    def __init__(self, fog_app):
+        self.fog_app = fog_app
+        self.points = []
+        self.last_point = None
+
+    def begin(self, x, y):
+        """Starts a stroke with a single stamp at the click position"""
+        self.end()
+        # Everything until the button is released undoes as one step
+        self.fog_app.history.begin_stroke()
+        self.last_point = (x, y)
+        reveal_path(self.fog_app, [(x, y)])
+
+    def add_point(self, x, y):
+        """Queues a drag position, revealing on the next frame"""
+        if self.last_point is None:
+            self.begin(x, y)
+            return
+
+        previous = self.points[-1] if self.points else self.last_point
+        if (x, y) == previous:
+            return
+        self.points.append((x, y))
+        self.fog_app.scheduler.before_frame(self.flush)
+
+    def flush(self):
+        """Reveals the path collected since the last frame"""
+        if not self.points:
+            return
+
+        path = [self.last_point] + self.points
+        self.last_point = self.points[-1]
+        self.points = []
+        reveal_path(self.fog_app, path)
+
+    def end(self):
+        """Reveals any remaining points and closes the undo step"""
+        if self.last_point is None:
+            return
+        self.flush()
+        self.last_point = None
+        self.fog_app.history.end_stroke()
@@ -0,0 +1,180 @@
+import os
+import json
+import threading
+from PIL import Image
+
+from utils.map_utils import user_cache_dir, file_content_hash
+
+# Map files whose hashes the index remembers; the least recently hashed go first
+INDEX_MAX_FILES = 4096
+INDEX_VERSION = 1
+
+
+def fog_index_path():
+    """Per-user file holding the fog index"""
+    return os.path.join(user_cache_dir(), "fog_index.json")
+
+
+class FogIndex:
+    """Finds the fog saves and cached data of a map by its content.
+
+    Maps are keyed by a hash of their bytes plus their pixel size, so a map
+    that was renamed or moved still finds the fog it was played with. The
+    hash of each file is remembered with its size and modification time
+    and only recomputed when those change, so keying a known map costs one
+    stat. Lookups are dictionary reads; nothing is found by scanning
+    directories. Entries of maps whose files were forgotten and whose saves
+    are gone are dropped. The index is a small JSON file, rewritten on each
+    change unless it was opened read_only.
+    """
+
+    def __init__(self, path=None, read_only=False):
+        self.path = path or fog_index_path()
+        self.read_only = read_only
+        self.lock = threading.Lock()
+        # Absolute map path -> [size, mtime_ns, content hash, width, height]
+        self.files = {}
+        # Map key -> {'paths': [...], 'saves': [...], 'regions': path}
+        self.maps = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == INDEX_VERSION:
+                self.files = data['files']
+                self.maps = data['maps']
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error reading fog index, starting a new one: {e}")
+
+    def save(self):
+        """Atomically rewrites the index file (call with the lock held)"""
+        if self.read_only:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': INDEX_VERSION, 'files': self.files,
+                           'maps': self.maps}, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f"Error writing fog index: {e}")
+
+    def map_key(self, map_path):
+        """Content key of a map file, hashing it only if it changed"""
+        path = os.path.abspath(map_path)
+        stat = os.stat(path)
+        with self.lock:
+            known = self.files.get(path)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return map_key(*known[2:])
+
+        content_hash = file_content_hash(path)
+        with Image.open(path) as image:
+            width, height = image.size
+        key = map_key(content_hash, width, height)
+        with self.lock:
+            # The file may hold another map than before
+            self.forget(path)
+            self.files[path] = [stat.st_size, stat.st_mtime_ns, content_hash, width, height]
+            while len(self.files) > INDEX_MAX_FILES:
+                self.forget(next(iter(self.files)))
+            add_first(self.entry(key)['paths'], path)
+            self.save()
+        return key
+
+    def content_hash(self, map_path):
+        """Hash of a map file's bytes, from the index when it is unchanged"""
+        return self.map_key(map_path).rsplit("-", 1)[0]
+
+    def entry(self, key):
+        return self.maps.setdefault(key, {'paths': [], 'saves': []})
+
+    def forget(self, path):
+        """Drops a map file from the index (call with the lock held)"""
+        known = self.files.pop(path, None)
+        if known is None:
+            return
+        key = map_key(*known[2:])
+        entry = self.maps.get(key)
+        if entry is not None and path in entry['paths']:
+            entry['paths'].remove(path)
+        self.drop_stale(key)
+
+    def drop_stale(self, key):
+        """Drops saves that no longer exist, and the whole entry once neither
+        a known file nor a save is left (call with the lock held)"""
+        entry = self.maps.get(key)
+        if entry is None:
+            return
+        entry['saves'] = [path for path in entry['saves'] if os.path.exists(path)]
+        if not entry['paths'] and not entry['saves']:
+            del self.maps[key]
+
+    def add_save(self, key, save_path):
+        """Records a fog save of the map with this key"""
+        with self.lock:
+            if add_first(self.entry(key)['saves'], os.path.abspath(save_path)):
+                self.save()
+
+    def find_save(self, key):
+        """The most recently written fog save of a map that still exists"""
+        with self.lock:
+            saves = list(self.maps.get(key, {}).get('saves', []))
+        found = next((path for path in saves if os.path.exists(path)), None)
+        if found is None and saves:
+            with self.lock:
+                self.drop_stale(key)
+                self.save()
+        return found
+
+    def find_map(self, key):
+        """A known path of the map with this key, if one still holds it.
+
+        A path whose file changed is hashed again, so call this off the Tk
+        thread.
+        """
+        with self.lock:
+            paths = list(self.maps.get(key, {}).get('paths', []))
+        for path in paths:
+            try:
+                if self.map_key(path) == key:
+                    return path
+            except OSError:
+                # Moved or deleted; forget it
+                with self.lock:
+                    self.forget(path)
+                    self.save()
+        return None
+
+    def set_derived(self, key, name, path):
+        """Records a file of data derived from the map, such as its room index"""
+        with self.lock:
+            entry = self.entry(key)
+            if entry.get(name) != path:
+                entry[name] = path
+                self.save()
+
+    def derived(self, key, name):
+        """A derived file recorded for the map, if it still exists"""
+        with self.lock:
+            path = self.maps.get(key, {}).get(name)
+        return path if path is not None and os.path.exists(path) else None
+
+
+def map_key(content_hash, width, height):
+    return f"{content_hash}-{width}x{height}"
+
+
+def add_first(paths, path):
+    """Moves path to the front of a most recent first list; False if it was there"""
+    if paths and paths[0] == path:
+        return False
+    if path in paths:
+        paths.remove(path)
+    paths.insert(0, path)
+    return True
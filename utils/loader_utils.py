@@ -0,0 +1,237 @@
+import os
+import queue
+import threading
+import zlib
+import struct
+from tkinter import messagebox
+from PIL import Image
+
+from utils.map_utils import MapSource, map_preview, save_thumbnail
+from utils.tile_utils import new_fog_mask, fog_shape, saved_fog_shape
+from utils.save_utils import (find_fog_save, read_fog_file, apply_fog_state,
+                              get_fog_save_path, locate_map, update_status)
+
+# How often the Tk thread checks on a loading map (ms)
+LOAD_POLL_MS = 30
+
+
+class MapLoad:
+    """One map being read on its own thread, posting messages for the Tk thread"""
+
+    def __init__(self, fog_app, map_path, fog=None, map_key=None):
+        self.fog_app = fog_app
+        self.map_path = map_path
+        # A fog save chosen by the DM, instead of looking the map's up
+        self.fog = fog
+        # Content key to find the map by when map_path no longer holds it
+        self.map_key = map_key
+        self.messages = queue.Queue()
+        self.cancelled = threading.Event()
+        self.previewed = False
+        self.thread = threading.Thread(target=self.run, name="map-load", daemon=True)
+
+    def run(self):
+        """Reads the fog, a preview and then the full map (loading thread)"""
+        try:
+            if self.map_key is not None:
+                map_path = self.fog_app.fog_index.find_map(self.map_key)
+                if map_path is None:
+                    self.messages.put(('missing',))
+                    return
+                self.map_path = map_path
+            with Image.open(self.map_path) as image:
+                width, height = image.size
+            shape = (height, width)
+            fog = self.fog if self.fog is not None else self.read_fog()
+            if self.cancelled.is_set():
+                return
+
+            # A cached decode maps instantly, so it needs no preview
+            if not MapSource.is_cached(self.map_path):
+                preview = map_preview(self.map_path)
+                if preview is not None and not self.cancelled.is_set():
+                    self.messages.put(('preview', MapSource.from_array(preview), shape, fog))
+            if self.cancelled.is_set():
+                return
+
+            # A load cancelled during the decode still finishes it into the
+            # map cache, which makes picking the map again later instant
+            map_source = MapSource.open(self.map_path, progress=self.decode_progress)
+            save_thumbnail(map_source)
+            self.messages.put(('done', map_source, fog))
+        except Exception as e:
+            print(f"Error loading {self.map_path}: {e}")
+            self.messages.put(('error', e))
+
+    def read_fog(self):
+        """(save path, metadata, fog mask) of the map's save; the mask is None
+        if the save can't be read, and the path too if there is none"""
+        save_path = find_fog_save(self.fog_app, self.map_path)
+        if save_path is None:
+            return None, {}, None
+        try:
+            metadata, fog_mask = read_fog_file(save_path)
+        except (ValueError, KeyError, zlib.error, struct.error):
+            return save_path, {}, None
+        return save_path, metadata, fog_mask
+
+    def decode_progress(self, fraction):
+        self.messages.put(('progress', fraction))
+
+
+class MapLoader:
+    """Loads maps in the background so the control panel and views stay live.
+
+    The loading thread reads the map's fog save, then, when the map isn't
+    in the map cache yet, a quick preview (a draft JPEG decode or the
+    thumbnail of an earlier decode) that is shown fogged while the full
+    decode runs, and swapped for the full map when it is ready. The map
+    shown before stays editable until the preview or the map replaces it;
+    a preview can't be edited, as its fog isn't journaled yet. Loading
+    another map, a campaign or a fog file cancels the load in progress.
+    """
+
+    def __init__(self, fog_app):
+        self.fog_app = fog_app
+        self.current = None
+
+    def load(self, map_path, fog=None, map_key=None):
+        """Starts loading a map, replacing any load in progress.
+
+        fog is (save path, metadata, fog mask) of a save read already, shown
+        instead of the map's own. With map_key, a map_path that is gone is
+        looked up in the fog index by content, and the DM asked for the map
+        if it isn't found.
+        """
+        self.cancel()
+        load = self.current = MapLoad(self.fog_app, map_path, fog, map_key)
+        load.thread.start()
+        self.show_progress(None)
+        self.fog_app.root.after(LOAD_POLL_MS, lambda: self.poll(load))
+
+    def cancel(self):
+        """Drops the load in progress; its thread stops at the next step"""
+        if self.current is not None:
+            self.current.cancelled.set()
+            self.current = None
+            self.fog_app.load_progress.stop()
+            self.fog_app.load_progress.pack_forget()
+
+    def show_progress(self, fraction):
+        """Shows how far the load is; None while that can't be measured"""
+        fog_app = self.fog_app
+        fog_app.status_label.configure(
+            text=f"Loading {os.path.basename(self.current.map_path)}...")
+        if not fog_app.load_progress.winfo_ismapped():
+            fog_app.load_progress.pack(pady=(5, 0))
+        if fraction is None:
+            # Reading and decoding the image report nothing until they are done
+            fog_app.load_progress.configure(mode="indeterminate")
+            fog_app.load_progress.start()
+        else:
+            fog_app.load_progress.stop()
+            fog_app.load_progress.configure(mode="determinate")
+            fog_app.load_progress.set(fraction)
+
+    def poll(self, load):
+        """Takes the messages of a load on the Tk thread"""
+        if load is not self.current:
+            return
+        try:
+            while True:
+                message = load.messages.get_nowait()
+                if message[0] == 'progress':
+                    self.show_progress(message[1])
+                elif message[0] == 'preview':
+                    self.show_preview(load, *message[1:])
+                elif message[0] == 'done':
+                    self.cancel()
+                    self.finish(load, *message[1:])
+                    return
+                elif message[0] == 'error':
+                    self.cancel()
+                    self.fail(load, message[1])
+                    return
+                elif message[0] == 'missing':
+                    self.cancel()
+                    self.locate(load)
+                    return
+        except queue.Empty:
+            pass
+        self.fog_app.root.after(LOAD_POLL_MS, lambda: self.poll(load))
+
+    def swap(self, map_source, map_path, fog_mask):
+        """Replaces the shown map, saving the fog of the one being left"""
+        fog_app = self.fog_app
+        if fog_app.campaign is not None:
+            fog_app.campaign.deactivate()
+        fog_app.stroke.end()
+        fog_app.autosave.detach()
+
+        fog_app.map_source = map_source
+        fog_app.map_image = map_source.pixels
+        fog_app.current_map_path = map_path
+        fog_app.fog_mask = fog_mask
+        fog_app.history.clear()
+        fog_app.regions.open_map()
+        if fog_app.dm_window is not None:
+            fog_app.dm_window.reset_view()
+        fog_app.mark_dirty()
+
+    def show_preview(self, load, map_source, shape, fog):
+        """Shows the preview with the saved fog, until the full map arrives"""
+        _, metadata, fog_mask = fog
+        # The renderer resamples the fog from its own size, so the saved fog
+        # covers the smaller preview as it is
+        if fog_mask is None or fog_mask.shape != saved_fog_shape(shape, metadata):
+            fog_mask = new_fog_mask(map_source.shape[:2])
+        load.previewed = True
+        self.swap(map_source, None, fog_mask)
+
+    def finish(self, load, map_source, fog):
+        """Shows the loaded map with its saved fog and starts journaling it"""
+        fog_app = self.fog_app
+        save_path, metadata, fog_mask = fog
+        if fog_mask is not None and fog_mask.shape == saved_fog_shape(map_source.shape, metadata):
+            self.swap(map_source, load.map_path, fog_mask)
+        else:
+            self.swap(map_source, load.map_path,
+                      new_fog_mask(fog_shape(map_source.shape, fog_app.fog_scale)))
+
+        status = "Map loaded successfully"
+        if save_path is not None:
+            if fog_mask is None:
+                messagebox.showerror("Error", "Invalid fog save file!")
+            elif load.fog is not None:
+                if apply_fog_state(fog_app, save_path, metadata, fog_mask):
+                    messagebox.showinfo("Success", "Fog state loaded successfully!")
+                    status = "Fog state loaded successfully"
+            elif apply_fog_state(fog_app, save_path, metadata, fog_mask):
+                status = f"Auto-loaded fog state: {os.path.basename(save_path)}"
+                if os.path.abspath(save_path) != os.path.abspath(get_fog_save_path(fog_app)):
+                    # Found under an old name or folder; the map gets its own save
+                    fog_app.autosave.flush()
+        if fog_app.autosave.save_path is None:
+            # No save yet, but a journal may survive from a crash
+            fog_app.autosave.attach(get_fog_save_path(fog_app))
+        update_status(fog_app, status)
+
+    def locate(self, load):
+        """Asks for a map the fog index couldn't find, then loads it"""
+        map_path = locate_map(load.map_path)
+        if map_path is None:
+            update_status(self.fog_app, "Fog state not loaded")
+            return
+        self.load(map_path, load.fog)
+
+    def fail(self, load, error):
+        """Reports a map that couldn't be loaded, dropping its preview"""
+        fog_app = self.fog_app
+        if load.previewed:
+            fog_app.map_source = None
+            fog_app.map_image = None
+            fog_app.fog_mask = None
+            fog_app.regions.open_map()
+            fog_app.mark_dirty()
+        messagebox.showerror("Error", f"Failed to load image: {str(error)}")
+        update_status(fog_app, "Failed to load map")
@@ -0,0 +1,249 @@
+import os
+import glob
+import hashlib
+import tempfile
+import numpy as np
+import cv2
+from PIL import Image
+
+# Battle maps are trusted local files and can legitimately be enormous
+Image.MAX_IMAGE_PIXELS = None
+
+# Decoded maps kept on disk for memory mapping (8 GB)
+MAP_CACHE_MAX_BYTES = 8 * 1024 * 1024 * 1024
+# Pyramid levels are halved until the longest side is at most this
+MIN_LEVEL_SIZE = 1024
+# Bytes read at a time when hashing a map file
+HASH_CHUNK_SIZE = 1024 * 1024
+# Longest side asked of a quick preview decode
+PREVIEW_SIZE = 1024
+# JPEG quality of the preview thumbnails kept for non-JPEG maps
+THUMBNAIL_QUALITY = 85
+
+
+def user_cache_dir():
+    """Per-user cache directory of the app"""
+    base = (os.environ.get('XDG_CACHE_HOME') or os.environ.get('LOCALAPPDATA')
+            or os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "fog-of-war-inator")
+
+
+def map_cache_dir():
+    """Per-user directory holding decoded map caches"""
+    return os.path.join(user_cache_dir(), "maps")
+
+
+def thumbnail_dir():
+    """Per-user directory holding preview thumbnails of decoded maps"""
+    return os.path.join(user_cache_dir(), "thumbs")
+
+
+def map_cache_key(map_path):
+    """Cache key for a map file; changes whenever the file is modified"""
+    stat = os.stat(map_path)
+    identity = f"{os.path.abspath(map_path)}|{stat.st_mtime_ns}|{stat.st_size}"
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()[:20]
+
+
+def file_content_hash(map_path):
+    """Hash of a map file's bytes; unlike map_cache_key it survives renames"""
+    digest = hashlib.sha1()
+    with open(map_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:20]
+
+
+class MapSource:
+    """A decoded map held as memory-mapped raw RGB plus a downscaled pyramid.
+
+    The first open decodes the image once into <cache>/<key>.npy and writes
+    half-size levels next to it. Later opens of the same unchanged file just
+    map those files, so nothing is decoded and only the pages a renderer
+    touches are read from disk.
+    """
+
+    def __init__(self, path, levels):
+        self.path = path
+        # levels[0] is full resolution, each next level is half the size
+        self.levels = levels
+        self.pixels = levels[0]
+        self.shape = self.pixels.shape
+
+    @classmethod
+    def open(cls, map_path, cache_dir=None, progress=None):
+        """Maps the cached decode of map_path, decoding it first if needed.
+
+        progress, if given, is called with the written fraction of a new
+        cache after each of its files; the decode itself reports nothing.
+        """
+        cache_dir = cache_dir or map_cache_dir()
+        base = os.path.join(cache_dir, map_cache_key(map_path))
+
+        if not os.path.exists(base + ".npy"):
+            os.makedirs(cache_dir, exist_ok=True)
+            decode_to_cache(map_path, base, progress)
+            prune_map_cache(cache_dir, keep=base)
+        else:
+            # Marks the cache as recently used for pruning
+            os.utime(base + ".npy")
+
+        levels = [np.load(base + ".npy", mmap_mode='r')]
+        while os.path.exists(f"{base}.{len(levels)}.npy"):
+            levels.append(np.load(f"{base}.{len(levels)}.npy", mmap_mode='r'))
+        return cls(map_path, levels)
+
+    @staticmethod
+    def is_cached(map_path, cache_dir=None):
+        """Whether opening map_path maps a cached decode instead of decoding"""
+        cache_dir = cache_dir or map_cache_dir()
+        return os.path.exists(os.path.join(cache_dir, map_cache_key(map_path) + ".npy"))
+
+    @classmethod
+    def from_array(cls, pixels, path=None):
+        """Wraps an in-memory RGB array, building its pyramid in memory"""
+        levels = [pixels]
+        while max(levels[-1].shape[:2]) > MIN_LEVEL_SIZE:
+            levels.append(half_size(levels[-1]))
+        return cls(path, levels)
+
+    def level_for(self, display_size):
+        """Returns (pixels, factor) of the smallest level at least display_size.
+
+        factor is how many full-resolution pixels one level pixel covers.
+        """
+        display_width, display_height = display_size
+        index = 0
+        for i, level in enumerate(self.levels):
+            if level.shape[1] >= display_width and level.shape[0] >= display_height:
+                index = i
+        return self.levels[index], 2 ** index
+
+    def region(self, x1, y1, x2, y2):
+        """Full-resolution pixels of a map rectangle"""
+        return self.pixels[y1:y2, x1:x2]
+
+    def resized(self, display_size, resample=Image.LANCZOS):
+        """The whole map resampled to display_size from the nearest level"""
+        pixels, _ = self.level_for(display_size)
+        return np.array(Image.fromarray(np.asarray(pixels)).resize(display_size, resample))
+
+
+def decode_to_cache(map_path, base, progress=None):
+    """Decodes an image into <base>.npy and writes its half-size levels"""
+    pixels = np.asarray(Image.open(map_path).convert('RGB'))
+
+    # Files to write: one per half-size level, then level 0
+    count = 1
+    while max(pixels.shape[:2]) >> (count - 1) > MIN_LEVEL_SIZE:
+        count += 1
+
+    # Write under temporary names and rename level 0 last, so a partly
+    # written cache is never picked up
+    level = pixels
+    index = 1
+    while max(level.shape[:2]) > MIN_LEVEL_SIZE:
+        level = half_size(level)
+        write_npy(f"{base}.{index}.npy", level)
+        if progress is not None:
+            progress(index / count)
+        index += 1
+    write_npy(base + ".npy", pixels)
+    if progress is not None:
+        progress(1.0)
+
+
+def thumbnail_path(map_path):
+    """Where the preview thumbnail of a map file is kept"""
+    return os.path.join(thumbnail_dir(), map_cache_key(map_path) + ".jpg")
+
+
+def map_preview(map_path, max_size=PREVIEW_SIZE):
+    """Quick low resolution pixels of a map, or None if there is no cheap way.
+
+    JPEGs are decoded in draft mode, straight at a fraction of their size;
+    other formats use the thumbnail written the last time they were decoded.
+    """
+    path = thumbnail_path(map_path)
+    if not os.path.exists(path):
+        path = map_path
+    with Image.open(path) as image:
+        if image.format != 'JPEG':
+            return None
+        image.draft('RGB', (max_size, max_size))
+        return np.asarray(image.convert('RGB'))
+
+
+def save_thumbnail(map_source):
+    """Keeps the smallest level of a decoded non-JPEG map as its preview"""
+    path = thumbnail_path(map_source.path)
+    if os.path.exists(path):
+        return
+    with Image.open(map_source.path) as image:
+        if image.format == 'JPEG':
+            return
+    os.makedirs(thumbnail_dir(), exist_ok=True)
+    temp_path = path + ".tmp"
+    Image.fromarray(np.asarray(map_source.levels[-1])).save(
+        temp_path, format='JPEG', quality=THUMBNAIL_QUALITY)
+    os.replace(temp_path, path)
+
+
+def half_size(pixels):
+    """Area-averages an image down to half its width and height"""
+    height, width = pixels.shape[:2]
+    return cv2.resize(pixels, (max(1, width // 2), max(1, height // 2)),
+                      interpolation=cv2.INTER_AREA)
+
+
+def write_npy(path, pixels):
+    """Atomically writes an array as a memory-mappable .npy file"""
+    # A unique temp name, as two opens of one map can decode it at once
+    fd, temp_path = tempfile.mkstemp(
+        prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, np.ascontiguousarray(pixels))
+    try:
+        os.replace(temp_path, path)
+    except OSError:
+        os.remove(temp_path)
+        # The other open wrote the same pixels first and may have them
+        # mapped already, which Windows won't let a rename replace
+        if not os.path.exists(path):
+            raise
+
+
+def prune_map_cache(cache_dir, keep=None, max_bytes=MAP_CACHE_MAX_BYTES):
+    """Deletes the least recently used map caches beyond max_bytes.
+
+    Caches that are in use are skipped: Windows can't delete a file that a
+    campaign map or the player process still has memory-mapped.
+    """
+    groups = {}
+    for path in glob.glob(os.path.join(cache_dir, "*.npy")):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        key = os.path.basename(path).split(".")[0]
+        groups.setdefault(key, []).append((path, stat.st_size, stat.st_mtime))
+
+    def last_used(files):
+        return max(mtime for _, _, mtime in files)
+
+    total = sum(size for files in groups.values() for _, size, _ in files)
+    for key, files in sorted(groups.items(), key=lambda item: last_used(item[1])):
+        if total <= max_bytes:
+            break
+        if keep is not None and os.path.basename(keep) == key:
+            continue
+        # Level 0 goes first; once it is gone the cache is never opened, so
+        # a level that can't be deleted yet leaves no half cache behind
+        files.sort(key=lambda f: os.path.basename(f[0]).count("."))
+        for path, size, _ in files:
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"Keeping map cache {os.path.basename(path)} in use: {e}")
+                break
+            total -= size
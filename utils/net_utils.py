@@ -0,0 +1,254 @@
+import io
+import json
+import socket
+import struct
+import threading
+import zlib
+import numpy as np
+from PIL import Image
+
+from utils.render_utils import map_rect_to_display, resize_mask_to_display, union_rect
+
+# Default TCP port of the network player view
+PLAYER_PORT = 8765
+# Longest side of the map as streamed to viewers
+STREAM_MAX_SIZE = 2048
+# JPEG quality of the one-time base map image
+STREAM_MAP_QUALITY = 90
+
+# Every message is a 4 byte kind, the JSON header length, the payload length,
+# the JSON header and the payload
+MESSAGE = struct.Struct('<4sII')
+# Base map: header {'size': [w, h]}, payload a JPEG
+MSG_MAP = b'MAP '
+# Fog region: header {'rect': [x1, y1, x2, y2]}, payload zlib'd uint8 rows
+MSG_FOG = b'FOG '
+
+
+def send_message(sock, kind, header, payload=b''):
+    """Sends one framed message"""
+    head = json.dumps(header).encode('utf-8')
+    sock.sendall(MESSAGE.pack(kind, len(head), len(payload)) + head + payload)
+
+
+def recv_exact(sock, size):
+    """Reads exactly size bytes, or returns None if the peer closed"""
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1 << 20))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def recv_message(sock):
+    """Reads one framed message as (kind, header, payload), None on EOF"""
+    prefix = recv_exact(sock, MESSAGE.size)
+    if prefix is None:
+        return None
+    kind, head_length, payload_length = MESSAGE.unpack(prefix)
+    head = recv_exact(sock, head_length)
+    payload = recv_exact(sock, payload_length)
+    if head is None or payload is None:
+        return None
+    return kind, json.loads(head.decode('utf-8')), payload
+
+
+def stream_size(image_size, max_size=STREAM_MAX_SIZE):
+    """Size a map is streamed at: its own size, or shrunk to fit max_size"""
+    scale = min(1.0, max_size / max(image_size))
+    return (max(1, int(image_size[0] * scale)), max(1, int(image_size[1] * scale)))
+
+
+def encode_map(pixels):
+    """JPEG bytes of the streamed base map"""
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='JPEG', quality=STREAM_MAP_QUALITY)
+    return buffer.getvalue()
+
+
+def decode_map(payload):
+    """RGB pixels of a streamed base map"""
+    return np.asarray(Image.open(io.BytesIO(payload)).convert('RGB'))
+
+
+def decode_fog_region(header, payload):
+    """Returns (rect, pixels) of a fog region message"""
+    x1, y1, x2, y2 = header['rect']
+    pixels = np.frombuffer(zlib.decompress(payload), dtype=np.uint8)
+    return (x1, y1, x2, y2), pixels.reshape(y2 - y1, x2 - x1)
+
+
+class ViewerConnection:
+    """One connected viewer and the stream rectangle it still has to receive"""
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.needs_map = True
+        self.pending = None
+
+
+class PlayerServer:
+    """Streams the player view to network viewers (see viewer.py).
+
+    A viewer first receives the map once as a JPEG at stream resolution,
+    then the fog at the same resolution. After that only the fog rectangles
+    the DM changed are sent, zlib-compressed, so traffic follows the area
+    revealed rather than the map size. Each viewer keeps one pending
+    rectangle that new changes are merged into, so a slow viewer gets fewer,
+    larger updates instead of a growing backlog.
+
+    mark_dirty() and flush() run on the Tk thread; flush() is registered as
+    a render scheduler view. Sockets are served by background threads that
+    only read the stream-resolution copies kept here.
+    """
+
+    def __init__(self, fog_app, host='', port=PLAYER_PORT, max_size=STREAM_MAX_SIZE):
+        self.fog_app = fog_app
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.listener = None
+        self.running = False
+        self.clients = []
+        self.condition = threading.Condition()
+
+        # Tk thread state
+        self.map_source = None
+        self.fog_mask = None
+        self.dirty = None
+        # Shared with the sender threads, guarded by condition
+        self.size = None
+        self.map_payload = None
+        self.fog_pixels = None
+
+    def start(self):
+        """Starts listening; returns the bound (host, port)"""
+        self.listener = socket.create_server((self.host, self.port))
+        self.port = self.listener.getsockname()[1]
+        self.running = True
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+        return (self.host, self.port)
+
+    def stop(self):
+        """Disconnects every viewer and stops listening"""
+        with self.condition:
+            self.running = False
+            clients, self.clients = self.clients, []
+            self.condition.notify_all()
+        for client in clients:
+            self.close_client(client)
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+
+    def mark_dirty(self, rect=None):
+        """Queues a changed map area (None is everything) for the next flush"""
+        if rect is None:
+            self.fog_mask = None
+        else:
+            self.dirty = union_rect(self.dirty, rect)
+
+    def flush(self):
+        """Brings the streamed fog up to date and wakes the senders"""
+        fog_app = self.fog_app
+        if fog_app.map_source is None or fog_app.fog_mask is None:
+            return
+
+        image_size = (fog_app.map_source.shape[1], fog_app.map_source.shape[0])
+        new_map = None
+        if fog_app.map_source is not self.map_source:
+            self.map_source = fog_app.map_source
+            size = stream_size(image_size, self.max_size)
+            new_map = (size, encode_map(self.map_source.resized(size)))
+            self.fog_mask = None
+
+        if fog_app.fog_mask is not self.fog_mask:
+            # New map, loaded fog or a full redraw: resend all of it
+            size = new_map[0] if new_map is not None else self.size
+            fog_pixels = resize_mask_to_display(fog_app.fog_mask, size)
+            self.fog_mask = fog_app.fog_mask
+            self.dirty = None
+            with self.condition:
+                if new_map is not None:
+                    self.size, self.map_payload = new_map
+                    for client in self.clients:
+                        client.needs_map = True
+                self.fog_pixels = fog_pixels
+                for client in self.clients:
+                    client.pending = (0, 0) + self.size
+                self.condition.notify_all()
+            return
+
+        if self.dirty is None:
+            return
+        rect = map_rect_to_display(self.dirty, image_size, self.size)
+        self.dirty = None
+        if rect is None:
+            return
+
+        x1, y1, x2, y2 = rect
+        region = resize_mask_to_display(self.fog_mask, self.size, display_rect=rect)
+        with self.condition:
+            self.fog_pixels[y1:y2, x1:x2] = region
+            for client in self.clients:
+                client.pending = union_rect(client.pending, rect)
+            self.condition.notify_all()
+
+    def accept_loop(self):
+        """Accepts viewers until the server stops"""
+        while self.running:
+            try:
+                sock, address = self.listener.accept()
+            except OSError:
+                break
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = ViewerConnection(sock, address)
+            with self.condition:
+                if self.size is not None:
+                    client.pending = (0, 0) + self.size
+                self.clients.append(client)
+            threading.Thread(target=self.send_loop, args=(client,), daemon=True).start()
+            print(f"Player viewer connected from {address[0]}")
+
+    def send_loop(self, client):
+        """Sends the base map and then fog changes to one viewer"""
+        try:
+            while True:
+                with self.condition:
+                    self.condition.wait_for(
+                        lambda: not self.running or client not in self.clients or
+                        (self.map_payload is not None and
+                         (client.needs_map or client.pending is not None)))
+                    if not self.running or client not in self.clients:
+                        return
+                    map_payload = self.map_payload if client.needs_map else None
+                    size = self.size
+                    rect = client.pending
+                    client.needs_map = False
+                    client.pending = None
+                    region = None
+                    if rect is not None:
+                        x1, y1, x2, y2 = rect
+                        region = self.fog_pixels[y1:y2, x1:x2].copy()
+
+                if map_payload is not None:
+                    send_message(client.sock, MSG_MAP, {'size': list(size)}, map_payload)
+                if region is not None:
+                    payload = zlib.compress(region.tobytes(), 6)
+                    send_message(client.sock, MSG_FOG, {'rect': list(rect)}, payload)
+        except OSError as e:
+            print(f"Player viewer {client.address[0]} disconnected: {e}")
+        finally:
+            with self.condition:
+                if client in self.clients:
+                    self.clients.remove(client)
+            self.close_client(client)
+
+    def close_client(self, client):
+        try:
+            client.sock.close()
+        except OSError:
+            pass
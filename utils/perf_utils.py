@@ -0,0 +1,147 @@
+import os
+import csv
+import json
+import time
+import threading
+from collections import deque
+from contextlib import nullcontext
+from datetime import datetime
+import numpy as np
+
+from utils.map_utils import user_cache_dir
+
+# Samples kept per stage for the rolling percentiles
+ROLLING_SAMPLES = 600
+# Upper edges of the session histogram buckets in milliseconds
+BUCKET_EDGES_MS = (0.25, 0.5, 1, 2, 4, 8, 16, 33, 66, 133, 266, 533)
+
+# Shared no-op context handed out while the monitor is disabled
+NULL_PROBE = nullcontext()
+
+
+def perf_export_dir():
+    """Per-user directory holding exported timing sessions"""
+    return os.path.join(user_cache_dir(), "perf")
+
+
+class StageStats:
+    """Timings of one stage: a rolling window plus session-wide buckets"""
+
+    def __init__(self, window=ROLLING_SAMPLES):
+        self.recent = deque(maxlen=window)
+        self.buckets = np.zeros(len(BUCKET_EDGES_MS) + 1, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.recent.append(ms)
+        self.buckets[np.searchsorted(BUCKET_EDGES_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.worst = max(self.worst, ms)
+
+    def summary(self):
+        """Rolling p50/p95/p99 and session count, mean and max in milliseconds"""
+        recent = np.fromiter(self.recent, dtype=np.float64, count=len(self.recent))
+        p50, p95, p99 = np.percentile(recent, (50, 95, 99)) if recent.size else (0, 0, 0)
+        return {'count': self.count, 'mean': self.total / max(1, self.count),
+                'p50': float(p50), 'p95': float(p95), 'p99': float(p99),
+                'max': self.worst}
+
+
+class Probe:
+    """Context manager timing one pass through a stage"""
+
+    __slots__ = ('monitor', 'name', 'start')
+
+    def __init__(self, monitor, name):
+        self.monitor = monitor
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.monitor.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class PerfMonitor:
+    """Collects per-stage timings from `with monitor.probe('stage'):` blocks.
+
+    While disabled probe() returns a shared no-op context, so instrumented
+    code pays one attribute check per stage. Set FOG_PERF=1 to collect from
+    startup, or toggle collection with the DM window overlay (F3).
+    """
+
+    def __init__(self, enabled=None):
+        if enabled is None:
+            enabled = os.environ.get('FOG_PERF', '') not in ('', '0')
+        self.enabled = enabled
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.started = datetime.now()
+
+    def probe(self, name):
+        """Times the with-block as one sample of `name` when enabled"""
+        if not self.enabled:
+            return NULL_PROBE
+        return Probe(self, name)
+
+    def record(self, name, seconds):
+        """Adds one externally measured sample"""
+        if not self.enabled:
+            return
+        with self.lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = StageStats()
+            stats.add(seconds)
+
+    def summary(self):
+        """Returns {stage: summary} for every stage seen so far"""
+        with self.lock:
+            return {name: stats.summary() for name, stats in sorted(self.stages.items())}
+
+    def overlay_text(self):
+        """A few lines of rolling timings for the on-screen overlay"""
+        lines = [f"{'stage':<14}{'p50':>8}{'p95':>8}{'max':>8}  ms"]
+        for name, stats in self.summary().items():
+            lines.append(f"{name:<14}{stats['p50']:8.2f}{stats['p95']:8.2f}"
+                         f"{stats['max']:8.1f}")
+        return "\n".join(lines)
+
+    def export(self, directory=None):
+        """Writes the session as CSV and JSON and returns the JSON path.
+
+        Nothing is written if no samples were collected.
+        """
+        if not self.stages:
+            return None
+        directory = directory or perf_export_dir()
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, "session-" + self.started.strftime("%Y%m%d-%H%M%S"))
+
+        summary = self.summary()
+        with self.lock:
+            buckets = {name: stats.buckets.tolist() for name, stats in self.stages.items()}
+
+        with open(base + ".json", 'w') as f:
+            json.dump({'started': self.started.isoformat(),
+                       'ended': datetime.now().isoformat(),
+                       'bucket_edges_ms': list(BUCKET_EDGES_MS),
+                       'stages': {name: dict(stats, buckets=buckets[name])
+                                  for name, stats in summary.items()}}, f, indent=2)
+
+        with open(base + ".csv", 'w', newline='') as f:
+            writer = csv.writer(f)
+            edges = [f"<={edge}ms" for edge in BUCKET_EDGES_MS] + [f">{BUCKET_EDGES_MS[-1]}ms"]
+            writer.writerow(['stage', 'count', 'mean', 'p50', 'p95', 'p99', 'max'] + edges)
+            for name, stats in summary.items():
+                writer.writerow([name, stats['count']] +
+                                [f"{stats[k]:.3f}" for k in ('mean', 'p50', 'p95', 'p99', 'max')] +
+                                buckets[name])
+        return base + ".json"
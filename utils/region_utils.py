@@ -0,0 +1,317 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+from PIL import Image
+
+from utils.autosave_utils import encode_patch
+from utils.save_utils import update_status
+from utils.tile_utils import GridFogMask
+
+# Longest side of the map level rooms are detected on
+REGION_ANALYSIS_SIZE = 2048
+# Widest doorway (analysis pixels) that still separates two rooms
+DOOR_GAP = 9
+# Regions smaller than this fraction of the map are texture noise, not rooms
+MIN_REGION_FRACTION = 0.0005
+# Analysis pixels a revealed room grows by, so its walls show too
+WALL_MARGIN = 3
+# How often the Tk side checks on a running analysis (ms)
+REGION_POLL_MS = 200
+
+
+class RegionMap:
+    """The rooms of a map as a label image plus one bounding box per room.
+
+    labels is stored at analysis resolution (label 0 is walls and noise);
+    boxes[i] is the (x1, y1, x2, y2) of label i in the same coordinates.
+    Lookups and reveals scale to the full map on the fly, so a room is one
+    bbox-sized mask operation however many pixels it covers. imported marks
+    an index read from a label image, whose label 0 is drawn walls.
+    """
+
+    def __init__(self, labels, boxes, map_shape, imported=False):
+        self.labels = labels
+        self.boxes = boxes
+        self.imported = imported
+        self.map_shape = tuple(map_shape[:2])
+        self.scale_x = self.map_shape[1] / labels.shape[1]
+        self.scale_y = self.map_shape[0] / labels.shape[0]
+
+    @property
+    def count(self):
+        return len(self.boxes) - 1
+
+    def region_at(self, x, y):
+        """Label of the room under a map point, 0 if there is none"""
+        lx = int(x / self.scale_x)
+        ly = int(y / self.scale_y)
+        if not (0 <= lx < self.labels.shape[1] and 0 <= ly < self.labels.shape[0]):
+            return 0
+        return int(self.labels[ly, lx])
+
+    def region_mask(self, label, shape=None):
+        """Returns (rect, uint8 mask of that rect) covering one room, in a
+        mask of the given shape (the map itself by default)"""
+        height, width = self.labels.shape
+        x1, y1, x2, y2 = (int(v) for v in self.boxes[label])
+        x1, y1 = max(0, x1 - WALL_MARGIN), max(0, y1 - WALL_MARGIN)
+        x2, y2 = min(width, x2 + WALL_MARGIN), min(height, y2 + WALL_MARGIN)
+
+        region = (self.labels[y1:y2, x1:x2] == label).astype(np.uint8) * 255
+        kernel = np.ones((2 * WALL_MARGIN + 1, 2 * WALL_MARGIN + 1), dtype=np.uint8)
+        region = cv2.dilate(region, kernel)
+
+        map_height, map_width = shape or self.map_shape
+        scale_x, scale_y = map_width / width, map_height / height
+        rect = (int(x1 * scale_x), int(y1 * scale_y),
+                min(map_width, int(round(x2 * scale_x))),
+                min(map_height, int(round(y2 * scale_y))))
+        size = (rect[2] - rect[0], rect[3] - rect[1])
+        # Bilinear then threshold gives smooth edges instead of blocky ones
+        region = cv2.resize(region, size, interpolation=cv2.INTER_LINEAR)
+        return rect, np.where(region > 127, 255, 0).astype(np.uint8)
+
+    def save(self, path):
+        """Writes the index atomically as a compressed .npz"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + ".tmp"
+        with open(temp_path, 'wb') as f:
+            np.savez_compressed(f, labels=self.labels, boxes=self.boxes,
+                                map_shape=np.array(self.map_shape),
+                                imported=np.array(self.imported))
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['labels'], data['boxes'],
+                       tuple(int(v) for v in data['map_shape']),
+                       'imported' in data.files and bool(data['imported']))
+
+
+def analysis_level(map_source, max_size=REGION_ANALYSIS_SIZE):
+    """The largest pyramid level whose longest side fits max_size"""
+    for level in map_source.levels:
+        if max(level.shape[:2]) <= max_size:
+            return np.asarray(level)
+    level = np.asarray(map_source.levels[-1])
+    scale = max_size / max(level.shape[:2])
+    size = (max(1, int(level.shape[1] * scale)), max(1, int(level.shape[0] * scale)))
+    return cv2.resize(level, size, interpolation=cv2.INTER_AREA)
+
+
+def detect_walls(pixels):
+    """uint8 mask (255 = wall) of the dark lines and strong edges of a map"""
+    gray = cv2.cvtColor(np.ascontiguousarray(pixels), cv2.COLOR_RGB2GRAY)
+    gray = cv2.GaussianBlur(gray, (5, 5), 0)
+    threshold, _ = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    walls = (gray < threshold / 2).astype(np.uint8) * 255
+    walls |= cv2.Canny(gray, 50, 150)
+    return cv2.dilate(walls, np.ones((3, 3), dtype=np.uint8))
+
+
+def detect_regions(pixels, map_shape):
+    """Segments a map image into rooms separated by walls and doorways.
+
+    Dark lines and strong edges are taken as walls, gaps up to DOOR_GAP are
+    closed so doorways split rooms, and every remaining connected open area
+    large enough to be a room becomes a region.
+    """
+    walls = detect_walls(pixels)
+    door = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (DOOR_GAP, DOOR_GAP))
+    walls = cv2.morphologyEx(walls, cv2.MORPH_CLOSE, door)
+
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(
+        255 - walls, connectivity=4, ltype=cv2.CV_32S)
+
+    # Renumber the rooms that are big enough as 1..n, everything else is 0
+    min_area = MIN_REGION_FRACTION * labels.size
+    keep = stats[:, cv2.CC_STAT_AREA] >= min_area
+    keep[0] = False
+    numbering = np.zeros(count, dtype=np.int32)
+    numbering[keep] = np.arange(1, keep.sum() + 1)
+    labels = numbering[labels]
+
+    x, y = stats[keep, cv2.CC_STAT_LEFT], stats[keep, cv2.CC_STAT_TOP]
+    boxes = np.zeros((keep.sum() + 1, 4), dtype=np.int32)
+    boxes[1:] = np.stack([x, y, x + stats[keep, cv2.CC_STAT_WIDTH],
+                          y + stats[keep, cv2.CC_STAT_HEIGHT]], axis=1)
+    return RegionMap(compact_labels(labels, len(boxes)), boxes, map_shape)
+
+
+def regions_from_image(image_path, map_shape, max_size=REGION_ANALYSIS_SIZE):
+    """Reads a region label image: every colour is one room, black is none"""
+    image = Image.open(image_path).convert('RGB')
+    scale = min(1.0, max_size / max(map_shape[:2]))
+    size = (max(1, int(map_shape[1] * scale)), max(1, int(map_shape[0] * scale)))
+    # Nearest keeps colours exact, so no blended in-between rooms appear
+    pixels = np.asarray(image.resize(size, Image.NEAREST)).astype(np.int32)
+    colours = (pixels[..., 0] << 16) | (pixels[..., 1] << 8) | pixels[..., 2]
+
+    values, labels = np.unique(colours, return_inverse=True)
+    labels = labels.reshape(colours.shape).astype(np.int32)
+    # Black sorts first and becomes label 0; without black, 0 stays unused
+    if values[0] != 0:
+        labels += 1
+    count = labels.max() + 1
+    return RegionMap(compact_labels(labels, count),
+                     label_boxes(labels, count), map_shape, imported=True)
+
+
+def label_boxes(labels, count):
+    """Bounding boxes of labels 0..count-1 without a pass per label"""
+    height, width = labels.shape
+    rows = np.zeros((count, height), dtype=bool)
+    cols = np.zeros((count, width), dtype=bool)
+    rows[labels, np.arange(height)[:, None]] = True
+    cols[labels, np.arange(width)[None, :]] = True
+
+    boxes = np.zeros((count, 4), dtype=np.int32)
+    boxes[:, 0] = cols.argmax(axis=1)
+    boxes[:, 1] = rows.argmax(axis=1)
+    boxes[:, 2] = width - cols[:, ::-1].argmax(axis=1)
+    boxes[:, 3] = height - rows[:, ::-1].argmax(axis=1)
+    return boxes
+
+
+def compact_labels(labels, count):
+    """Stores labels as uint16 whenever the room count allows it"""
+    return labels.astype(np.uint16 if count <= 65536 else np.int32)
+
+
+def region_cache_path(map_path, content_hash):
+    """Region index file for a map, in fog/regions next to its fog saves"""
+    return os.path.join(os.path.dirname(map_path), "fog", "regions", content_hash + ".npz")
+
+
+class RegionService:
+    """Finds and caches the rooms of the shown map on a background thread.
+
+    The index is keyed by the map's content hash, so it is computed once per
+    map image and reused when the map is opened again, even under another
+    name. Results are picked up on the Tk thread by polling.
+    """
+
+    def __init__(self, fog_app):
+        self.fog_app = fog_app
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="regions")
+        self.map_source = None
+        self.regions = None
+        self.future = None
+        self.after_id = None
+
+    @property
+    def busy(self):
+        return self.future is not None
+
+    def open_map(self):
+        """Follows a map change, loading its cached index if there is one"""
+        self.start(None)
+
+    def detect(self):
+        """Detects the rooms of the shown map unless they are known already"""
+        if self.regions is not None and self.map_source is self.fog_app.map_source:
+            update_status(self.fog_app, f"{self.regions.count} rooms ready, Shift+Click to reveal")
+            return
+        self.start('detect')
+
+    def import_labels(self, image_path):
+        """Uses a region label image for the shown map instead of detection"""
+        self.start('import', image_path)
+
+    def start(self, mode, image_path=None):
+        map_source = self.fog_app.map_source
+        self.map_source = map_source
+        self.regions = None
+        if map_source is None or map_source.path is None:
+            return
+        if mode is not None:
+            update_status(self.fog_app, "Finding rooms...")
+        self.future = self.executor.submit(self.find, map_source, mode, image_path)
+        if self.after_id is None:
+            self.after_id = self.fog_app.root.after(REGION_POLL_MS, self.poll)
+
+    def find(self, map_source, mode, image_path):
+        """Loads the cached index or builds it (worker thread)"""
+        fog_index = self.fog_app.fog_index
+        key = fog_index.map_key(map_source.path)
+        cache_path = region_cache_path(map_source.path, fog_index.content_hash(map_source.path))
+        # The index of a map that moved folders stays where it was built
+        moved_path = fog_index.derived(key, 'regions')
+        if mode == 'import':
+            regions = regions_from_image(image_path, map_source.shape)
+        elif os.path.exists(cache_path):
+            fog_index.set_derived(key, 'regions', cache_path)
+            return map_source, RegionMap.load(cache_path)
+        elif moved_path is not None:
+            return map_source, RegionMap.load(moved_path)
+        elif mode == 'detect':
+            regions = detect_regions(analysis_level(map_source), map_source.shape)
+        else:
+            return map_source, None
+        try:
+            regions.save(cache_path)
+        except OSError as e:
+            # A read-only map folder; the rooms are found again next time
+            print(f"Error saving room index: {e}")
+            return map_source, regions
+        fog_index.set_derived(key, 'regions', cache_path)
+        return map_source, regions
+
+    def poll(self):
+        """Takes the finished index on the Tk thread"""
+        self.after_id = None
+        if self.future is None:
+            return
+        if not self.future.done():
+            self.after_id = self.fog_app.root.after(REGION_POLL_MS, self.poll)
+            return
+
+        future, self.future = self.future, None
+        try:
+            map_source, regions = future.result()
+        except Exception as e:
+            print(f"Error finding rooms: {e}")
+            update_status(self.fog_app, f"Failed to find rooms: {e}")
+            return
+        # Another map was opened while this one was analysed
+        if map_source is not self.map_source:
+            return
+        self.regions = regions
+        if regions is not None:
+            update_status(self.fog_app, f"{regions.count} rooms ready, Shift+Click to reveal")
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def reveal_region(self, x, y):
+        """Removes the fog of the whole room under a map point"""
+        if self.fog_mask is None:
+            return None
+        service = self.regions
+        if service.regions is None or service.map_source is not self.map_source:
+            if service.busy:
+                update_status(self, "Still finding rooms...")
+            else:
+                update_status(self, "No rooms found yet, use Detect Rooms first")
+            return None
+
+        label = service.regions.region_at(x, y)
+        if label == 0:
+            return None
+
+        with self.perf.probe('mask_update'):
+            if isinstance(self.fog_mask, GridFogMask):
+                # Cells whose centre is in the room
+                rect, stamp = self.fog_mask.sample_region(*service.regions.region_mask(label))
+            else:
+                rect, stamp = service.regions.region_mask(label, self.fog_mask.shape)
+            x1, y1, x2, y2 = rect
+            self.push_undo(rect)
+            self.fog_mask[y1:y2, x1:x2] |= stamp
+
+        self.autosave.record('patch', rect, data=encode_patch(self.fog_mask[y1:y2, x1:x2]))
+        self.mark_dirty(rect)
+        return rect
@@ -0,0 +1,422 @@
+import math
+import numpy as np
+import cv2
+from PIL import Image
+
+from utils.perf_utils import PerfMonitor
+from utils.tile_utils import GridFogMask
+
+# Extra display pixels recomputed around a dirty area so resampled edges blend
+RESAMPLE_MARGIN = 2
+# Half-width of each resampling kernel in output pixels
+RESAMPLE_SUPPORT = {Image.LANCZOS: 3, Image.BILINEAR: 1, Image.BOX: 0.5}
+
+
+def union_rect(rect_a, rect_b):
+    """Returns the bounding box covering both rectangles"""
+    if rect_a is None:
+        return rect_b
+    if rect_b is None:
+        return rect_a
+    return (min(rect_a[0], rect_b[0]), min(rect_a[1], rect_b[1]),
+            max(rect_a[2], rect_b[2]), max(rect_a[3], rect_b[3]))
+
+
+def fog_rect_to_map(rect, fog_shape, map_shape):
+    """Converts a fog mask rectangle into the map rectangle it affects"""
+    if rect is None or tuple(fog_shape[:2]) == tuple(map_shape[:2]):
+        return rect
+    # Upsampling blends each fog pixel into its neighbours, so the map area
+    # one fog pixel around the change is redrawn too
+    rect = (max(0, rect[0] - 1), max(0, rect[1] - 1),
+            min(fog_shape[1], rect[2] + 1), min(fog_shape[0], rect[3] + 1))
+    scale_x = map_shape[1] / fog_shape[1]
+    scale_y = map_shape[0] / fog_shape[0]
+    return (int(math.floor(rect[0] * scale_x)), int(math.floor(rect[1] * scale_y)),
+            min(map_shape[1], int(math.ceil(rect[2] * scale_x))),
+            min(map_shape[0], int(math.ceil(rect[3] * scale_y))))
+
+
+def mask_rect_to_map(fog_mask, rect, map_shape):
+    """Converts a rectangle of any fog mask into the map rectangle it covers"""
+    if rect is not None and isinstance(fog_mask, GridFogMask):
+        return fog_mask.rect_to_map(rect)
+    return fog_rect_to_map(rect, fog_mask.shape, map_shape)
+
+
+def clip_to_visible(display_rect, visible):
+    """Clips a display rectangle to the visible one, in visible-local coordinates"""
+    if display_rect is None:
+        return None
+    vx1, vy1, vx2, vy2 = visible
+    x1, y1 = max(display_rect[0], vx1), max(display_rect[1], vy1)
+    x2, y2 = min(display_rect[2], vx2), min(display_rect[3], vy2)
+    if x2 <= x1 or y2 <= y1:
+        return None
+    return (x1 - vx1, y1 - vy1, x2 - vx1, y2 - vy1)
+
+
+def map_rect_to_display(rect, image_size, display_size, margin=RESAMPLE_MARGIN):
+    """Converts a map rectangle (x1, y1, x2, y2) into a padded display rectangle"""
+    img_width, img_height = image_size
+    display_width, display_height = display_size
+    scale_x = display_width / img_width
+    scale_y = display_height / img_height
+
+    x1 = max(0, int(math.floor(rect[0] * scale_x)) - margin)
+    y1 = max(0, int(math.floor(rect[1] * scale_y)) - margin)
+    x2 = min(display_width, int(math.ceil(rect[2] * scale_x)) + margin)
+    y2 = min(display_height, int(math.ceil(rect[3] * scale_y)) + margin)
+
+    if x2 <= x1 or y2 <= y1:
+        return None
+    return (x1, y1, x2, y2)
+
+
+def resize_region(source, display_rect, image_size, display_size,
+                  resample=Image.LANCZOS):
+    """Resamples only the source pixels behind a display rectangle.
+
+    source(x1, y1, x2, y2) must return the pixels of that source region. The
+    result matches the same region of a full-image resize with `resample`.
+    """
+    img_width, img_height = image_size
+    display_width, display_height = display_size
+    scale_x = display_width / img_width
+    scale_y = display_height / img_height
+
+    dx1, dy1, dx2, dy2 = display_rect
+    box = (dx1 / scale_x, dy1 / scale_y, dx2 / scale_x, dy2 / scale_y)
+
+    # Pad the source crop by the kernel footprint so edge pixels sample the
+    # same neighbours they would in a full resize
+    support = RESAMPLE_SUPPORT[resample]
+    pad_x = int(math.ceil(support / min(scale_x, 1.0))) + 1
+    pad_y = int(math.ceil(support / min(scale_y, 1.0))) + 1
+    sx1 = max(0, int(box[0]) - pad_x)
+    sy1 = max(0, int(box[1]) - pad_y)
+    sx2 = min(img_width, int(math.ceil(box[2])) + pad_x)
+    sy2 = min(img_height, int(math.ceil(box[3])) + pad_y)
+
+    region = Image.fromarray(source(sx1, sy1, sx2, sy2))
+    return region.resize(
+        (dx2 - dx1, dy2 - dy1), resample,
+        box=(box[0] - sx1, box[1] - sy1, box[2] - sx1, box[3] - sy1))
+
+
+def resize_to_display(pixels, display_size, resample=Image.LANCZOS):
+    """Resamples a full map-sized array to the display size"""
+    return np.array(Image.fromarray(pixels).resize(display_size, resample))
+
+
+def resize_mask_to_display(fog_mask, display_size, band_rows=128, display_rect=None):
+    """Resamples a fog mask to the display size, or only display_rect of it.
+
+    Only the mask pixels behind display_rect are read. Masks that are not
+    plain arrays (e.g. tiled masks) are resampled one band of display rows
+    at a time so only a strip of the mask is ever dense.
+    """
+    if isinstance(fog_mask, GridFogMask):
+        return fog_mask.expand(display_size, display_rect)
+    is_array = isinstance(fog_mask, np.ndarray)
+    if display_rect is None:
+        if is_array:
+            return resize_to_display(fog_mask, display_size, Image.BILINEAR)
+        display_rect = (0, 0) + tuple(display_size)
+
+    image_size = (fog_mask.shape[1], fog_mask.shape[0])
+    x1, y1, x2, y2 = display_rect
+    rows = y2 - y1 if is_array else band_rows
+    resized = np.empty((y2 - y1, x2 - x1), dtype=np.uint8)
+    for band_y1 in range(y1, y2, rows):
+        band_y2 = min(band_y1 + rows, y2)
+        band = resize_region(
+            lambda sx1, sy1, sx2, sy2: fog_mask[sy1:sy2, sx1:sx2],
+            (x1, band_y1, x2, band_y2), image_size, display_size, Image.BILINEAR)
+        resized[band_y1 - y1:band_y2 - y1] = np.asarray(band)
+    return resized
+
+
+# The DM sees fogged areas as the map faded 70% towards this grey
+DM_FOG_GREY = 64
+DM_FOG_STRENGTH = 0.7
+
+
+def darken_for_dm(map_pixels):
+    """Pre-computes how fully fogged map pixels look in the DM view"""
+    lut = np.round(np.arange(256) * (1 - DM_FOG_STRENGTH)
+                   + DM_FOG_GREY * DM_FOG_STRENGTH).astype(np.uint8)
+    return lut[map_pixels]
+
+
+class Compositor:
+    """Blends display-size uint8 images with saturating integer kernels.
+
+    The DM view is the cached map weighted by the fog plus its pre-darkened
+    copy weighted by the inverse fog; the player view scales the map by the
+    fog. Scratch buffers are kept between frames so compositing does not
+    allocate once the display size is stable.
+    """
+
+    def __init__(self):
+        self.scratch = np.empty(0, dtype=np.uint8)
+
+    def buffers(self, fog_shape, count):
+        """Returns `count` contiguous uint8 RGB scratch views for a region"""
+        height, width = fog_shape
+        size = height * width * 3
+        if self.scratch.size < size * count:
+            self.scratch = np.empty(size * count, dtype=np.uint8)
+        return [self.scratch[size * i:size * (i + 1)].reshape(height, width, 3)
+                for i in range(count)]
+
+    def dm(self, map_pixels, dark_pixels, fog_pixels, out):
+        """Writes (map * fog + dark * (255 - fog)) / 255 into out"""
+        fog, inverse, fogged, result = self.buffers(fog_pixels.shape, 4)
+        cv2.cvtColor(np.ascontiguousarray(fog_pixels), cv2.COLOR_GRAY2RGB, dst=fog)
+        cv2.bitwise_not(fog, dst=inverse)
+        cv2.multiply(dark_pixels, inverse, dst=fogged, scale=1 / 255)
+        cv2.multiply(map_pixels, fog, dst=result, scale=1 / 255)
+        cv2.add(result, fogged, dst=result)
+        out[...] = result
+        return out
+
+    def player(self, map_pixels, fog_pixels, out):
+        """Writes map * fog / 255 into out"""
+        fog, result = self.buffers(fog_pixels.shape, 2)
+        cv2.cvtColor(np.ascontiguousarray(fog_pixels), cv2.COLOR_GRAY2RGB, dst=fog)
+        cv2.multiply(map_pixels, fog, dst=result, scale=1 / 255)
+        out[...] = result
+        return out
+
+
+def visible_span(center, scale, virtual_length, canvas_length):
+    """Canvas origin along one axis, keeping as much of the map on screen as fits"""
+    if virtual_length <= canvas_length:
+        # The whole axis fits, so it is centred and the origin is negative
+        return -((canvas_length - virtual_length) // 2)
+    origin = int(round(center * scale - canvas_length / 2))
+    return max(0, min(origin, virtual_length - canvas_length))
+
+
+class Layout:
+    """Where a map of image_size sits in a canvas, optionally zoomed in.
+
+    At zoom 1 the whole map is fitted into the canvas. Zooming scales that
+    fit up into a virtual display of virtual_size, of which only the
+    `visible` rectangle (around `center`, in map pixels) is on the canvas.
+    display_size is the size of that visible part, drawn at x/y_offset.
+    """
+
+    def __init__(self, image_size, canvas_size, zoom=1.0, center=None):
+        img_width, img_height = image_size
+        canvas_width, canvas_height = canvas_size
+        self.image_size = image_size
+        self.zoom = zoom
+        self.scale = min(canvas_width / img_width, canvas_height / img_height) * zoom
+        self.virtual_size = (max(1, int(img_width * self.scale)),
+                             max(1, int(img_height * self.scale)))
+
+        center_x, center_y = center or (img_width / 2, img_height / 2)
+        origin_x = visible_span(center_x, self.scale, self.virtual_size[0], canvas_width)
+        origin_y = visible_span(center_y, self.scale, self.virtual_size[1], canvas_height)
+        self.visible = (max(0, origin_x), max(0, origin_y),
+                        min(self.virtual_size[0], origin_x + canvas_width),
+                        min(self.virtual_size[1], origin_y + canvas_height))
+        self.display_size = (self.visible[2] - self.visible[0],
+                             self.visible[3] - self.visible[1])
+        self.x_offset = self.visible[0] - origin_x
+        self.y_offset = self.visible[1] - origin_y
+        # Where the view ended up after clamping to the map edges
+        self.center = ((origin_x + canvas_width / 2) / self.scale,
+                       (origin_y + canvas_height / 2) / self.scale)
+
+    def map_point(self, x, y):
+        """Converts canvas coordinates into unclamped fractional map coordinates"""
+        return ((x - self.x_offset + self.visible[0]) / self.scale,
+                (y - self.y_offset + self.visible[1]) / self.scale)
+
+    def canvas_to_map(self, x, y):
+        """Converts canvas coordinates into clamped map pixel coordinates"""
+        img_width, img_height = self.image_size
+        map_x, map_y = (int(v) for v in self.map_point(x, y))
+        return (max(0, min(map_x, img_width - 1)), max(0, min(map_y, img_height - 1)))
+
+
+class DisplayCache:
+    """The visible part of the map and fog resampled to one virtual display size.
+
+    Only the map and fog pixels behind `visible` are read, so the cost of a
+    zoomed-in view follows the visible area. Views showing the same area at
+    the same size share one cache.
+    """
+
+    def __init__(self, map_source, fog_mask, virtual_size, visible):
+        self.virtual_size = virtual_size
+        self.visible = visible
+        self.full_view = visible == (0, 0) + tuple(virtual_size)
+        if self.full_view:
+            self.map_pixels = map_source.resized(virtual_size)
+        else:
+            # Crop the nearest pyramid level before resampling
+            pixels, _ = map_source.level_for(virtual_size)
+            self.map_pixels = np.asarray(resize_region(
+                lambda x1, y1, x2, y2: np.asarray(pixels[y1:y2, x1:x2]),
+                visible, (pixels.shape[1], pixels.shape[0]), virtual_size))
+        self.dark_pixels = None
+        self.fog_pixels = self.resample_mask(fog_mask)
+        self.fog_dirty = None
+        self.fog_stale = False
+
+    def resample_mask(self, fog_mask):
+        """The whole visible fog at display resolution"""
+        return resize_mask_to_display(
+            fog_mask, self.virtual_size,
+            display_rect=None if self.full_view else self.visible)
+
+    def dark(self):
+        """The pre-darkened DM base, built on first use"""
+        if self.dark_pixels is None:
+            self.dark_pixels = darken_for_dm(self.map_pixels)
+        return self.dark_pixels
+
+
+class ViewState:
+    """Per-view frame buffer and the map area it still has to recomposite"""
+
+    def __init__(self):
+        self.cache_key = None
+        self.frame = None
+        self.dirty = None
+        self.full = True
+
+
+class FogRenderer:
+    """Tk-free renderer producing display-ready DM and player frames.
+
+    Views are named ('dm', 'player'). Views that show the same area at the
+    same size share one DisplayCache, so the resized map and resampled fog
+    are computed once per frame for both. Fog changes reported through mark_dirty() are
+    resampled into each cache once and recomposited per view only inside the
+    changed area.
+    """
+
+    VIEWS = ('dm', 'player')
+
+    def __init__(self, perf=None):
+        self.map_source = None
+        self.caches = {}
+        self.views = {}
+        self.compositor = Compositor()
+        self.perf = perf or PerfMonitor(enabled=False)
+
+    def mark_dirty(self, rect=None):
+        """Queues a map area (x1, y1, x2, y2) for redraw, None redraws everything"""
+        for cache in self.caches.values():
+            if rect is None:
+                cache.fog_stale = True
+                cache.fog_dirty = None
+            else:
+                cache.fog_dirty = union_rect(cache.fog_dirty, rect)
+
+        for state in self.views.values():
+            if rect is None:
+                state.full = True
+            else:
+                state.dirty = union_rect(state.dirty, rect)
+
+    def drop_view(self, view):
+        """Forgets a closed view and any cache only it was using"""
+        self.views.pop(view, None)
+        self.drop_unused_caches()
+
+    def drop_unused_caches(self):
+        """Frees display caches no view is showing at the moment"""
+        used = {state.cache_key for state in self.views.values()}
+        for key in list(self.caches):
+            if key not in used:
+                del self.caches[key]
+
+    def render(self, view, map_source, fog_mask, canvas_size, zoom=1.0, center=None):
+        """Brings a view's frame up to date.
+
+        Returns (frame, changed, layout): frame is the display-size uint8 RGB
+        buffer owned by the renderer, changed is the display rectangle that
+        was recomposited (None if nothing changed) and layout describes how
+        the frame sits on the canvas. zoom and center (in map pixels) select
+        the part of the map shown; zoom 1 fits the whole map.
+        """
+        if map_source is not self.map_source:
+            self.map_source = map_source
+            self.caches.clear()
+            self.mark_dirty()
+
+        image_size = (map_source.shape[1], map_source.shape[0])
+        layout = Layout(image_size, canvas_size, zoom, center)
+        display_size = layout.display_size
+        key = (layout.virtual_size, layout.visible)
+
+        state = self.views.setdefault(view, ViewState())
+        if state.cache_key != key:
+            state.cache_key = key
+            if state.frame is None or state.frame.shape[:2] != display_size[::-1]:
+                state.frame = np.empty((display_size[1], display_size[0], 3), dtype=np.uint8)
+            state.full = True
+            self.drop_unused_caches()
+
+        cache = self.caches.get(key)
+        if cache is None:
+            with self.perf.probe('map_resize'):
+                cache = DisplayCache(map_source, fog_mask, layout.virtual_size, layout.visible)
+            self.caches[key] = cache
+        elif cache.fog_stale:
+            with self.perf.probe('fog_resample'):
+                cache.fog_pixels = cache.resample_mask(fog_mask)
+            cache.fog_stale = False
+        elif cache.fog_dirty is not None:
+            with self.perf.probe('fog_resample'):
+                self.resample_fog(cache, fog_mask, image_size)
+
+        if state.full:
+            changed = (0, 0) + display_size
+        elif state.dirty is not None:
+            changed = clip_to_visible(
+                map_rect_to_display(state.dirty, image_size, layout.virtual_size),
+                layout.visible)
+        else:
+            changed = None
+
+        if changed is not None:
+            with self.perf.probe('blend'):
+                self.composite(view, cache, state.frame, changed)
+        state.full = False
+        state.dirty = None
+        return state.frame, changed, layout
+
+    def resample_fog(self, cache, fog_mask, image_size):
+        """Updates the changed area of a cache's display-size fog"""
+        display_rect = clip_to_visible(
+            map_rect_to_display(cache.fog_dirty, image_size, cache.virtual_size),
+            cache.visible)
+        cache.fog_dirty = None
+        if display_rect is None:
+            return
+
+        x1, y1, x2, y2 = display_rect
+        vx1, vy1 = cache.visible[:2]
+        # The fog may be stored coarser than the map; it is upsampled here
+        cache.fog_pixels[y1:y2, x1:x2] = resize_mask_to_display(
+            fog_mask, cache.virtual_size,
+            display_rect=(x1 + vx1, y1 + vy1, x2 + vx1, y2 + vy1))
+
+    def composite(self, view, cache, frame, display_rect):
+        """Blends one display rectangle of a view into its frame"""
+        x1, y1, x2, y2 = display_rect
+        if view == 'dm':
+            self.compositor.dm(
+                cache.map_pixels[y1:y2, x1:x2], cache.dark()[y1:y2, x1:x2],
+                cache.fog_pixels[y1:y2, x1:x2], frame[y1:y2, x1:x2])
+        else:
+            self.compositor.player(
+                cache.map_pixels[y1:y2, x1:x2], cache.fog_pixels[y1:y2, x1:x2],
+                frame[y1:y2, x1:x2])
@@ -1,10 +1,19 @@
 import os
 import json
+import struct
+import zlib
 from datetime import datetime
 from tkinter import filedialog, messagebox
 import numpy as np
 from PIL import Image
-from windows.player_window import PlayerWindow
+from utils.tile_utils import new_fog_mask, mask_scale, saved_fog_shape, GridFogMask
+
+# Binary fog files start with this magic, then a little-endian uint16 format
+# version, a uint32 header length, the JSON header and the compressed mask
+FOG_MAGIC = b'FOGW'
+FOG_FORMAT_VERSION = 2
+# Rows encoded per chunk; a multiple of 8 keeps packed bands byte aligned
+SAVE_BAND_ROWS = 256
 
 def get_fog_save_path(self, map_path=None):
         """Generate a fog save file path based on the map path"""
@@ -14,18 +23,19 @@ def get_fog_save_path(self, map_path=None):
         if map_path is None:
             return None
 
-        # Get the directory and filename of the map
-        map_dir = os.path.dirname(map_path)
-        map_filename = os.path.basename(map_path)
-        map_name = os.path.splitext(map_filename)[0]
+        save_path = fog_save_path(map_path)
 
         # Create fog directory if it doesn't exist
-        fog_dir = os.path.join(map_dir, "fog")
+        fog_dir = os.path.dirname(save_path)
         if not os.path.exists(fog_dir):
             os.makedirs(fog_dir)
 
-        # Create fog save path in the fog directory
-        return os.path.join(fog_dir, map_name + ".fog")
+        return save_path
+
+def fog_save_path(map_path):
+        """The fog save a map keeps in fog/ next to it, whether it exists or not"""
+        map_name = os.path.splitext(os.path.basename(map_path))[0]
+        return os.path.join(os.path.dirname(map_path), "fog", map_name + ".fog")
 
 def save_fog_state(self, auto_save=False):
         """Save the current fog state"""
@@ -55,19 +65,10 @@ def save_fog_state(self, auto_save=False):
             if not save_path:
                 return False
 
-            # Create save data
-            save_data = {
-                'fog_mask': self.fog_mask.tolist(),  # Convert numpy array to list
-                'map_path': self.current_map_path,
-                'map_shape': self.map_image.shape,
-                'reveal_radius': self.reveal_radius,
-                'timestamp': datetime.now().isoformat(),
-                'version': '1.0'
-            }
-
             # Save to file
-            with open(save_path, 'w') as f:
-                json.dump(save_data, f, indent=2)
+            metadata = fog_metadata(self)
+            write_fog_file(save_path, self.fog_mask, metadata)
+            index_fog_save(self, save_path, metadata)
 
             current_save_path = save_path
 
@@ -87,6 +88,130 @@ def save_fog_state(self, auto_save=False):
             update_status(self, "Failed to save fog state")
             return False
 
+def fog_metadata(self):
+        """Builds the header stored alongside the fog mask"""
+        metadata = {
+            'map_path': self.current_map_path,
+            'map_shape': list(self.map_image.shape),
+            'fog_scale': mask_scale(self.map_image.shape, self.fog_mask.shape),
+            'reveal_radius': self.reveal_radius,
+            'timestamp': datetime.now().isoformat(),
+            'journal_seq': self.autosave.seq
+        }
+        if isinstance(self.fog_mask, GridFogMask):
+            cell_size, offset = self.fog_mask.geometry
+            metadata['grid'] = {'cell_size': cell_size, 'offset': list(offset)}
+        try:
+            # Finds the map again by its content if it is moved or renamed
+            metadata['map_key'] = self.fog_index.map_key(self.current_map_path)
+        except OSError:
+            pass
+        return metadata
+
+def index_fog_save(self, save_path, metadata):
+        """Records a written fog file in the fog index under its map"""
+        if metadata.get('map_key'):
+            self.fog_index.add_save(metadata['map_key'], save_path)
+
+def write_fog_file(save_path, fog_mask, metadata):
+        """Writes a binary version 2 fog file"""
+        height, width = fog_mask.shape
+        # Work in bands of rows so tiled masks never need a full dense copy
+        bands = [(y, min(y + SAVE_BAND_ROWS, height))
+                 for y in range(0, height, SAVE_BAND_ROWS)]
+
+        # Masks are normally pure 0/255, which packs into one bit per pixel
+        binary = all(np.all((band == 0) | (band == 255))
+                     for band in (fog_mask[y1:y2, :] for y1, y2 in bands))
+
+        compressor = zlib.compressobj(1)
+        payload = []
+        for y1, y2 in bands:
+            band = fog_mask[y1:y2, :]
+            if binary:
+                # Bands hold a multiple of 8 pixels, so the bits concatenate
+                payload.append(compressor.compress(np.packbits(band > 127).tobytes()))
+            else:
+                payload.append(compressor.compress(np.ascontiguousarray(band).tobytes()))
+        payload.append(compressor.flush())
+
+        header = dict(metadata)
+        header.update({
+            'version': '2.0',
+            'mask_shape': [height, width],
+            'encoding': 'packbits+zlib' if binary else 'zlib'
+        })
+        header_bytes = json.dumps(header).encode('utf-8')
+
+        # Write to a temp file and rename so a crash never leaves a torn save
+        temp_path = save_path + ".tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(FOG_MAGIC)
+            f.write(struct.pack('<HI', FOG_FORMAT_VERSION, len(header_bytes)))
+            f.write(header_bytes)
+            for chunk in payload:
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, save_path)
+
+def read_fog_file(file_path):
+        """Reads a fog file of either version and returns (metadata, fog_mask)"""
+        with open(file_path, 'rb') as f:
+            if f.read(len(FOG_MAGIC)) != FOG_MAGIC:
+                # Version 1.0 files are plain JSON with the mask as nested lists
+                f.seek(0)
+                save_data = json.loads(f.read().decode('utf-8'))
+                if 'fog_mask' not in save_data:
+                    raise ValueError("Missing fog mask")
+                pixels = np.array(save_data.pop('fog_mask'), dtype=np.uint8)
+                fog_mask = new_fog_mask(pixels.shape)
+                fog_mask[:, :] = pixels
+                return save_data, fog_mask
+
+            format_version, header_length = struct.unpack('<HI', f.read(6))
+            if format_version > FOG_FORMAT_VERSION:
+                raise ValueError(f"Unsupported fog file version {format_version}")
+            header = json.loads(f.read(header_length).decode('utf-8'))
+            payload = np.frombuffer(zlib.decompress(f.read()), dtype=np.uint8)
+
+        height, width = header['mask_shape']
+        grid = header.get('grid')
+        if grid:
+            fog_mask = GridFogMask(header['map_shape'], grid['cell_size'], grid['offset'])
+            if fog_mask.shape != (height, width):
+                raise ValueError("Grid fog doesn't match its map shape")
+        else:
+            fog_mask = new_fog_mask((height, width))
+        for y1 in range(0, height, SAVE_BAND_ROWS):
+            y2 = min(y1 + SAVE_BAND_ROWS, height)
+            count = (y2 - y1) * width
+            if header['encoding'] == 'packbits+zlib':
+                start = y1 * width // 8
+                bits = np.unpackbits(payload[start:start + -(-count // 8)], count=count)
+                fog_mask[y1:y2, :] = (bits * 255).reshape(y2 - y1, width)
+            elif header['encoding'] == 'zlib':
+                start = y1 * width
+                fog_mask[y1:y2, :] = payload[start:start + count].reshape(y2 - y1, width)
+            else:
+                raise ValueError(f"Unknown fog encoding {header['encoding']}")
+        return header, fog_mask
+
+def offer_fog_upgrade(self, file_path):
+        """Asks to rewrite an old JSON fog file in the compact binary format"""
+        if messagebox.askyesno(
+                "Upgrade Fog File",
+                f"{os.path.basename(file_path)} uses the old fog format.\n"
+                "Convert it to the new compact format?"):
+            try:
+                metadata = fog_metadata(self)
+                write_fog_file(file_path, self.fog_mask, metadata)
+                index_fog_save(self, file_path, metadata)
+                update_status(self, "Fog file upgraded")
+            except Exception as e:
+                messagebox.showerror(
+                    "Error", f"Failed to upgrade fog file: {str(e)}")
+
 def load_fog_state(self):
         """Load a fog state from file"""
         # Default to the fog directory if it exists
@@ -109,66 +234,44 @@ def load_fog_state(self):
 def load_fog_from_path(self, file_path):
         """Load fog state from a specific file path"""
         try:
-            with open(file_path, 'r') as f:
-                save_data = json.load(f)
+            try:
+                save_data, fog_mask = read_fog_file(file_path)
+            except (ValueError, KeyError, zlib.error, struct.error):
+                save_data, fog_mask = {}, None
 
             # Validate save data
-            if 'fog_mask' not in save_data or 'map_path' not in save_data:
+            if fog_mask is None or 'map_path' not in save_data:
                 messagebox.showerror("Error", "Invalid fog save file!")
                 return False
 
-            # Check if the associated map exists
+            # Check if the associated map exists, or was seen elsewhere
             saved_map_path = save_data['map_path']
+            if not os.path.exists(saved_map_path) and save_data.get('map_key'):
+                # Finding it may hash map files, so the loading thread looks
+                # and asks for the map only if it finds none
+                self.loader.load(saved_map_path, (file_path, save_data, fog_mask),
+                                 map_key=save_data['map_key'])
+                return True
             if not os.path.exists(saved_map_path):
-                # Ask user to locate the map
-                messagebox.showwarning("Warning",
-                                       f"Original map not found at {saved_map_path}\n"
-                                       "Please locate the map file.")
-
-                new_map_path = filedialog.askopenfilename(
-                    title="Locate Map Image",
-                    filetypes=[
-                        ("Image files", "*.png *.jpg *.jpeg *.bmp *.tiff *.gif")]
-                )
-
-                if not new_map_path:
+                saved_map_path = locate_map(saved_map_path)
+                if not saved_map_path:
                     return False
 
-                saved_map_path = new_map_path
-
-            # Load the map if it's not already loaded or if it's different
+            # Another map is loaded in the background and shows this fog
+            # once it is ready
             if self.current_map_path != saved_map_path:
-                try:
-                    pil_image = Image.open(saved_map_path).convert('RGB')
-                    self.map_image = np.array(pil_image)
-                    self.current_map_path = saved_map_path
-                except Exception as e:
-                    messagebox.showerror(
-                        "Error", f"Failed to load map: {str(e)}")
-                    return False
+                self.loader.load(saved_map_path, (file_path, save_data, fog_mask))
+                return True
 
-            # Load fog mask
-            self.fog_mask = np.array(save_data['fog_mask'], dtype=np.uint8)
+            # Save and close the journal of the fog being replaced
+            self.loader.cancel()
+            self.autosave.detach()
 
-            # Verify dimensions match
-            if self.fog_mask.shape != self.map_image.shape[:2]:
-                messagebox.showerror(
-                    "Error", "Fog mask dimensions don't match map dimensions!")
+            if not apply_fog_state(self, file_path, save_data, fog_mask):
                 return False
 
-            # Load other settings
-            if 'reveal_radius' in save_data:
-                self.reveal_radius = save_data['reveal_radius']
-                self.radius_slider.set(self.reveal_radius)
-                self.radius_value.configure(
-                    text=f"{self.reveal_radius}x{self.reveal_radius} pixels")
-
-            current_save_path = file_path
             messagebox.showinfo("Success", "Fog state loaded successfully!")
             update_status(self, "Fog state loaded successfully")
-
-            # Update windows if they're open
-            self.update_queue.put("update_all")
             return True
 
         except Exception as e:
@@ -177,44 +280,67 @@ def load_fog_from_path(self, file_path):
             update_status(self, "Failed to load fog state")
             return False
 
-def auto_load_fog_state(self):
-        """Automatically load fog state if it exists for the current map"""
-        if not self.current_map_path:
-            return
-        # First, try to find exact match in fog directory
+def locate_map(saved_map_path):
+        """Asks the user where the map of a fog save went; None if cancelled"""
+        messagebox.showwarning("Warning",
+                               f"Original map not found at {saved_map_path}\n"
+                               "Please locate the map file.")
+
+        new_map_path = filedialog.askopenfilename(
+            title="Locate Map Image",
+            filetypes=[
+                ("Image files", "*.png *.jpg *.jpeg *.bmp *.tiff *.gif")]
+        )
+        return new_map_path or None
+
+def apply_fog_state(self, file_path, save_data, fog_mask):
+        """Shows fog read from file_path on the loaded map and journals it"""
+        # Verify dimensions match, at the fog detail it was saved with
+        if fog_mask.shape != saved_fog_shape(self.map_image.shape, save_data):
+            messagebox.showerror(
+                "Error", "Fog mask dimensions don't match map dimensions!")
+            return False
+
+        # Load fog mask
+        self.fog_mask = fog_mask
+        self.history.clear()
+        self.show_fog_scale()
+
+        # Load other settings
+        if 'reveal_radius' in save_data:
+            self.reveal_radius = save_data['reveal_radius']
+            self.radius_slider.set(self.reveal_radius)
+            self.radius_value.configure(
+                text=f"{self.reveal_radius}x{self.reveal_radius} pixels")
+
+        # Replay edits journaled after this save, if it is the autosave
         auto_save_path = get_fog_save_path(self)
-        if auto_save_path and os.path.exists(auto_save_path):
-            try:
-                print("checking again")
-                load_fog_from_path(self, auto_save_path)
-                update_status(self, "Auto-loaded existing fog state")
-                return
-            except:
-                # Continue to search for other matches
-                pass
-
-        # If exact match not found, search for similar names in fog directory
-        map_dir = os.path.dirname(self.current_map_path)
-        fog_dir = os.path.join(map_dir, "fog")
+        self.autosave.attach(
+            auto_save_path, save_data.get('journal_seq', 0),
+            replay=os.path.abspath(file_path) == os.path.abspath(auto_save_path))
 
-        if not os.path.exists(fog_dir):
-            return
-
-        map_filename = os.path.basename(self.current_map_path)
-        map_name = os.path.splitext(map_filename)[0].lower()
-
-        # Look for fog files that match the map name (case-insensitive)
-        for filename in os.listdir(fog_dir):
-            if filename.lower().endswith('.fog'):
-                fog_name = os.path.splitext(filename)[0].lower()
-                if fog_name == map_name:
-                    fog_path = os.path.join(fog_dir, filename)
-                    try:
-                        load_fog_from_path(fog_path)
-                        update_status(self, f"Auto-loaded fog state: {filename}")
-                        return
-                    except:
-                        continue
+        if save_data.get('version') == '1.0':
+            offer_fog_upgrade(self, file_path)
+
+        # Update windows if they're open
+        self.mark_dirty()
+        return True
+
+def find_fog_save(self, map_path):
+        """The fog save of a map if there is one, even from before a rename.
+
+        Hashes the map the first time it is seen, so call it off the Tk thread.
+        """
+        # Keying also records where the map is now
+        key = self.fog_index.map_key(map_path)
+
+        # First, try the exact name in the fog directory
+        auto_save_path = get_fog_save_path(self, map_path)
+        if os.path.exists(auto_save_path):
+            return auto_save_path
+
+        # Then the latest save of the same image under any name or folder
+        return self.fog_index.find_save(key)
 
 def manual_save(self, event=None):
         """Handle Ctrl+S manual save"""
@@ -225,9 +351,4 @@ def update_status(self, message):
         self.status_label.configure(text=message)
         # Clear status after 3 seconds
         self.root.after(
-            3000, lambda: self.status_label.configure(text="Ready"))
-
-        """Opens the player window"""
-        if self.map_image is None:
-            messagebox.showwarning("Warning", "Please load a map first!")
-            return
\ No newline at end of file
+            3000, lambda: self.status_label.configure(text="Ready"))
\ No newline at end of file
@@ -0,0 +1,104 @@
+import time
+
+# Default redraw rate of the DM and player windows
+TARGET_FPS = 60
+
+
+class RenderScheduler:
+    """Coalesces redraw requests into at most one render per display frame.
+
+    Views register a draw callback by name. request() only marks views dirty
+    and makes sure one frame is pending on the Tk event loop; however many
+    fog edits arrive before that frame, each dirty view is drawn once with
+    the latest state. Frames are paced at target_fps, and a frame that runs
+    late pushes the next one back instead of queueing a backlog, so stale
+    frames are dropped under load. Everything runs on the Tk thread.
+    """
+
+    def __init__(self, root, target_fps=TARGET_FPS, perf=None):
+        self.root = root
+        self.interval = 1.0 / target_fps
+        self.perf = perf
+        self.views = {}
+        self.dirty = set()
+        self.before_frame_callbacks = []
+        self.after_id = None
+        self.in_frame = False
+        self.requested_at = None
+        self.next_frame_time = 0.0
+
+    def register(self, view, draw):
+        """Adds a view drawn by draw() and schedules its first frame"""
+        self.views[view] = draw
+        self.request(view)
+
+    def unregister(self, view):
+        """Stops drawing a closed view"""
+        self.views.pop(view, None)
+        self.dirty.discard(view)
+
+    def request(self, view=None):
+        """Marks one view (every view if None) dirty for the next frame"""
+        if view is None:
+            self.dirty.update(self.views)
+        elif view in self.views:
+            self.dirty.add(view)
+        if self.dirty:
+            self.schedule()
+
+    def before_frame(self, callback):
+        """Runs callback once at the start of the next frame"""
+        if callback not in self.before_frame_callbacks:
+            self.before_frame_callbacks.append(callback)
+        self.schedule()
+
+    def schedule(self):
+        """Makes sure a frame is pending, no sooner than the frame interval allows"""
+        if self.after_id is not None or self.in_frame:
+            # A running frame reschedules itself once it is done
+            return
+        now = time.perf_counter()
+        if self.requested_at is None:
+            self.requested_at = now
+        delay_ms = max(0, int((self.next_frame_time - now) * 1000))
+        self.after_id = self.root.after(delay_ms, self.run_frame)
+
+    def cancel(self):
+        """Drops the pending frame, e.g. when the app is closing"""
+        if self.after_id is not None:
+            self.root.after_cancel(self.after_id)
+            self.after_id = None
+
+    def run_frame(self):
+        """Runs pending callbacks, then draws each dirty view once"""
+        self.after_id = None
+        self.in_frame = True
+        start = time.perf_counter()
+        if self.perf is not None and self.requested_at is not None:
+            self.perf.record('frame_latency', start - self.requested_at)
+        self.requested_at = None
+
+        # Callbacks may change the fog and mark views dirty for this frame
+        callbacks, self.before_frame_callbacks = self.before_frame_callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Error before frame: {e}")
+
+        dirty, self.dirty = self.dirty, set()
+        for view in dirty:
+            draw = self.views.get(view)
+            if draw is None:
+                continue
+            try:
+                draw()
+            except Exception as e:
+                print(f"Error drawing {view} view: {e}")
+        self.in_frame = False
+
+        # Pace from this frame's start, but never try to catch up on frames
+        # that were missed while it ran
+        self.next_frame_time = max(start + self.interval, time.perf_counter())
+        if self.dirty or self.before_frame_callbacks:
+            self.schedule()
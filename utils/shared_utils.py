@@ -0,0 +1,156 @@
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+from utils.render_utils import union_rect
+from utils.tile_utils import GridFogMask
+
+# Shared header slots (int64): change sequence, the map area changed since
+# the player last looked (x2 <= x1 when none) and the map generation
+HEADER_SEQ = 0
+HEADER_RECT = slice(1, 5)
+HEADER_GENERATION = 5
+HEADER_SLOTS = 8
+
+
+def attach_shared(name):
+    """Opens an existing shared memory block without taking ownership of it"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching also registers the block for cleanup,
+        # which would unlink it when this process exits
+        block = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(block._name, 'shared_memory')
+        return block
+
+
+def take_changes(header, lock, last_seq):
+    """Returns (seq, changed map rect or None) and clears the pending rect"""
+    with lock:
+        seq = int(header[HEADER_SEQ])
+        if seq == last_seq:
+            return seq, None
+        x1, y1, x2, y2 = (int(v) for v in header[HEADER_RECT])
+        header[HEADER_RECT] = (0, 0, 0, 0)
+    return seq, ((x1, y1, x2, y2) if x2 > x1 and y2 > y1 else None)
+
+
+class PlayerProcess:
+    """Runs the player window in its own process, fed through shared memory.
+
+    The fog is mirrored into a shared uint8 block; each frame the Tk thread
+    copies only the changed rectangle into it, merges that rectangle into
+    the shared header and bumps the change sequence. The player process
+    polls the sequence and recomposites just that area on its own core, so
+    however slow the player display is, it never holds up the DM. The map
+    itself is shared through its memory-mapped decode in the map cache.
+    """
+
+    def __init__(self, fog_app):
+        self.fog_app = fog_app
+        self.context = multiprocessing.get_context('spawn')
+        self.lock = self.context.Lock()
+        self.control = self.context.Queue()
+        self.header_block = shared_memory.SharedMemory(
+            create=True, size=HEADER_SLOTS * 8)
+        self.header = np.ndarray((HEADER_SLOTS,), dtype=np.int64,
+                                 buffer=self.header_block.buf)
+        self.header[:] = 0
+        self.fog_block = None
+        self.fog_pixels = None
+        self.process = None
+
+        # Tk thread state
+        self.map_source = None
+        self.grid = None
+        self.fog_mask = None
+        self.dirty = None
+
+    def start(self):
+        """Starts the player process"""
+        from windows.player_process import run_player_process
+        self.process = self.context.Process(
+            target=run_player_process,
+            args=(self.header_block.name, self.lock, self.control),
+            daemon=True)
+        self.process.start()
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def stop(self):
+        """Closes the player process and frees the shared memory"""
+        if self.alive:
+            self.control.put(('close',))
+            self.process.join(2)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.process = None
+        self.release_fog()
+        self.header = None
+        self.header_block.close()
+        self.header_block.unlink()
+
+    def release_fog(self):
+        if self.fog_block is not None:
+            self.fog_pixels = None
+            self.fog_block.close()
+            self.fog_block.unlink()
+            self.fog_block = None
+
+    def mark_dirty(self, rect=None):
+        """Queues a changed map area (None is everything) for the next flush"""
+        if rect is None:
+            self.fog_mask = None
+        else:
+            self.dirty = union_rect(self.dirty, rect)
+
+    def flush(self):
+        """Copies the changed fog into shared memory and bumps the sequence"""
+        fog_app = self.fog_app
+        if fog_app.map_source is None or fog_app.fog_mask is None or not self.alive:
+            return
+        if fog_app.current_map_path is None:
+            # A preview; the process opens the map itself once it has loaded
+            return
+
+        height, width = fog_app.fog_mask.shape
+        grid = fog_app.fog_mask.geometry if isinstance(fog_app.fog_mask, GridFogMask) else None
+        # A new map, fog detail or grid needs a new block
+        if (fog_app.map_source is not self.map_source or
+                self.fog_pixels.shape != (height, width) or grid != self.grid):
+            self.map_source = fog_app.map_source
+            self.grid = grid
+            self.release_fog()
+            self.fog_block = shared_memory.SharedMemory(create=True, size=height * width)
+            self.fog_pixels = np.ndarray((height, width), dtype=np.uint8,
+                                         buffer=self.fog_block.buf)
+            self.fog_pixels[:, :] = fog_app.fog_mask[:, :]
+            self.fog_mask = fog_app.fog_mask
+            self.dirty = None
+            with self.lock:
+                self.header[HEADER_GENERATION] += 1
+                self.header[HEADER_RECT] = (0, 0, 0, 0)
+            self.control.put(('map', fog_app.current_map_path, self.fog_block.name,
+                              (height, width), int(self.header[HEADER_GENERATION]), grid))
+            return
+
+        if fog_app.fog_mask is not self.fog_mask:
+            # Loaded fog or a full redraw
+            self.fog_mask = fog_app.fog_mask
+            self.dirty = (0, 0, width, height)
+        if self.dirty is None:
+            return
+
+        x1, y1, x2, y2 = self.dirty
+        self.dirty = None
+        self.fog_pixels[y1:y2, x1:x2] = self.fog_mask[y1:y2, x1:x2]
+        with self.lock:
+            pending = tuple(int(v) for v in self.header[HEADER_RECT])
+            rect = (x1, y1, x2, y2)
+            if pending[2] > pending[0] and pending[3] > pending[1]:
+                rect = union_rect(pending, rect)
+            self.header[HEADER_RECT] = rect
+            self.header[HEADER_SEQ] += 1
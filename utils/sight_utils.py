@@ -0,0 +1,168 @@
+import math
+from collections import OrderedDict
+import numpy as np
+import cv2
+
+from utils.fog_utils import reveal_polygon
+from utils.region_utils import analysis_level, detect_walls
+
+# Longest side of the wall grid sight is traced on
+SIGHT_GRID_SIZE = 1024
+# Rays cast around a token
+SIGHT_RAYS = 720
+# Token positions within one cell (grid pixels) share a visibility polygon
+SIGHT_CELL = 4
+# Visibility polygons kept per map
+SIGHT_CACHE_ENTRIES = 512
+
+
+class SightEngine:
+    """Reveals what a token can see, stopping at the walls of the map.
+
+    Walls come from an imported room map (its black pixels) or are detected
+    from the map image, on a grid of at most SIGHT_GRID_SIZE. Visibility is
+    traced with all rays at once in NumPy: every ray samples the grid at one
+    cell steps, and the first wall along it ends the ray. The polygon of the
+    ray ends is cached per token cell, so moving a token back and forth
+    costs only the mask write, which goes through reveal_polygon like any
+    other reveal.
+
+    Like StrokeEngine, positions received while dragging are traced once
+    per frame, right before the scheduler draws.
+    """
+
+    def __init__(self, fog_app, rays=SIGHT_RAYS):
+        self.fog_app = fog_app
+        self.rays = rays
+        self.token = None
+        self.token_map = None
+        self.pending = None
+
+        # Per map state, rebuilt when the map or its room index changes
+        self.source = None
+        self.walls = None
+        self.scale = np.ones(2)
+        self.offsets = None
+        self.cache = OrderedDict()
+
+    def place(self, x, y):
+        """Puts the token at a map point and reveals what it sees"""
+        self.end()
+        self.fog_app.history.begin_stroke()
+        self.token = (x, y)
+        self.token_map = self.fog_app.map_source
+        self.reveal(x, y)
+
+    def move(self, x, y):
+        """Queues a new token position, revealing on the next frame"""
+        if self.visible_token() is None:
+            self.place(x, y)
+            return
+        self.token = (x, y)
+        self.pending = (x, y)
+        self.fog_app.scheduler.before_frame(self.flush)
+        self.fog_app.scheduler.request('dm')
+
+    def flush(self):
+        """Reveals the sight of the last queued position"""
+        if self.pending is not None:
+            x, y = self.pending
+            self.pending = None
+            self.reveal(x, y)
+
+    def end(self):
+        """Finishes a token drag as one undo step"""
+        self.flush()
+        self.fog_app.history.end_stroke()
+
+    def remove(self):
+        """Takes the token off the map"""
+        self.end()
+        self.token = None
+        self.fog_app.scheduler.request('dm')
+
+    def visible_token(self):
+        """The token position, or None if it was placed on another map"""
+        if self.token_map is not self.fog_app.map_source:
+            return None
+        return self.token
+
+    def reveal(self, x, y):
+        if self.fog_app.map_source is None:
+            return None
+        polygon = self.visible_polygon(x, y)
+        if polygon is None:
+            return None
+        return reveal_polygon(self.fog_app, polygon)
+
+    def prepare(self):
+        """Builds the wall grid of the shown map if it isn't current"""
+        fog_app = self.fog_app
+        service = fog_app.regions
+        regions = service.regions if service.map_source is fog_app.map_source else None
+        source = (fog_app.map_source, regions if regions is not None and regions.imported else None)
+        if self.source is not None and self.source[0] is source[0] and self.source[1] is source[1]:
+            return
+
+        if source[1] is not None:
+            walls = source[1].labels == 0
+            scale = max(walls.shape) / SIGHT_GRID_SIZE
+            if scale > 1:
+                # Area averaging keeps a wall cell wherever any wall pixel was
+                size = (max(1, int(walls.shape[1] / scale)), max(1, int(walls.shape[0] / scale)))
+                walls = cv2.resize(walls.astype(np.uint8) * 255, size,
+                                   interpolation=cv2.INTER_AREA) > 0
+        else:
+            walls = detect_walls(analysis_level(fog_app.map_source, SIGHT_GRID_SIZE)) > 0
+
+        self.source = source
+        # A one cell wall around the grid stops every ray at the map edge
+        self.walls = np.pad(walls, 1, constant_values=True)
+        self.scale = np.array([fog_app.map_source.shape[1] / walls.shape[1],
+                               fog_app.map_source.shape[0] / walls.shape[0]])
+        self.cache.clear()
+
+        # Ray sample offsets, long enough to cross the whole grid
+        length = int(math.hypot(*walls.shape)) + 1
+        angles = np.linspace(0, 2 * np.pi, self.rays, endpoint=False)
+        steps = np.arange(1, length + 1, dtype=np.float32)
+        self.offsets = (np.cos(angles).astype(np.float32)[:, None] * steps,
+                        np.sin(angles).astype(np.float32)[:, None] * steps)
+
+    def visible_polygon(self, x, y):
+        """Map-coordinate polygon a token at x, y can see, cached per cell"""
+        self.prepare()
+        height, width = self.walls.shape[0] - 2, self.walls.shape[1] - 2
+        cell = (int(x / self.scale[0]) // SIGHT_CELL, int(y / self.scale[1]) // SIGHT_CELL)
+        if not (0 <= cell[0] * SIGHT_CELL < width and 0 <= cell[1] * SIGHT_CELL < height):
+            return None
+
+        polygon = self.cache.get(cell)
+        if polygon is not None:
+            self.cache.move_to_end(cell)
+            return polygon
+
+        with self.fog_app.perf.probe('sight'):
+            polygon = self.trace(min(width - 1, (cell[0] + 0.5) * SIGHT_CELL),
+                                 min(height - 1, (cell[1] + 0.5) * SIGHT_CELL))
+        self.cache[cell] = polygon
+        if len(self.cache) > SIGHT_CACHE_ENTRIES:
+            self.cache.popitem(last=False)
+        return polygon
+
+    def trace(self, grid_x, grid_y):
+        """Casts every ray from a grid point and returns the polygon of their ends"""
+        height, width = self.walls.shape[0] - 2, self.walls.shape[1] - 2
+        # Grid cell of every ray sample, shifted by the border cell
+        cells_x = np.clip(grid_x + 1 + self.offsets[0], 0, width + 1).astype(np.intp)
+        cells_y = np.clip(grid_y + 1 + self.offsets[1], 0, height + 1).astype(np.intp)
+        blocked = self.walls[cells_y, cells_x]
+
+        # Each ray runs to its first blocked sample, which is included so
+        # the wall itself shows; the border blocks every ray eventually
+        hit = blocked.argmax(axis=1)
+        rows = np.arange(len(hit))
+        ends = np.stack([cells_x[rows, hit], cells_y[rows, hit]], axis=1) - 0.5
+        ends[:, 0] = np.clip(ends[:, 0], 0, width)
+        ends[:, 1] = np.clip(ends[:, 1], 0, height)
+        return np.round(ends * self.scale).astype(np.int32)
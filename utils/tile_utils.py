@@ -0,0 +1,341 @@
+import numpy as np
+
+# Edge length of one fog tile in pixels
+TILE_SIZE = 256
+# Maps with at least this many pixels get a tiled fog mask (about 8K x 6K)
+TILED_FOG_MIN_PIXELS = 48 * 1024 * 1024
+
+
+def fog_shape(map_shape, fog_scale=1):
+    """Shape of a fog mask storing one pixel per fog_scale x fog_scale map pixels"""
+    return (-(-int(map_shape[0]) // fog_scale), -(-int(map_shape[1]) // fog_scale))
+
+
+def mask_scale(map_shape, mask_shape):
+    """The fog_scale a mask of mask_shape was made with for a map"""
+    return max(1, int(round(map_shape[1] / mask_shape[1])))
+
+
+def new_fog_mask(shape, fill=0):
+    """Creates the fog mask for a map, tiled when the map is very large"""
+    if shape[0] * shape[1] >= TILED_FOG_MIN_PIXELS:
+        return TiledFogMask(shape, fill)
+    return np.full(shape, fill, dtype=np.uint8)
+
+
+class TiledFogMask:
+    """A uint8 fog mask split into fixed-size tiles.
+
+    Tiles that are a single value (fully fogged or fully revealed) are stored
+    as that value only; just the tiles along a reveal boundary hold pixels.
+    Slicing with [y1:y2, x1:x2] reads or writes a region like a NumPy array,
+    and fill() is O(tiles), so the rest of the fog code works unchanged.
+    """
+
+    def __init__(self, shape, fill=0, tile_size=TILE_SIZE):
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.dtype = np.dtype(np.uint8)
+        self.ndim = 2
+        self.tile_size = tile_size
+        self.rows = -(-self.shape[0] // tile_size)
+        self.cols = -(-self.shape[1] // tile_size)
+        # Value of each uniform tile, -1 where the tile is backed by pixels
+        self.constants = np.full((self.rows, self.cols), fill, dtype=np.int16)
+        self.tiles = {}
+
+    @classmethod
+    def from_array(cls, pixels, tile_size=TILE_SIZE):
+        """Builds a tiled mask from a dense array"""
+        mask = cls(pixels.shape, 0, tile_size)
+        mask[:, :] = pixels
+        return mask
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def nbytes(self):
+        """Memory actually held by the mask"""
+        return self.constants.nbytes + sum(t.nbytes for t in self.tiles.values())
+
+    def copy(self):
+        """Copies the mask; uniform tiles cost nothing to copy"""
+        mask = TiledFogMask(self.shape, 0, self.tile_size)
+        mask.constants = self.constants.copy()
+        mask.tiles = {key: tile.copy() for key, tile in self.tiles.items()}
+        return mask
+
+    def fill(self, value):
+        """Sets every pixel to value in O(tiles)"""
+        self.constants.fill(value)
+        self.tiles.clear()
+
+    def __array__(self, dtype=None, copy=None):
+        pixels = self[:, :]
+        return pixels if dtype is None else pixels.astype(dtype)
+
+    def region(self, key):
+        """Converts a [y1:y2, x1:x2] key into clamped (x1, y1, x2, y2)"""
+        return slice_region(key, self.shape, "TiledFogMask")
+
+    def tile_spans(self, x1, y1, x2, y2):
+        """Yields each overlapping tile with the overlap in tile and region coords"""
+        size = self.tile_size
+        for row in range(y1 // size, -(-y2 // size)):
+            ty1 = max(y1, row * size)
+            ty2 = min(y2, (row + 1) * size)
+            for col in range(x1 // size, -(-x2 // size)):
+                tx1 = max(x1, col * size)
+                tx2 = min(x2, (col + 1) * size)
+                yield (row, col,
+                       (slice(ty1 - row * size, ty2 - row * size),
+                        slice(tx1 - col * size, tx2 - col * size)),
+                       (slice(ty1 - y1, ty2 - y1), slice(tx1 - x1, tx2 - x1)))
+
+    def tile_shape(self, row, col):
+        """Pixel size of a tile, smaller along the right and bottom edges"""
+        size = self.tile_size
+        return (min(size, self.shape[0] - row * size),
+                min(size, self.shape[1] - col * size))
+
+    def __getitem__(self, key):
+        x1, y1, x2, y2 = self.region(key)
+        pixels = np.empty((y2 - y1, x2 - x1), dtype=np.uint8)
+        for row, col, tile_part, region_part in self.tile_spans(x1, y1, x2, y2):
+            value = self.constants[row, col]
+            if value >= 0:
+                pixels[region_part] = value
+            else:
+                pixels[region_part] = self.tiles[(row, col)][tile_part]
+        return pixels
+
+    def __setitem__(self, key, value):
+        x1, y1, x2, y2 = self.region(key)
+        if isinstance(value, TiledFogMask):
+            if (x1, y1, x2, y2) == (0, 0) + self.shape[::-1]:
+                copied = value.copy()
+                self.constants, self.tiles = copied.constants, copied.tiles
+                return
+            value = value[:, :]
+
+        if np.isscalar(value) or np.ndim(value) == 0:
+            value = int(value)
+        else:
+            value = np.broadcast_to(np.asarray(value, dtype=np.uint8),
+                                    (y2 - y1, x2 - x1))
+
+        for row, col, tile_part, region_part in self.tile_spans(x1, y1, x2, y2):
+            part = value if isinstance(value, int) else value[region_part]
+            tile_shape = self.tile_shape(row, col)
+            covers_tile = (tile_part[0].stop - tile_part[0].start == tile_shape[0] and
+                           tile_part[1].stop - tile_part[1].start == tile_shape[1])
+
+            if covers_tile:
+                uniform = part if isinstance(part, int) else uniform_value(part)
+                if uniform is not None:
+                    self.constants[row, col] = uniform
+                    self.tiles.pop((row, col), None)
+                else:
+                    self.constants[row, col] = -1
+                    self.tiles[(row, col)] = np.array(part, dtype=np.uint8)
+                continue
+
+            tile = self.tiles.get((row, col))
+            if tile is None:
+                constant = self.constants[row, col]
+                if isinstance(part, int) and part == constant:
+                    continue
+                tile = np.full(tile_shape, constant, dtype=np.uint8)
+            tile[tile_part] = part
+
+            uniform = uniform_value(tile)
+            if uniform is not None:
+                self.constants[row, col] = uniform
+                self.tiles.pop((row, col), None)
+            else:
+                self.constants[row, col] = -1
+                self.tiles[(row, col)] = tile
+
+
+class GridFogMask:
+    """The fog of a map on a square battle grid, stored as one bit per cell.
+
+    Cells are cell_size map pixels wide with grid lines at offset (x, y) and
+    every cell_size pixels from there; the partial cells along the map edges
+    are cells too. Like TiledFogMask it slices as a uint8 0/255 mask, here of
+    [rows, cols] cells, so the fog code works on cells unchanged while only
+    the packed bits are kept. expand() turns cells into display pixels
+    through per-display-size index maps, which are cached.
+    """
+
+    def __init__(self, map_shape, cell_size, offset=(0, 0), fill=0):
+        self.map_shape = (int(map_shape[0]), int(map_shape[1]))
+        self.cell_size = int(cell_size)
+        self.offset = (int(offset[0]) % self.cell_size, int(offset[1]) % self.cell_size)
+        # Map position of the first cell, which starts off the map when the
+        # first grid line isn't on the edge
+        self.origin = tuple(o - self.cell_size if o else 0 for o in self.offset)
+        self.shape = grid_shape(self.map_shape, self.cell_size, self.offset)
+        self.dtype = np.dtype(np.uint8)
+        self.ndim = 2
+        self.bits = np.full((self.shape[0], -(-self.shape[1] // 8)),
+                            255 if fill > 127 else 0, dtype=np.uint8)
+        self.index_maps = {}
+
+    @classmethod
+    def from_mask(cls, fog_mask, map_shape, cell_size, offset=(0, 0)):
+        """Builds a grid from any fog mask: a cell is revealed if its centre is"""
+        mask = cls(map_shape, cell_size, offset)
+        centres_x = mask.origin[0] + (np.arange(mask.shape[1]) + 0.5) * mask.cell_size
+        centres_y = mask.origin[1] + (np.arange(mask.shape[0]) + 0.5) * mask.cell_size
+        mask[:, :] = sample_mask(fog_mask, map_shape, centres_x, centres_y)
+        return mask
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    @property
+    def geometry(self):
+        """(cell_size, offset), enough to rebuild the grid for the same map"""
+        return (self.cell_size, self.offset)
+
+    def copy(self):
+        mask = GridFogMask(self.map_shape, self.cell_size, self.offset)
+        mask.bits = self.bits.copy()
+        return mask
+
+    def fill(self, value):
+        """Sets every cell in O(cells / 8)"""
+        self.bits.fill(255 if value > 127 else 0)
+
+    def __array__(self, dtype=None, copy=None):
+        pixels = self[:, :]
+        return pixels if dtype is None else pixels.astype(dtype)
+
+    def __getitem__(self, key):
+        x1, y1, x2, y2 = slice_region(key, self.shape, "GridFogMask")
+        byte_x1 = x1 // 8
+        bits = np.unpackbits(self.bits[y1:y2, byte_x1:-(-x2 // 8)], axis=1)
+        return bits[:, x1 - byte_x1 * 8:x2 - byte_x1 * 8] * np.uint8(255)
+
+    def __setitem__(self, key, value):
+        x1, y1, x2, y2 = slice_region(key, self.shape, "GridFogMask")
+        if isinstance(value, GridFogMask):
+            value = value[:, :]
+        value = np.broadcast_to(np.asarray(value) > 127, (y2 - y1, x2 - x1))
+
+        # Rewrite the whole bytes the cells fall in
+        byte_x1, byte_x2 = x1 // 8, -(-x2 // 8)
+        bits = np.unpackbits(self.bits[y1:y2, byte_x1:byte_x2], axis=1)
+        bits[:, x1 - byte_x1 * 8:x2 - byte_x1 * 8] = value
+        self.bits[y1:y2, byte_x1:byte_x2] = np.packbits(bits, axis=1)
+
+    def map_to_cell(self, x, y):
+        """The (column, row) of the cell holding a map point"""
+        return (int((x - self.origin[0]) // self.cell_size),
+                int((y - self.origin[1]) // self.cell_size))
+
+    def rect_to_map(self, rect):
+        """The map rectangle covered by a rectangle of cells"""
+        x1, y1, x2, y2 = rect
+        size = self.cell_size
+        return (max(0, self.origin[0] + x1 * size), max(0, self.origin[1] + y1 * size),
+                min(self.map_shape[1], self.origin[0] + x2 * size),
+                min(self.map_shape[0], self.origin[1] + y2 * size))
+
+    def sample_region(self, rect, pixels):
+        """Converts a map-resolution patch into (cell rect, cells), taking
+        each cell whose centre lies in the patch from it"""
+        x1, y1 = self.map_to_cell(rect[0], rect[1])
+        x2, y2 = self.map_to_cell(rect[2] - 1, rect[3] - 1)
+        x1, y1 = max(0, x1), max(0, y1)
+        x2, y2 = min(self.shape[1], x2 + 1), min(self.shape[0], y2 + 1)
+        centres_x = self.origin[0] + (np.arange(x1, x2) + 0.5) * self.cell_size - rect[0]
+        centres_y = self.origin[1] + (np.arange(y1, y2) + 0.5) * self.cell_size - rect[1]
+        cols = np.clip(centres_x, 0, pixels.shape[1] - 1).astype(np.intp)
+        rows = np.clip(centres_y, 0, pixels.shape[0] - 1).astype(np.intp)
+        inside = (((centres_y >= 0) & (centres_y < pixels.shape[0]))[:, None] &
+                  ((centres_x >= 0) & (centres_x < pixels.shape[1]))[None, :])
+        return (x1, y1, x2, y2), np.where(inside, pixels[np.ix_(rows, cols)], 0).astype(np.uint8)
+
+    def display_index(self, display_size):
+        """Cell row and column of every display row and column, cached"""
+        index = self.index_maps.get(display_size)
+        if index is None:
+            width, height = display_size
+            map_x = (np.arange(width) + 0.5) * self.map_shape[1] / width
+            map_y = (np.arange(height) + 0.5) * self.map_shape[0] / height
+            cols = np.clip((map_x - self.origin[0]) // self.cell_size, 0, self.shape[1] - 1)
+            rows = np.clip((map_y - self.origin[1]) // self.cell_size, 0, self.shape[0] - 1)
+            index = (rows.astype(np.intp), cols.astype(np.intp))
+            if len(self.index_maps) >= 8:
+                self.index_maps.clear()
+            self.index_maps[display_size] = index
+        return index
+
+    def expand(self, display_size, display_rect=None):
+        """The fog at display_size (or just display_rect of it), crisp per cell"""
+        rows, cols = self.display_index(tuple(display_size))
+        if display_rect is not None:
+            x1, y1, x2, y2 = display_rect
+            rows, cols = rows[y1:y2], cols[x1:x2]
+        if len(rows) == 0 or len(cols) == 0:
+            return np.zeros((len(rows), len(cols)), dtype=np.uint8)
+        # Only the cells behind the area are unpacked
+        cells = self[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+        return cells[np.ix_(rows - rows[0], cols - cols[0])]
+
+
+def grid_shape(map_shape, cell_size, offset=(0, 0)):
+    """(rows, cols) of the grid cells covering a map"""
+    origin = [o % cell_size - cell_size if o % cell_size else 0 for o in offset]
+    return (-(-(int(map_shape[0]) - origin[1]) // cell_size),
+            -(-(int(map_shape[1]) - origin[0]) // cell_size))
+
+
+def saved_fog_shape(map_shape, metadata):
+    """Shape the mask of a fog save must have to belong to a map"""
+    grid = metadata.get('grid')
+    if grid:
+        return grid_shape(map_shape, grid['cell_size'], grid['offset'])
+    return fog_shape(map_shape, metadata.get('fog_scale', 1))
+
+
+def sample_mask(fog_mask, map_shape, map_x, map_y):
+    """Values of any fog mask at the map columns map_x and rows map_y"""
+    pixels = np.asarray(fog_mask[:, :])
+    if isinstance(fog_mask, GridFogMask):
+        cols = (np.asarray(map_x) - fog_mask.origin[0]) // fog_mask.cell_size
+        rows = (np.asarray(map_y) - fog_mask.origin[1]) // fog_mask.cell_size
+    else:
+        cols = np.asarray(map_x) * fog_mask.shape[1] / map_shape[1]
+        rows = np.asarray(map_y) * fog_mask.shape[0] / map_shape[0]
+    cols = np.clip(cols, 0, fog_mask.shape[1] - 1).astype(np.intp)
+    rows = np.clip(rows, 0, fog_mask.shape[0] - 1).astype(np.intp)
+    return pixels[np.ix_(rows, cols)]
+
+
+def slice_region(key, shape, name):
+    """Converts a [y1:y2, x1:x2] key into clamped (x1, y1, x2, y2)"""
+    if not isinstance(key, tuple) or len(key) != 2:
+        raise IndexError(f"{name} only supports [y1:y2, x1:x2] slicing")
+    y_range = key[0].indices(shape[0])
+    x_range = key[1].indices(shape[1])
+    if y_range[2] != 1 or x_range[2] != 1:
+        raise IndexError(f"{name} does not support strided slices")
+    return (x_range[0], y_range[0], max(x_range[0], x_range[1]),
+            max(y_range[0], y_range[1]))
+
+
+def uniform_value(pixels):
+    """Returns the single value of an array, or None if it has several"""
+    first = int(pixels.flat[0])
+    if (pixels == first).all():
+        return first
+    return None
@@ -1,21 +1,153 @@
+from collections import deque
 from utils.save_utils import update_status
+from utils.render_utils import union_rect
+from utils.autosave_utils import encode_patch
+from utils.tile_utils import TiledFogMask
+
+# Default memory budget for the undo/redo history (256 MB)
+DEFAULT_UNDO_BUDGET = 256 * 1024 * 1024
+
+
+class UndoHistory:
+    """Keeps fog changes as small rectangle patches instead of full mask copies.
+
+    Each entry is a list of (rect, pixels) patches taken from the mask before
+    it changed. A click-drag is grouped into one entry between begin_stroke()
+    and end_stroke(). Once the stored patches exceed max_bytes the oldest
+    entries are dropped.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_UNDO_BUDGET):
+        self.max_bytes = max_bytes
+        # Oldest step first, so eviction pops from the left in O(1)
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.used_bytes = 0
+        self.stroke = None
+
+    def clear(self):
+        """Forgets all history, e.g. when a different mask is loaded"""
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.used_bytes = 0
+        self.stroke = None
+
+    def begin_stroke(self):
+        """Starts grouping the following records into a single undo step"""
+        self.end_stroke()
+        self.stroke = []
+
+    def end_stroke(self):
+        """Closes the current stroke and pushes it onto the undo stack"""
+        if self.stroke:
+            self.undo_stack.append(self.stroke)
+        self.stroke = None
+
+    def record(self, fog_mask, rect=None):
+        """Saves the pixels of rect (the whole mask if None) before they change"""
+        self.drop_redo()
+        patch = capture_patch(fog_mask, rect)
+        self.used_bytes += patch[1].nbytes
+
+        if self.stroke is not None:
+            self.stroke.append(patch)
+        else:
+            self.undo_stack.append([patch])
+        self.enforce_budget()
+
+    def drop_redo(self):
+        """Discards the redo history after a new change"""
+        for entry in self.redo_stack:
+            self.used_bytes -= entry_size(entry)
+        self.redo_stack.clear()
+
+    def enforce_budget(self):
+        """Evicts the oldest undo steps until the history fits in max_bytes"""
+        while self.used_bytes > self.max_bytes and self.undo_stack:
+            self.used_bytes -= entry_size(self.undo_stack.popleft())
+
+    def undo(self, fog_mask):
+        """Restores the last step in place and returns the changed bbox"""
+        self.end_stroke()
+        if not self.undo_stack:
+            return None
+        entry = self.undo_stack.pop()
+        self.redo_stack.append(apply_entry(fog_mask, entry))
+        return entry_bbox(entry)
+
+    def redo(self, fog_mask):
+        """Re-applies the last undone step in place and returns the changed bbox"""
+        self.end_stroke()
+        if not self.redo_stack:
+            return None
+        entry = self.redo_stack.pop()
+        self.undo_stack.append(apply_entry(fog_mask, entry))
+        return entry_bbox(entry)
+
+
+def capture_patch(fog_mask, rect=None):
+    """Copies the pixels of a (x1, y1, x2, y2) rectangle of the mask"""
+    whole = (0, 0, fog_mask.shape[1], fog_mask.shape[0])
+    if rect is None:
+        rect = whole
+    if isinstance(fog_mask, TiledFogMask) and tuple(rect) == whole:
+        # Keeps uniform tiles compact instead of expanding every pixel
+        return (rect, fog_mask.copy())
+    x1, y1, x2, y2 = rect
+    return (rect, fog_mask[y1:y2, x1:x2].copy())
+
+
+def apply_entry(fog_mask, entry):
+    """Writes an entry's patches back and returns the entry that reverts it"""
+    # Snapshot every rect first so the inverse comes from one consistent state
+    inverse = [capture_patch(fog_mask, rect) for rect, _ in entry]
+    # Later patches of a stroke were taken after earlier ones, so restore
+    # newest first to end at the oldest pixels
+    for (x1, y1, x2, y2), pixels in reversed(entry):
+        fog_mask[y1:y2, x1:x2] = pixels
+    return inverse
+
+
+def entry_size(entry):
+    """Bytes held by an entry's patches"""
+    return sum(pixels.nbytes for _, pixels in entry)
+
+
+def entry_bbox(entry):
+    """Bounding box of all patches in an entry"""
+    bbox = None
+    for rect, _ in entry:
+        bbox = union_rect(bbox, rect)
+    return bbox
+
 
 def undo(self, event=None):
         """Undoes the last done action"""
-        if self.undo_stack:
-            self.redo_stack.append(self.fog_mask.copy())
-            self.fog_mask = self.undo_stack.pop()
-            self.update_queue.put("update_all")
+        bbox = self.history.undo(self.fog_mask)
+        if bbox is not None:
+            journal_change(self, bbox)
+            self.mark_dirty(bbox)
             update_status(self, "Undo applied")
         else:
             update_status(self, "Nothing to undo")
 
 def redo(self):
         """Redoes the undo action"""
-        if self.redo_stack:
-            self.undo_stack.append(self.fog_mask.copy())
-            self.fog_mask = self.redo_stack.pop()
-            self.update_queue.put("update_all")
-            update_status("self, Redo applied")
+        bbox = self.history.redo(self.fog_mask)
+        if bbox is not None:
+            journal_change(self, bbox)
+            self.mark_dirty(bbox)
+            update_status(self, "Redo applied")
         else:
             update_status(self, "Nothing to redo")
+
+def journal_change(self, bbox):
+        """Journals the fog of bbox as it is after an undo or redo"""
+        x1, y1, x2, y2 = bbox
+        if (x1, y1, x2, y2) == (0, 0, self.fog_mask.shape[1], self.fog_mask.shape[0]):
+            # Undoing a reset or clear: the autosave worker packs the mask,
+            # tile by tile when it is tiled, off the Tk thread
+            self.autosave.record_mask()
+        else:
+            self.autosave.record(
+                'patch', bbox, data=encode_patch(self.fog_mask[y1:y2, x1:x2]))
@@ -0,0 +1,138 @@
+"""Network player view: shows the fog streamed by the DM's Fog of War app
+
+    python viewer.py HOST[:PORT]
+
+Start the player server from the control panel first. F11 toggles
+fullscreen and Esc leaves it.
+"""
+import sys
+import time
+import queue
+import socket
+import threading
+import tkinter as tk
+import numpy as np
+
+from utils.map_utils import MapSource
+from utils.render_utils import FogRenderer
+from utils.net_utils import (PLAYER_PORT, MSG_MAP, MSG_FOG, recv_message,
+                             decode_map, decode_fog_region)
+from windows.canvas_image import CanvasImage
+
+# Seconds between reconnection attempts
+RECONNECT_DELAY = 2.0
+# How often the Tk side applies received messages (milliseconds)
+POLL_INTERVAL_MS = 15
+
+
+class PlayerViewer:
+    """A window showing the player view received from a PlayerServer"""
+
+    def __init__(self, host, port=PLAYER_PORT):
+        self.host = host
+        self.port = port
+        self.messages = queue.Queue()
+
+        self.map_source = None
+        self.fog_mask = None
+        self.renderer = FogRenderer()
+        self.needs_draw = False
+
+        self.root = tk.Tk()
+        self.root.title(f"Player View - {host}:{port}")
+        self.root.geometry("800x600")
+        self.root.configure(bg='black')
+        self.root.bind('<Escape>', lambda e: self.root.attributes('-fullscreen', False))
+        self.root.bind('<F11>', self.toggle_fullscreen)
+
+        self.canvas = tk.Canvas(self.root, bg="black", highlightthickness=0)
+        self.canvas.pack(fill="both", expand=True)
+        self.canvas.bind("<Configure>", lambda e: self.request_draw())
+        self.view_image = CanvasImage(self.canvas)
+        self.status = self.canvas.create_text(
+            10, 10, anchor="nw", fill="white", text=f"Connecting to {host}:{port}...")
+
+        threading.Thread(target=self.receive_loop, daemon=True).start()
+        self.root.after(POLL_INTERVAL_MS, self.poll)
+
+    def toggle_fullscreen(self, event=None):
+        """Toggles fullscreen mode"""
+        self.root.attributes('-fullscreen', not self.root.attributes('-fullscreen'))
+
+    def receive_loop(self):
+        """Reads messages on a background thread, reconnecting when dropped"""
+        while True:
+            try:
+                with socket.create_connection((self.host, self.port)) as sock:
+                    self.messages.put(('status', ""))
+                    while True:
+                        message = recv_message(sock)
+                        if message is None:
+                            break
+                        self.messages.put(message)
+            except OSError as e:
+                print(f"Error connecting to {self.host}:{self.port}: {e}")
+            self.messages.put(('status', "Disconnected, retrying..."))
+            time.sleep(RECONNECT_DELAY)
+
+    def poll(self):
+        """Applies every received message on the Tk thread, then redraws once"""
+        try:
+            while True:
+                kind, *message = self.messages.get_nowait()
+                if kind == 'status':
+                    self.canvas.itemconfigure(self.status, text=message[0])
+                    self.canvas.tag_raise(self.status)
+                elif kind == MSG_MAP:
+                    self.apply_map(*message)
+                elif kind == MSG_FOG and self.fog_mask is not None:
+                    self.apply_fog(*message)
+        except queue.Empty:
+            pass
+
+        if self.needs_draw:
+            self.draw()
+        self.root.after(POLL_INTERVAL_MS, self.poll)
+
+    def apply_map(self, header, payload):
+        """Replaces the base map; the fog follows in the next message"""
+        width, height = header['size']
+        self.map_source = MapSource.from_array(decode_map(payload))
+        self.fog_mask = np.zeros((height, width), dtype=np.uint8)
+        self.renderer.mark_dirty()
+        self.request_draw()
+
+    def apply_fog(self, header, payload):
+        """Writes a fog region into the local mask"""
+        (x1, y1, x2, y2), pixels = decode_fog_region(header, payload)
+        self.fog_mask[y1:y2, x1:x2] = pixels
+        self.renderer.mark_dirty((x1, y1, x2, y2))
+        self.request_draw()
+
+    def request_draw(self):
+        self.needs_draw = True
+
+    def draw(self):
+        """Renders the changed part of the view into the canvas"""
+        self.needs_draw = False
+        if self.map_source is None:
+            return
+        canvas_size = (max(1, self.canvas.winfo_width()), max(1, self.canvas.winfo_height()))
+        frame, changed, layout = self.renderer.render(
+            'player', self.map_source, self.fog_mask, canvas_size)
+        self.view_image.show(frame, changed, layout.x_offset, layout.y_offset)
+
+    def run(self):
+        self.root.mainloop()
+
+
+def main():
+    if len(sys.argv) != 2:
+        print(__doc__)
+        sys.exit(1)
+    host, _, port = sys.argv[1].partition(":")
+    PlayerViewer(host, int(port) if port else PLAYER_PORT).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+from PIL import Image, ImageTk
+
+
+class CanvasImage:
+    """One persistent canvas image item whose PhotoImage is updated in place.
+
+    The PhotoImage is only rebuilt when the frame size changes; otherwise
+    just the rectangle the renderer recomposited is pasted into a scratch
+    PhotoImage and copied into it from there. The scratch image only grows
+    when a bigger rectangle arrives, so long drags don't churn Tk image
+    objects.
+    """
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.photo = None
+        self.item = None
+        self.size = None
+        self.scratch = None
+        self.scratch_size = (0, 0)
+
+    def show(self, frame, changed, x, y):
+        """Displays a uint8 RGB frame at canvas position x, y"""
+        size = (frame.shape[1], frame.shape[0])
+        if self.photo is None or size != self.size:
+            self.photo = ImageTk.PhotoImage(Image.fromarray(frame))
+            self.size = size
+            if self.item is None:
+                self.item = self.canvas.create_image(x, y, anchor="nw", image=self.photo)
+            else:
+                self.canvas.itemconfigure(self.item, image=self.photo)
+        elif changed == (0, 0) + size:
+            self.photo.paste(Image.fromarray(frame))
+        elif changed is not None:
+            x1, y1, x2, y2 = changed
+            width, height = x2 - x1, y2 - y1
+            if width > self.scratch_size[0] or height > self.scratch_size[1]:
+                self.scratch_size = (max(width, self.scratch_size[0]),
+                                     max(height, self.scratch_size[1]))
+                self.scratch = ImageTk.PhotoImage(
+                    "RGB", self.scratch_size,
+                    width=self.scratch_size[0], height=self.scratch_size[1])
+            # Fills the top left of the scratch image
+            self.scratch.paste(Image.fromarray(frame[y1:y2, x1:x2]))
+            self.canvas.tk.call(str(self.photo), "copy", str(self.scratch),
+                                "-from", 0, 0, width, height, "-to", x1, y1)
+
+        if tuple(self.canvas.coords(self.item)) != (x, y):
+            self.canvas.coords(self.item, x, y)
+
+    def clear(self):
+        """Removes the image item, e.g. after a drawing error"""
+        if self.item is not None:
+            self.canvas.delete(self.item)
+        self.photo = None
+        self.item = None
+        self.size = None
@@ -1,12 +1,18 @@
 import customtkinter as ctk
 import tkinter as tk
+import time
 from tkinter import messagebox
-import numpy as np
-from PIL import Image, ImageTk
 
-from utils.save_utils import manual_save, save_fog_state
-from utils.fog_utils import reset_fog, clear_fog, reveal_area
+from utils.save_utils import manual_save
+from utils.fog_utils import reset_fog, clear_fog
 from utils.undo_redo_utils import undo, redo
+from utils.region_utils import reveal_region
+from windows.canvas_image import CanvasImage
+
+# Zoom step per mouse wheel notch
+ZOOM_STEP = 1.25
+# Deepest zoom, in screen pixels per map pixel
+MAX_PIXEL_ZOOM = 8
 
 class DMWindow:
     """Generates the DM Window"""
@@ -30,6 +36,11 @@ class DMWindow:
             self.window.bind('<Control-z>', lambda e: undo(self.fog_app))
             self.window.bind('<Control-y>', lambda e: redo(self.fog_app))
 
+            # Frame timing overlay
+            self.window.bind('<F3>', self.toggle_perf_overlay)
+            self.perf_overlay = False
+            self.overlay_after_id = None
+
             # Bind window close event to auto-save
             self.window.protocol("WM_DELETE_WINDOW", self.on_closing)
 
@@ -44,6 +55,25 @@ class DMWindow:
             # Bind click events
             self.canvas.bind("<Button-1>", self.on_click)
             self.canvas.bind("<B1-Motion>", self.on_drag)
+            self.canvas.bind("<ButtonRelease-1>", self.on_release)
+            # Shift+Click reveals the whole room; dragging it does nothing more
+            self.canvas.bind("<Shift-Button-1>", self.on_room_click)
+            self.canvas.bind("<Shift-B1-Motion>", lambda e: None)
+            # Ctrl+Click places a token that reveals what it can see,
+            # Ctrl+Drag walks it around and Delete takes it off the map
+            self.canvas.bind("<Control-Button-1>", self.on_token_click)
+            self.canvas.bind("<Control-B1-Motion>", self.on_token_drag)
+            self.canvas.bind("<Control-ButtonRelease-1>", lambda e: self.fog_app.sight.end())
+            self.window.bind('<Delete>', lambda e: self.fog_app.sight.remove())
+
+            # Mouse wheel zooms around the cursor, right or middle drag pans
+            self.canvas.bind("<MouseWheel>", self.on_wheel)
+            self.canvas.bind("<Button-4>", lambda e: self.zoom_at(e.x, e.y, 1))
+            self.canvas.bind("<Button-5>", lambda e: self.zoom_at(e.x, e.y, -1))
+            for button in (2, 3):
+                self.canvas.bind(f"<Button-{button}>", self.on_pan_start)
+                self.canvas.bind(f"<B{button}-Motion>", self.on_pan)
+            self.window.bind('<Home>', self.reset_view)
 
             # Variables for smooth dragging (removed since we're handling it differently)
             self.last_drag_time = 0
@@ -54,9 +84,20 @@ class DMWindow:
             self.display_height = 0
             self.x_offset = 0
             self.y_offset = 0
-            self.dm_photo = None
+            # Zoom relative to fitting the whole map, and the map point at the
+            # centre of the canvas (None centres the map)
+            self.zoom = 1.0
+            self.view_center = None
+            self.pan_anchor = None
+
+            # Persistent canvas image, patched in place for the areas the
+            # renderer recomposited
+            self.view_image = CanvasImage(self.canvas)
+            self.layout = None
 
-            self.window.after(500, self.update_display)
+            # Redraw through the scheduler, including whenever the canvas resizes
+            self.canvas.bind("<Configure>", self.on_resize)
+            self.fog_app.scheduler.register('dm', self.update_display)
 
         except Exception as e:
             print(f"Error creating DM window: {e}")
@@ -71,14 +112,26 @@ class DMWindow:
                             "Ctrl + Y  : Redo last undone action\n"
                             "F11       : Toggle fullscreen\n"
                             "Esc       : Exit fullscreen\n"
+                            "F3        : Toggle frame timings\n"
+                            "Home      : Show the whole map\n"
                             "F1        : Show this help\n\n"
                             "Mouse:\n"
                             "Left Click      : Reveal fog\n"
-                            "Click + Drag    : Reveal multiple areas")
+                            "Click + Drag    : Reveal multiple areas\n"
+                            "Shift + Click   : Reveal a whole room\n"
+                            "Ctrl + Click    : Place a sight token\n"
+                            "Ctrl + Drag     : Move the token, revealing what it sees\n"
+                            "Delete          : Remove the token\n"
+                            "Mouse Wheel     : Zoom in and out\n"
+                            "Right Drag      : Pan the map")
 
     def on_closing(self):
         """Handle window closing - auto-save before closing"""
-        save_fog_state(self.fog_app, auto_save=True)
+        if self.overlay_after_id is not None:
+            self.window.after_cancel(self.overlay_after_id)
+        self.fog_app.autosave.flush()
+        self.fog_app.scheduler.unregister('dm')
+        self.fog_app.renderer.drop_view('dm')
         self.fog_app.dm_window = None
         self.window.destroy()
 
@@ -88,35 +141,131 @@ class DMWindow:
         self.window.attributes('-fullscreen', not is_fullscreen)
         if is_fullscreen:
             self.window.geometry("800x600")
-        self.window.after(100, self.update_display)
+
+    def on_resize(self, event=None):
+        """Redraws at the new canvas size on the next frame"""
+        self.fog_app.scheduler.request('dm')
+
+    def toggle_perf_overlay(self, event=None):
+        """Shows or hides the frame timings; showing them starts collection"""
+        self.perf_overlay = not self.perf_overlay
+        if self.perf_overlay:
+            self.fog_app.perf.enabled = True
+            self.draw_perf_overlay()
+        else:
+            if self.overlay_after_id is not None:
+                self.window.after_cancel(self.overlay_after_id)
+                self.overlay_after_id = None
+            self.canvas.delete("perf_overlay")
+
+    def draw_perf_overlay(self):
+        """Redraws the timing overlay, refreshing it twice a second while shown"""
+        if self.overlay_after_id is not None:
+            self.window.after_cancel(self.overlay_after_id)
+        self.overlay_after_id = self.window.after(500, self.draw_perf_overlay)
+
+        self.canvas.delete("perf_overlay")
+        text = self.canvas.create_text(
+            10, 10, anchor="nw", text=self.fog_app.perf.overlay_text(),
+            fill="#00ff66", font=("Courier", 10), tags="perf_overlay")
+        x1, y1, x2, y2 = self.canvas.bbox(text)
+        background = self.canvas.create_rectangle(
+            x1 - 4, y1 - 4, x2 + 4, y2 + 4, fill="black", outline="",
+            tags="perf_overlay")
+        self.canvas.tag_lower(background, text)
 
     def on_click(self, event):
         """Handles clicking on the DM side"""
-        if self.fog_app.map_image is not None:
-            image_x = event.x - self.x_offset
-            image_y = event.y - self.y_offset
-
-            x = int(image_x / self.scale_factor)
-            y = int(image_y / self.scale_factor)
-
-            x = max(0, min(x, self.fog_app.map_image.shape[1] - 1))
-            y = max(0, min(y, self.fog_app.map_image.shape[0] - 1))
-
-            reveal_area(self.fog_app, x, y, force_update=True)
+        if self.fog_app.editable and self.layout is not None:
+            x, y = self.layout.canvas_to_map(event.x, event.y)
+            self.fog_app.stroke.begin(x, y)
+
+    def on_room_click(self, event):
+        """Reveals the room under the cursor"""
+        if self.fog_app.editable and self.layout is not None:
+            x, y = self.layout.canvas_to_map(event.x, event.y)
+            self.fog_app.stroke.end()
+            reveal_region(self.fog_app, x, y)
+
+    def on_token_click(self, event):
+        """Places the sight token under the cursor"""
+        if self.fog_app.editable and self.layout is not None:
+            x, y = self.layout.canvas_to_map(event.x, event.y)
+            self.fog_app.stroke.end()
+            self.fog_app.sight.place(x, y)
+            self.draw_token()
+
+    def on_token_drag(self, event):
+        """Moves the sight token with the mouse"""
+        if self.fog_app.editable and self.layout is not None:
+            x, y = self.layout.canvas_to_map(event.x, event.y)
+            self.fog_app.sight.move(x, y)
+
+    def draw_token(self):
+        """Draws the sight token marker at its place in the current view"""
+        self.canvas.delete("token")
+        token = self.fog_app.sight.visible_token()
+        if token is None or self.layout is None:
+            return
+        scale = self.layout.scale
+        x = token[0] * scale - self.layout.visible[0] + self.x_offset
+        y = token[1] * scale - self.layout.visible[1] + self.y_offset
+        self.canvas.create_oval(x - 8, y - 8, x + 8, y + 8, fill="#ffcc00",
+                                outline="black", width=2, tags="token")
 
     def on_drag(self, event):
         """Does basically on click but when dragging"""
-        if self.fog_app.map_image is not None:
-            image_x = event.x - self.x_offset
-            image_y = event.y - self.y_offset
+        if self.fog_app.editable and self.layout is not None:
+            x, y = self.layout.canvas_to_map(event.x, event.y)
+            self.fog_app.stroke.add_point(x, y)
+
+    def on_release(self, event):
+        """Ends the click-drag stroke, or a token drag whose Ctrl was let go first"""
+        self.fog_app.stroke.end()
+        self.fog_app.sight.end()
+
+    def on_wheel(self, event):
+        """Zooms with the mouse wheel (Windows and macOS)"""
+        self.zoom_at(event.x, event.y, 1 if event.delta > 0 else -1)
+
+    def zoom_at(self, x, y, steps):
+        """Zooms in (steps > 0) or out, keeping the map point under x, y in place"""
+        if self.layout is None:
+            return
+        fit_scale = self.layout.scale / self.layout.zoom
+        max_zoom = max(1.0, MAX_PIXEL_ZOOM / fit_scale)
+        zoom = max(1.0, min(self.zoom * ZOOM_STEP ** steps, max_zoom))
+        if zoom == self.zoom:
+            return
 
-            x = int(image_x / self.scale_factor)
-            y = int(image_y / self.scale_factor)
+        map_x, map_y = self.layout.map_point(x, y)
+        scale = fit_scale * zoom
+        self.view_center = (map_x - (x - self.canvas.winfo_width() / 2) / scale,
+                            map_y - (y - self.canvas.winfo_height() / 2) / scale)
+        self.zoom = zoom
+        self.fog_app.scheduler.request('dm')
 
-            x = max(0, min(x, self.fog_app.map_image.shape[1] - 1))
-            y = max(0, min(y, self.fog_app.map_image.shape[0] - 1))
+    def on_pan_start(self, event):
+        """Starts dragging the view"""
+        self.pan_anchor = (event.x, event.y)
 
-            reveal_area(self.fog_app, x, y, force_update=False)
+    def on_pan(self, event):
+        """Moves the view with the mouse"""
+        if self.layout is None or self.pan_anchor is None or self.zoom == 1.0:
+            return
+        # Several motion events can arrive before the next frame
+        center_x, center_y = self.view_center or self.layout.center
+        scale = self.layout.scale / self.layout.zoom * self.zoom
+        self.view_center = (center_x - (event.x - self.pan_anchor[0]) / scale,
+                            center_y - (event.y - self.pan_anchor[1]) / scale)
+        self.pan_anchor = (event.x, event.y)
+        self.fog_app.scheduler.request('dm')
+
+    def reset_view(self, event=None):
+        """Zooms back out to the whole map"""
+        self.zoom = 1.0
+        self.view_center = None
+        self.fog_app.scheduler.request('dm')
 
     def update_display(self):
         """Updates the DM display"""
@@ -133,45 +282,30 @@ class DMWindow:
                 canvas_width = 800
                 canvas_height = 600
 
-            img_height, img_width = self.fog_app.map_image.shape[:2]
-            scale_x = canvas_width / img_width
-            scale_y = canvas_height / img_height
-
-            self.scale_factor = min(scale_x, scale_y)
+            frame_start = time.perf_counter()
+            frame, changed, self.layout = self.fog_app.renderer.render(
+                'dm', self.fog_app.map_source, self.fog_app.fog_mask,
+                (canvas_width, canvas_height), self.zoom, self.view_center)
+            # Keep the view clamped to the map edges
+            self.view_center = self.layout.center if self.zoom > 1.0 else None
 
-            self.display_width = int(img_width * self.scale_factor)
-            self.display_height = int(img_height * self.scale_factor)
-
-            self.x_offset = (canvas_width - self.display_width) // 2
-            self.y_offset = (canvas_height - self.display_height) // 2
+            self.scale_factor = self.layout.scale
+            self.display_width, self.display_height = self.layout.display_size
+            self.x_offset = self.layout.x_offset
+            self.y_offset = self.layout.y_offset
 
             try:
-                dm_image = self.fog_app.map_image.copy()
-                fog_overlay = np.full_like(dm_image, 64, dtype=np.uint8)
-
-                fog_alpha = (
-                    255 - self.fog_app.fog_mask).astype(np.float32) / 255.0
-                fog_alpha = fog_alpha[:, :, np.newaxis]
-
-                dm_image = dm_image.astype(np.float32)
-                fog_overlay = fog_overlay.astype(np.float32)
-
-                dm_image = (dm_image * (1 - fog_alpha * 0.7) +
-                            fog_overlay * fog_alpha * 0.7).astype(np.uint8)
-
-                dm_pil = Image.fromarray(dm_image)
-                dm_pil_resized = dm_pil.resize(
-                    (self.display_width, self.display_height), Image.LANCZOS)
-                self.dm_photo = ImageTk.PhotoImage(dm_pil_resized)
-
-                self.canvas.delete("all")
-                self.canvas.create_image(
-                    self.x_offset, self.y_offset, anchor="nw", image=self.dm_photo)
+                with self.fog_app.perf.probe('photo'):
+                    self.view_image.show(frame, changed, self.x_offset, self.y_offset)
+                self.draw_token()
+                self.canvas.delete("error")
+                self.fog_app.perf.record('dm_frame', time.perf_counter() - frame_start)
 
             except Exception as e:
-                self.canvas.delete("all")
+                self.view_image.clear()
+                self.canvas.delete("error")
                 self.canvas.create_text(canvas_width//2, canvas_height//2,
-                                        text="Error loading map", fill="white")
+                                        text="Error loading map", fill="white", tags="error")
 
         except Exception as e:
             print(f"Error in update_display: {e}")
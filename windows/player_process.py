@@ -0,0 +1,130 @@
+import queue
+import tkinter as tk
+import numpy as np
+
+from utils.map_utils import MapSource
+from utils.render_utils import FogRenderer, mask_rect_to_map
+from utils.tile_utils import GridFogMask
+from utils.shared_utils import (attach_shared, take_changes, HEADER_GENERATION,
+                                HEADER_SLOTS)
+from windows.canvas_image import CanvasImage
+
+# How often the player process checks for fog changes (milliseconds)
+POLL_INTERVAL_MS = 8
+
+
+class PlayerProcessWindow:
+    """The player view drawn in its own process from shared memory"""
+
+    def __init__(self, header_name, lock, control):
+        self.lock = lock
+        self.control = control
+        self.header_block = attach_shared(header_name)
+        self.header = np.ndarray((HEADER_SLOTS,), dtype=np.int64,
+                                 buffer=self.header_block.buf)
+        self.fog_block = None
+        self.shared_fog = None
+        # The fog the renderer reads: the shared block itself, or for grid
+        # fog a local grid mask that changed cells are copied into
+        self.fog_mask = None
+        self.map_source = None
+        self.generation = None
+        self.last_seq = None
+        self.renderer = FogRenderer()
+        self.needs_draw = False
+
+        self.root = tk.Tk()
+        self.root.title("Player View - Fog of War")
+        self.root.geometry("800x600")
+        self.root.configure(bg='black')
+        self.root.bind('<Escape>', lambda e: self.root.attributes('-fullscreen', False))
+        self.root.bind('<F11>', self.toggle_fullscreen)
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+
+        self.canvas = tk.Canvas(self.root, bg="black", highlightthickness=0)
+        self.canvas.pack(fill="both", expand=True)
+        self.canvas.bind("<Configure>", lambda e: self.request_draw())
+        self.view_image = CanvasImage(self.canvas)
+
+        self.root.after(POLL_INTERVAL_MS, self.poll)
+
+    def toggle_fullscreen(self, event=None):
+        """Toggles fullscreen mode"""
+        self.root.attributes('-fullscreen', not self.root.attributes('-fullscreen'))
+
+    def poll(self):
+        """Applies control messages and fog changes, then redraws once"""
+        try:
+            while True:
+                message = self.control.get_nowait()
+                if message[0] == 'close':
+                    self.close()
+                    return
+                if message[0] == 'map':
+                    self.open_map(*message[1:])
+        except queue.Empty:
+            pass
+
+        if self.fog_mask is not None:
+            self.last_seq, rect = take_changes(self.header, self.lock, self.last_seq)
+            # Changes made for a map this process hasn't opened yet are
+            # covered by the full redraw when it does
+            if rect is not None and int(self.header[HEADER_GENERATION]) == self.generation:
+                if self.fog_mask is not self.shared_fog:
+                    x1, y1, x2, y2 = rect
+                    self.fog_mask[y1:y2, x1:x2] = self.shared_fog[y1:y2, x1:x2]
+                self.renderer.mark_dirty(
+                    mask_rect_to_map(self.fog_mask, rect, self.map_source.shape))
+                self.request_draw()
+
+        if self.needs_draw:
+            self.draw()
+        self.root.after(POLL_INTERVAL_MS, self.poll)
+
+    def open_map(self, map_path, fog_name, shape, generation, grid):
+        """Switches to a new map and its shared fog block"""
+        self.fog_mask = None
+        self.shared_fog = None
+        if self.fog_block is not None:
+            self.fog_block.close()
+        self.fog_block = attach_shared(fog_name)
+        self.shared_fog = np.ndarray(shape, dtype=np.uint8, buffer=self.fog_block.buf)
+        self.map_source = MapSource.open(map_path)
+        self.fog_mask = self.shared_fog
+        if grid is not None:
+            self.fog_mask = GridFogMask(self.map_source.shape, *grid)
+            self.fog_mask[:, :] = self.shared_fog
+        self.generation = generation
+        self.renderer.mark_dirty()
+        self.request_draw()
+
+    def request_draw(self):
+        self.needs_draw = True
+
+    def draw(self):
+        """Renders the changed part of the view into the canvas"""
+        self.needs_draw = False
+        if self.map_source is None:
+            return
+        canvas_size = (max(1, self.canvas.winfo_width()), max(1, self.canvas.winfo_height()))
+        frame, changed, layout = self.renderer.render(
+            'player', self.map_source, self.fog_mask, canvas_size)
+        self.view_image.show(frame, changed, layout.x_offset, layout.y_offset)
+
+    def close(self):
+        """Closes the window; the DM side notices the process has exited"""
+        self.root.destroy()
+
+
+def run_player_process(header_name, lock, control):
+    """Entry point of the player process"""
+    window = PlayerProcessWindow(header_name, lock, control)
+    window.root.mainloop()
+    # Views into the shared blocks must go before the blocks are closed
+    window.fog_mask = None
+    window.shared_fog = None
+    window.header = None
+    window.renderer = None
+    if window.fog_block is not None:
+        window.fog_block.close()
+    window.header_block.close()
@@ -1,7 +1,8 @@
 import customtkinter as ctk
 import tkinter as tk
-import numpy as np
-from PIL import Image, ImageTk
+import time
+
+from windows.canvas_image import CanvasImage
 
 class PlayerWindow:
     """Sets up the player window"""
@@ -36,9 +37,15 @@ class PlayerWindow:
             self.display_height = 0
             self.x_offset = 0
             self.y_offset = 0
-            self.player_photo = None
 
-            self.window.after(500, self.update_display)
+            # Persistent canvas image, patched in place for the areas the
+            # renderer recomposited
+            self.view_image = CanvasImage(self.canvas)
+            self.layout = None
+
+            # Redraw through the scheduler, including whenever the canvas resizes
+            self.canvas.bind("<Configure>", self.on_resize)
+            self.fog_app.scheduler.register('player', self.update_display)
 
         except Exception as e:
             print(f"Error creating player window: {e}")
@@ -46,6 +53,8 @@ class PlayerWindow:
 
     def on_closing(self):
         """Handle window closing - auto-save before closing"""
+        self.fog_app.scheduler.unregister('player')
+        self.fog_app.renderer.drop_view('player')
         self.fog_app.player_window = None
         self.window.destroy()
 
@@ -55,7 +64,10 @@ class PlayerWindow:
         self.window.attributes('-fullscreen', not is_fullscreen)
         if is_fullscreen:
             self.window.geometry("800x600")
-        self.window.after(100, self.update_display)
+
+    def on_resize(self, event=None):
+        """Redraws at the new canvas size on the next frame"""
+        self.fog_app.scheduler.request('player')
 
     def update_display(self):
         """Updates the display based on DM screen"""
@@ -72,39 +84,28 @@ class PlayerWindow:
                 canvas_width = 800
                 canvas_height = 600
 
-            img_height, img_width = self.fog_app.map_image.shape[:2]
-            scale_x = canvas_width / img_width
-            scale_y = canvas_height / img_height
-
-            self.scale_factor = min(scale_x, scale_y)
+            frame_start = time.perf_counter()
+            frame, changed, self.layout = self.fog_app.renderer.render(
+                'player', self.fog_app.map_source, self.fog_app.fog_mask,
+                (canvas_width, canvas_height))
 
-            self.display_width = int(img_width * self.scale_factor)
-            self.display_height = int(img_height * self.scale_factor)
-
-            self.x_offset = (canvas_width - self.display_width) // 2
-            self.y_offset = (canvas_height - self.display_height) // 2
+            self.scale_factor = self.layout.scale
+            self.display_width, self.display_height = self.layout.display_size
+            self.x_offset = self.layout.x_offset
+            self.y_offset = self.layout.y_offset
 
             try:
-                fog_alpha = self.fog_app.fog_mask.astype(np.float32) / 255.0
-                fog_alpha = fog_alpha[:, :, np.newaxis]
-
-                player_image = (self.fog_app.map_image.astype(
-                    np.float32) * fog_alpha).astype(np.uint8)
-
-                player_pil = Image.fromarray(player_image)
-                player_pil_resized = player_pil.resize(
-                    (self.display_width, self.display_height), Image.LANCZOS)
-                self.player_photo = ImageTk.PhotoImage(player_pil_resized)
-
-                self.canvas.delete("all")
-                self.canvas.create_image(
-                    self.x_offset, self.y_offset, anchor="nw", image=self.player_photo)
+                with self.fog_app.perf.probe('photo'):
+                    self.view_image.show(frame, changed, self.x_offset, self.y_offset)
+                self.canvas.delete("error")
+                self.fog_app.perf.record('player_frame', time.perf_counter() - frame_start)
 
             except Exception as e:
                 print(f"Error creating player image: {e}")
-                self.canvas.delete("all")
+                self.view_image.clear()
+                self.canvas.delete("error")
                 self.canvas.create_text(canvas_width//2, canvas_height//2,
-                                        text="Error loading map", fill="white")
+                                        text="Error loading map", fill="white", tags="error")
 
         except Exception as e:
             print(f"Error in update_display: {e}")